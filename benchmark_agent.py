@@ -0,0 +1,263 @@
+"""
+问答流程压力测试：用本地模拟的模型服务和网络搜索驱动并发的多轮对话，测量问答循环本身的开销和并发上限
+
+不需要网络和 API Key。默认在临时目录中用合成语料和哈希嵌入模型建一个知识库，并启动 tools.mock_llm 子进程
+（需要安装 `pip install -e .[server]`）：
+
+    python benchmark_agent.py --concurrency 1 8 32 64 --sessions 64 --questions 2 --scenario db_web
+
+--mock-url 指向已经运行的模拟服务时不再启动子进程。每个并发级别报告：
+
+- 每个问题的延迟分位数和吞吐量（问题/秒）
+- 循环开销：每次问答的总耗时中不在模型调用和工具调用之内的部分（同一次问答中这些 span 的时间区间求并后相减）
+- 模型调用的首 token 延迟（与模拟服务设置的延迟相比，多出的部分是客户端排队）
+- 模拟服务观察到的最大并发请求数
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import io
+import contextlib
+import urllib.request
+
+from benchmark_retrieval import generate_corpus, generate_queries, percentiles
+
+SPAN_NAMES = ("agent.conversation", "llm.call", "tool.search_with_db", "tool.tavily_search", "context.build", "retrieve")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _http(url, method="GET", timeout=5):
+    request = urllib.request.Request(url, method=method)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def start_mock(args):
+    """启动模拟服务子进程，返回 (进程, base_url)"""
+    port = _free_port()
+    command = [
+        sys.executable, "-m", "tools.mock_llm", "--port", str(port), "--scenario", args.scenario,
+        "--collection", args.collection, "--first-token-ms", str(args.first_token_ms),
+        "--chunk-ms", str(args.chunk_ms), "--chunk-chars", str(args.chunk_chars), "--jitter", str(args.jitter),
+    ]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    base_url = f"http://127.0.0.1:{port}/v1"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("模拟服务启动失败")
+        try:
+            _http(f"{base_url}/models", timeout=1)
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("等待模拟服务启动超时")
+
+
+def build_collection(args):
+    """用合成语料和哈希嵌入模型建立测试知识库"""
+    from tools.fake_embeddings import HashingEmbeddings
+    from tools.registry import register_embeddings
+    from tools.vector_store import create_store
+    from tools import settings
+
+    embeddings = HashingEmbeddings(dim=args.dim)
+    register_embeddings(embeddings)
+    ids, texts, metadatas = generate_corpus(args.corpus_size)
+    with contextlib.redirect_stdout(io.StringIO()):
+        store = create_store(args.collection, settings.PERSIST_DIRECTORY, backend=args.backend)
+        for start in range(0, len(ids), 512):
+            end = start + 512
+            store.add(ids[start:end], embeddings.embed_documents(texts[start:end]), texts[start:end], metadatas[start:end])
+        store.flush()
+
+
+def _covered(intervals):
+    """时间区间求并后的总长度"""
+    total, current_start, current_end = 0.0, None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def loop_overhead(spans):
+    """每次问答中不在模型调用和工具调用之内的耗时（毫秒）"""
+    traces = {}
+    for s in spans:
+        traces.setdefault(s["trace_id"], []).append(s)
+    overheads, total = [], 0.0
+    for items in traces.values():
+        for conversation in (s for s in items if s["name"] == "agent.conversation"):
+            busy = [
+                (s["start"], s["start"] + s["duration"]) for s in items
+                if s["name"] == "llm.call" or s["name"].startswith("tool.")
+            ]
+            overheads.append((conversation["duration"] - _covered(busy)) * 1000)
+            total += conversation["duration"] * 1000
+    result = percentiles(overheads)
+    result["share"] = sum(overheads) / total if total else None
+    return result
+
+
+async def run_level(concurrency, args, queries, mock_url):
+    """以给定并发数运行 args.sessions 个会话，每个会话连续问 args.questions 个问题"""
+    import asyncio
+    from tools import tracing
+    from tools.agent import run_conversation_async
+    from tools.conversation import ConversationSession
+
+    tracing.reset()
+    await asyncio.to_thread(_http, f"{mock_url.rsplit('/v1', 1)[0]}/stats/reset", "POST")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def session_task(index):
+        async with semaphore:
+            session = ConversationSession()
+            for j in range(args.questions):
+                query = queries[(index * args.questions + j) % len(queries)]
+                started = time.perf_counter()
+                try:
+                    await run_conversation_async(query, collection_name=args.collection, session=session)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session_task(i) for i in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+
+    spans = tracing.recent_spans()
+    first_token = [s["attrs"]["first_token_ms"] for s in spans if s["name"] == "llm.call" and "first_token_ms" in s["attrs"]]
+    mock_stats = await asyncio.to_thread(_http, f"{mock_url.rsplit('/v1', 1)[0]}/stats")
+    return {
+        "concurrency": concurrency,
+        "sessions": args.sessions,
+        "questions": len(latencies),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "seconds": elapsed,
+        "questions_per_s": len(latencies) / elapsed if elapsed else None,
+        "latency": percentiles(latencies),
+        "loop_overhead": loop_overhead(spans),
+        "first_token": percentiles(first_token),
+        "mock_server": mock_stats,
+        "spans": [row for row in tracing.summarize(spans) if row["name"] in SPAN_NAMES],
+    }
+
+
+async def run_all(args, queries, mock_url):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    # 知识库检索在默认线程池中执行，线程数是并发上限之一
+    workers = args.executor_workers or min(32, (os.cpu_count() or 1) + 4)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(workers))
+    results = []
+    for concurrency in args.concurrency:
+        print(f"正在测试并发数 {concurrency}...", file=sys.stderr)
+        # 问答流程会打印每轮的调试信息，测量时屏蔽输出
+        with contextlib.redirect_stdout(io.StringIO()):
+            results.append(await run_level(concurrency, args, queries, mock_url))
+    return workers, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="问答流程压力测试")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="同时进行的会话数，可以测试多个级别")
+    parser.add_argument("--sessions", type=int, default=64, help="每个并发级别运行的会话数")
+    parser.add_argument("--questions", type=int, default=2, help="每个会话连续问的问题数")
+    parser.add_argument("--scenario", default="db", help="模拟服务的脚本：direct、db、web、db_web、multi 或自定义脚本名")
+    parser.add_argument("--mock-url", default=None, help="已经运行的模拟服务地址，例如 http://127.0.0.1:8700/v1")
+    parser.add_argument("--first-token-ms", type=float, default=200.0, help="模拟的首 token 延迟（毫秒）")
+    parser.add_argument("--chunk-ms", type=float, default=10.0, help="模拟的分片间隔（毫秒）")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="每个分片的字符数")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟延迟的随机浮动比例")
+    parser.add_argument("--search-latency-ms", type=float, default=300.0, help="模拟网络搜索的延迟（毫秒）")
+    parser.add_argument("--executor-workers", type=int, default=None, help="默认线程池的线程数")
+    parser.add_argument("--collection", default="bench_agent", help="测试知识库的集合名称")
+    parser.add_argument("--corpus-size", type=int, default=2000, help="测试知识库的片段数")
+    parser.add_argument("--dim", type=int, default=256, help="哈希嵌入的维度")
+    parser.add_argument("--backend", default="faiss", choices=["chroma", "faiss"], help="向量存储后端")
+    parser.add_argument("--answer-cache", action="store_true", help="启用答案缓存（默认关闭，以测量完整的问答流程）")
+    parser.add_argument("--work-dir", default=None, help="临时数据库目录，默认使用系统临时目录")
+    parser.add_argument("--output", default=None, help="结果 JSON 文件，默认输出到标准输出")
+    args = parser.parse_args(argv)
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix="zhiku_bench_agent_")
+
+    process = None
+    if args.mock_url:
+        mock_url = args.mock_url
+    else:
+        process, mock_url = start_mock(args)
+
+    # 配置在导入 tools 时读取，必须先设置环境变量
+    os.environ.update({
+        "ZHIKU_PERSIST_DIRECTORY": args.work_dir,
+        "ZHIKU_EMBEDDING_CACHE_PATH": os.path.join(args.work_dir, "embeddings.sqlite3"),
+        "ZHIKU_LLM_PROVIDER": "mock",
+        "ZHIKU_MOCK_LLM_URL": mock_url,
+        "ZHIKU_SEARCH_PROVIDER": "local",
+        "ZHIKU_SEARCH_LATENCY_MS": str(args.search_latency_ms),
+        "ZHIKU_ANSWER_CACHE": "1" if args.answer_cache else "0",
+        "ZHIKU_TRACE_RECENT_SPANS": "1000000",
+        # 请求的 model 是脚本名时模拟服务使用该脚本
+        "DEEPSEEK_MODEL": args.scenario,
+    })
+
+    import asyncio
+
+    try:
+        build_collection(args)
+        queries = generate_queries(max(args.sessions * args.questions, 1))
+        workers, results = asyncio.run(run_all(args, queries, mock_url))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "scenario": args.scenario,
+        "first_token_ms": args.first_token_ms,
+        "chunk_ms": args.chunk_ms,
+        "search_latency_ms": args.search_latency_ms,
+        "executor_workers": workers,
+        "questions_per_session": args.questions,
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
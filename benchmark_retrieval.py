@@ -0,0 +1,287 @@
+"""
+检索基准测试：测量导入吞吐量、查询延迟分位数以及相对精确检索的 recall@k
+
+默认使用合成的中文语料和轻量的哈希嵌入模型，在无 GPU、无网络的机器上也能运行：
+
+    python benchmark_retrieval.py --sizes 10000 100000 --queries 200 --output bench.json
+
+使用真实模型：
+
+    python benchmark_retrieval.py --embedding bge --sizes 10000
+
+比较不同的向量存储后端：
+
+    python benchmark_retrieval.py --backend faiss --index-type hnsw --sizes 100000 1000000
+
+比较压缩索引（int8 / 二值编码 + 全精度重排）与原始索引的内存占用和召回率：
+
+    python benchmark_retrieval.py --backend faiss --index-type sq8 binary hnsw --rescore 4
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import io
+import contextlib
+import importlib
+
+import numpy as np
+
+# 合成语料使用的词表
+TOPICS = [
+    "机器学习", "深度学习", "神经网络", "自然语言处理", "计算机视觉", "知识图谱", "向量数据库",
+    "推荐系统", "强化学习", "语音识别", "数据清洗", "特征工程", "模型压缩", "分布式训练",
+    "检索增强生成", "文本分类", "情感分析", "机器翻译", "目标检测", "图像分割",
+]
+VERBS = ["提升了", "依赖于", "优化了", "改进了", "结合了", "替代了", "加速了", "简化了"]
+OBJECTS = [
+    "训练效率", "推理速度", "召回率", "准确率", "内存占用", "部署成本", "数据质量",
+    "模型泛化能力", "系统吞吐量", "查询延迟",
+]
+PRODUCTS = ["API网关", "调度服务", "索引构建器", "缓存层", "日志平台", "监控系统"]
+
+
+def generate_corpus(size, seed=42):
+    """
+    生成 size 个合成中文片段，返回 (ids, texts, metadatas)
+    """
+    rng = random.Random(seed)
+    ids, texts, metadatas = [], [], []
+    for i in range(size):
+        topic = rng.choice(TOPICS)
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            sentences.append(
+                f"{rng.choice(TOPICS)}{rng.choice(VERBS)}{rng.choice(PRODUCTS)}的{rng.choice(OBJECTS)}。"
+            )
+        code = f"E{rng.randint(1000, 9999)}"
+        texts.append(f"{topic}：" + "".join(sentences) + f"相关错误码 {code}。")
+        ids.append(f"bench-{i}")
+        metadatas.append({"source_file": f"bench_{i // 100}.txt", "topic": topic})
+    return ids, texts, metadatas
+
+
+def generate_queries(count, seed=7):
+    """生成 count 个查询"""
+    rng = random.Random(seed)
+    return [
+        f"{rng.choice(TOPICS)}如何{rng.choice(VERBS)}{rng.choice(OBJECTS)}"
+        for _ in range(count)
+    ]
+
+
+def load_embeddings(name, dim):
+    """
+    加载嵌入模型：fake（哈希嵌入）、bge（注册表中的默认模型）或 module:Class
+    """
+    if name == "fake":
+        from tools.fake_embeddings import HashingEmbeddings
+        return HashingEmbeddings(dim=dim)
+    if name == "bge":
+        from tools.registry import get_embeddings
+        return get_embeddings()
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def percentiles(samples_ms):
+    """计算延迟分位数（毫秒）"""
+    if not samples_ms:
+        return {}
+    values = np.asarray(samples_ms)
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+    }
+
+
+def exact_top_k(query_vectors, matrix, ids, k, block=16):
+    """
+    暴力计算每个查询 L2 距离最近的 k 个片段ID
+
+    ||q - x||² = ||q||² - 2q·x + ||x||²，排序时只需比较 q·x - ||x||²/2
+    """
+    half_norms = 0.5 * np.einsum("ij,ij->i", matrix, matrix)
+    results = []
+    for start in range(0, len(query_vectors), block):
+        scores = query_vectors[start:start + block] @ matrix.T - half_norms
+        top = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+        results.extend({ids[j] for j in row} for row in top)
+    return results
+
+
+def _batches(seq, size):
+    for i in range(0, len(seq), size):
+        yield i, seq[i:i + size]
+
+
+def bench_size(size, args, embeddings, queries, index_type=None):
+    """对一个语料规模运行完整的基准测试"""
+    from langchain_core.documents import Document
+    from tools.registry import invalidate
+    from tools.vector_store import create_store
+    from tools.query_db import query_vector_db, query_vector_db_batch
+    from tools import lexical_index, chunking
+
+    result = {"size": size, "index_type": index_type}
+    persist_directory = os.path.join(args.work_dir, f"bench_{size}_{index_type or args.backend}")
+    shutil.rmtree(persist_directory, ignore_errors=True)
+    collection_name = "bench"
+
+    ids, texts, metadatas = generate_corpus(size, seed=args.seed)
+
+    # 1. 分块吞吐量：把片段拼接成较长文档后用导入时的分块策略重新切分
+    documents = [Document(page_content="\n\n".join(texts[i:i + 20])) for i in range(0, len(texts), 20)]
+    started = time.perf_counter()
+    chunk_count = sum(len(chunking.chunk_page(doc, "paragraph", "bench.txt")) for doc in documents)
+    elapsed = time.perf_counter() - started
+    result["split"] = {"chunks": chunk_count, "seconds": elapsed, "chunks_per_s": chunk_count / elapsed if elapsed else None}
+
+    # 2. 嵌入吞吐量
+    started = time.perf_counter()
+    vectors = []
+    for _, batch in _batches(texts, args.batch_size):
+        vectors.extend(embeddings.embed_documents(batch))
+    elapsed = time.perf_counter() - started
+    result["embed"] = {"chunks": size, "seconds": elapsed, "chunks_per_s": size / elapsed if elapsed else None}
+    matrix = np.asarray(vectors, dtype=np.float32)
+
+    # 3. 写入吞吐量（使用预先计算的向量，只测量存储开销）
+    with contextlib.redirect_stdout(io.StringIO()):
+        store = create_store(collection_name, persist_directory, backend=args.backend,
+                             index_type=index_type, rescore=args.rescore)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for start, batch_ids in _batches(ids, args.batch_size):
+            end = start + len(batch_ids)
+            store.add(batch_ids, vectors[start:end], texts[start:end], metadatas[start:end])
+        # FAISS 的索引构建和落盘也计入写入时间
+        store.flush()
+    elapsed = time.perf_counter() - started
+    result["write"] = {"chunks": size, "seconds": elapsed, "chunks_per_s": size / elapsed if elapsed else None}
+    result["store"] = store.stats()
+
+    if set(args.modes) & {"lexical", "hybrid"}:
+        started = time.perf_counter()
+        for start, batch_ids in _batches(ids, args.batch_size):
+            end = start + len(batch_ids)
+            docs = [Document(page_content=t, metadata=m) for t, m in zip(texts[start:end], metadatas[start:end])]
+            lexical_index.add_documents(collection_name, batch_ids, docs, persist_directory)
+        elapsed = time.perf_counter() - started
+        result["lexical_write"] = {"chunks": size, "seconds": elapsed, "chunks_per_s": size / elapsed if elapsed else None}
+
+    # 4. 暴力精确检索的参考结果（与向量存储使用的 L2 距离保持一致）
+    query_vectors = np.asarray([embeddings.embed_query(q) for q in queries], dtype=np.float32)
+    exact_ids = exact_top_k(query_vectors, matrix, ids, args.k)
+
+    # 5. 查询延迟和 recall@k
+    result["query"] = {}
+    for mode in args.modes:
+        latencies = []
+        hits = 0
+        # query_vector_db 会打印加载信息，测量时屏蔽输出
+        with contextlib.redirect_stdout(io.StringIO()):
+            total_started = time.perf_counter()
+            for query, expected in zip(queries, exact_ids):
+                started = time.perf_counter()
+                docs = query_vector_db(query, collection_name, k=args.k, persist_directory=persist_directory,
+                                       mode=mode, use_cache=False)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found = {getattr(doc, "id", None) for doc in docs}
+                hits += len(found & expected)
+            total_elapsed = time.perf_counter() - total_started
+        result["query"][mode] = {
+            "queries": len(queries),
+            f"recall@{args.k}": hits / (len(queries) * args.k) if queries else None,
+            "qps": len(queries) / total_elapsed if total_elapsed else None,
+            **percentiles(latencies),
+        }
+
+        # 批量查询：每批的查询向量一次计算，向量检索批量执行
+        if args.query_batch > 1:
+            hits = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                for start, batch in _batches(queries, args.query_batch):
+                    results = query_vector_db_batch(batch, collection_name, k=args.k, persist_directory=persist_directory,
+                                                    mode=mode, use_cache=False)
+                    for docs, expected in zip(results, exact_ids[start:start + len(batch)]):
+                        hits += len({getattr(doc, "id", None) for doc in docs} & expected)
+                elapsed = time.perf_counter() - started
+            result.setdefault("query_batch", {})[mode] = {
+                "queries": len(queries),
+                "batch_size": args.query_batch,
+                f"recall@{args.k}": hits / (len(queries) * args.k) if queries else None,
+                "qps": len(queries) / elapsed if elapsed else None,
+            }
+
+    invalidate(persist_directory)
+    if not args.keep:
+        shutil.rmtree(persist_directory, ignore_errors=True)
+    return result
+
+
+def main(argv=None):
+    from tools.vector_store import INDEX_TYPES
+
+    parser = argparse.ArgumentParser(description="检索基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000], help="语料规模（片段数），如 10000 100000 1000000")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--k", type=int, default=3, help="recall@k 中的 k")
+    parser.add_argument("--query-batch", type=int, default=32, help="批量查询每批的查询数，1 表示不测批量查询")
+    parser.add_argument("--modes", nargs="+", default=["vector"], choices=["vector", "lexical", "hybrid"], help="要测试的检索模式")
+    parser.add_argument("--embedding", default="fake", help="fake、bge 或 module:Class")
+    parser.add_argument("--dim", type=int, default=256, help="哈希嵌入的维度")
+    parser.add_argument("--backend", default="chroma", choices=["chroma", "faiss"], help="向量存储后端")
+    parser.add_argument("--index-type", nargs="+", default=[None], choices=INDEX_TYPES,
+                        help="FAISS 索引类型，可以同时比较多个")
+    parser.add_argument("--rescore", type=int, default=None, help="压缩索引重排的候选倍数，0 关闭重排")
+    parser.add_argument("--batch-size", type=int, default=512, help="嵌入和写入的批大小")
+    parser.add_argument("--seed", type=int, default=42, help="语料随机种子")
+    parser.add_argument("--work-dir", default=None, help="临时数据库目录，默认使用系统临时目录")
+    parser.add_argument("--keep", action="store_true", help="保留测试数据库")
+    parser.add_argument("--output", default=None, help="结果 JSON 文件，默认输出到标准输出")
+    args = parser.parse_args(argv)
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix="zhiku_bench_")
+
+    from tools.registry import register_embeddings
+
+    embeddings = load_embeddings(args.embedding, args.dim)
+    register_embeddings(embeddings)
+    queries = generate_queries(args.queries)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "embedding": args.embedding,
+        "backend": args.backend,
+        "rescore": args.rescore,
+        "k": args.k,
+        "results": [],
+    }
+    for size in args.sizes:
+        for index_type in args.index_type:
+            print(f"正在测试规模 {size}（{index_type or args.backend}）...", file=sys.stderr)
+            report["results"].append(bench_size(size, args, embeddings, queries, index_type))
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+启动耗时测试：用 python -X importtime 测量各入口模块的导入耗时，并列出最耗时的依赖
+
+    python benchmark_startup.py
+    python benchmark_startup.py --modules tools.agent main_streamlit --top 15 --budget-ms 1000
+
+每个模块在独立的子进程中导入，互不影响；超过 --budget-ms 时返回非零退出码，可用于回归检查。
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+DEFAULT_MODULES = [
+    "tools.agent",
+    "tools.query_db",
+    "tools.ingestion",
+    "tools.jobs",
+    "tools.bulk_ingest",
+    "tools.vector_store",
+]
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def measure(module, python=sys.executable):
+    """
+    在子进程中导入模块，返回总耗时和每个被导入模块的耗时（微秒）
+    """
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    imports = []
+    for line in completed.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append({
+                "module": name,
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": len(indent) // 2,
+            })
+    # 缩进最浅的条目是直接由 import 语句触发的顶层导入，它们的累计耗时之和就是总导入耗时
+    top_level = [item for item in imports if item["depth"] == min((i["depth"] for i in imports), default=0)]
+    return {
+        "module": module,
+        "ok": completed.returncode == 0,
+        "error": completed.stderr.strip().splitlines()[-1] if completed.returncode else None,
+        "import_ms": sum(item["cumulative_us"] for item in top_level) / 1000,
+        "wall_ms": wall_ms,
+        "imports": imports,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="启动耗时测试（python -X importtime）")
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES, help="要测量的模块")
+    parser.add_argument("--top", type=int, default=10, help="列出累计耗时最高的前 N 个依赖")
+    parser.add_argument("--budget-ms", type=float, default=None, help="导入耗时上限（毫秒），超过时返回 1")
+    parser.add_argument("--output", default=None, help="结果 JSON 文件")
+    args = parser.parse_args(argv)
+
+    results = []
+    for module in args.modules:
+        result = measure(module)
+        results.append(result)
+        status = f"{result['import_ms']:.0f} ms（进程总耗时 {result['wall_ms']:.0f} ms）" if result["ok"] else f"导入失败: {result['error']}"
+        print(f"{module}: {status}")
+        heaviest = sorted(
+            (item for item in result["imports"] if item["module"] != module),
+            key=lambda item: item["cumulative_us"], reverse=True,
+        )[:args.top]
+        for item in heaviest:
+            print(f"    {item['cumulative_us'] / 1000:8.1f} ms  {item['module']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump([{k: v for k, v in r.items() if k != "imports"} for r in results], f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+    if args.budget_ms is not None:
+        over = [r["module"] for r in results if not r["ok"] or r["import_ms"] > args.budget_ms]
+        if over:
+            print(f"超过 {args.budget_ms:.0f} ms 的模块: {', '.join(over)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
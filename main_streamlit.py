@@ -1,11 +1,68 @@
 import streamlit as st
 import os
-from tools.ingestion import ingest_docs, delete_by_source_file
+import time
+from tools.ingestion import delete_by_source_file, rebuild_catalog
+from tools.jobs import get_job_queue
 from tools.query_db import query_vector_db, load_vector_db, list_collections
+from tools import manifest, tracing
 import tempfile
-from langchain_core.messages import HumanMessage
 
-from tools.agent import run_conversation
+from tools.agent import stream_conversation
+from tools.conversation import ConversationSession
+
+
+def load_file_catalog(collection_name):
+    """
+    从文件目录读取集合中的文件，不需要扫描全部片段；旧集合首次使用时从向量数据库重建一次
+    """
+    files = manifest.list_files(collection_name)
+    if not files:
+        store = load_vector_db(collection_name)
+        if store and store.count() > 0:
+            files = rebuild_catalog(collection_name)
+    return files
+
+
+JOB_STATUS_LABELS = {
+    "queued": "⏳ 排队中",
+    "running": "⚙️ 导入中",
+    "succeeded": "✅ 已完成",
+    "failed": "❌ 失败",
+    "cancelled": "🚫 已取消",
+}
+
+
+@st.fragment(run_every=2)
+def job_panel(collection_name):
+    """
+    每 2 秒刷新一次导入任务的进度，只重跑这个片段；有任务新完成时刷新整个页面的文档列表
+    """
+    jobs = get_job_queue().list(collection_name, limit=10)
+    if not jobs:
+        return
+    st.subheader("📥 导入任务")
+    finished = {job["id"] for job in jobs if job["status"] == "succeeded"}
+    # 首次渲染时已经完成的任务不触发刷新
+    newly_finished = finished - st.session_state.setdefault("finished_jobs", finished)
+    st.session_state.finished_jobs |= finished
+
+    for job in jobs:
+        st.markdown(f"**{job['source_file']}** {JOB_STATUS_LABELS.get(job['status'], job['status'])}")
+        if job["status"] in ("queued", "running"):
+            st.caption(
+                f"已解析 {job['pages_parsed']} 页 · {job['chunks_parsed']} 个片段，"
+                f"已嵌入 {job['chunks_embedded']}，已写入 {job['chunks_written']}，未变化 {job['chunks_unchanged']}"
+            )
+            if st.button("取消", key=f"cancel_{job['id']}"):
+                get_job_queue().cancel(job["id"])
+        elif job["status"] == "failed":
+            st.caption(f"错误: {job['error']}")
+        elif job["status"] == "succeeded":
+            st.caption(f"新增 {job['chunks_written']} 个片段，未变化 {job['chunks_unchanged']} 个")
+
+    if newly_finished:
+        st.session_state.refresh = True
+        st.rerun()
 
 
 # 设置页面标题和布局
@@ -18,11 +75,11 @@ with st.sidebar:
     st.header("📁 文档管理")
     
     # 文件上传器 - 添加中文提示
-    uploaded_file = st.file_uploader(
+    uploaded_files = st.file_uploader(
         "上传文档", 
         type=["pdf", "txt", "docx", "md"],
-        help="支持的格式: PDF, TXT, DOCX, MD",
-        accept_multiple_files=False  # 只接受单个文件
+        help="支持的格式: PDF, TXT, DOCX, MD，可一次选择多个文件",
+        accept_multiple_files=True
     )
     
     # 选择或输入集合名称
@@ -43,30 +100,35 @@ with st.sidebar:
     if st.session_state.get('last_collection') != collection_name:
         st.session_state.last_collection = collection_name
         st.session_state.refresh = True
+        # 换了知识库就开始新的对话
+        st.session_state.conversation = ConversationSession()
+        st.session_state.chat_history = []
     
     # 处理上传的文件
-    if uploaded_file is not None:
-        # 保存上传的文件到临时位置，但保留原始文件名
-        print(f"上传的文件名: {uploaded_file.name}")
-        original_filename = uploaded_file.name  # 保留原始文件名
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(original_filename)[1]) as tmp_file:
-            tmp_file.write(uploaded_file.read())
-            temp_path = tmp_file.name
-        
-        # 处理文档并添加到知识库
+    if uploaded_files:
+        # 提交后台导入任务，界面不会被长时间的导入阻塞
         if st.button("📤 添加到知识库", use_container_width=True):
+            # 只在点击按钮时保存上传的文件到临时位置（每次重新运行脚本都写入会留下大量临时文件），保留原始文件名
+            original_filenames = [f.name for f in uploaded_files]  # 保留原始文件名
+            print(f"上传的文件名: {original_filenames}")
+            temp_paths = []
             try:
-                with st.spinner(f"正在处理文档 {original_filename}..."):
-                    vectorstore = ingest_docs(temp_path, collection_name, original_filename)
-                st.success(f"✅ 文档 {original_filename} 已成功添加到知识库!")
-                
-                # 显示一些统计信息
-                st.info(f"文档已添加到集合 '{collection_name}'")
+                for uploaded_file in uploaded_files:
+                    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
+                        temp_paths.append(tmp_file.name)
+                        tmp_file.write(uploaded_file.getvalue())
+                queue = get_job_queue()
+                for temp_path, filename in zip(temp_paths, original_filenames):
+                    queue.submit(temp_path, collection_name, filename)
+                st.success(f"✅ 已提交 {len(temp_paths)} 个导入任务，可在下方查看进度")
             except Exception as e:
-                st.error(f"❌ 处理文档时出错: {str(e)}")
+                st.error(f"❌ 提交导入任务时出错: {str(e)}")
             finally:
-                # 清理临时文件
-                os.unlink(temp_path)
+                # 任务队列已复制文件，清理临时文件
+                for temp_path in temp_paths:
+                    os.unlink(temp_path)
+
+    job_panel(collection_name)
     
     st.markdown("---")
     
@@ -82,19 +144,10 @@ with st.sidebar:
     if st.button("🔄 刷新文档列表", use_container_width=True):
         st.session_state.refresh = True
 
-    # 如果需要刷新或首次加载，就从向量数据库获取文件名列表
+    # 如果需要刷新或首次加载，就从文件目录获取文件名列表
     if st.session_state.refresh:
         try:
-            vectorstore = load_vector_db(collection_name)
-            if vectorstore:
-                all_docs = vectorstore.get()
-                unique_sources = sorted({
-                    m.get('source_file')
-                    for m in all_docs.get('metadatas', [])
-                    if m.get('source_file')
-                })
-            else:
-                unique_sources = []
+            unique_sources = [f["source_file"] for f in load_file_catalog(collection_name)]
         except Exception:
             unique_sources = []
 
@@ -122,23 +175,93 @@ with st.sidebar:
 # 主界面 - 问答功能
 st.header("💬 与知识库对话")
 
+# 对话会话在 Streamlit 重新运行之间保持，追问时模型能看到之前的问答和检索结果
+if 'conversation' not in st.session_state:
+    st.session_state.conversation = ConversationSession()
+    st.session_state.chat_history = []
+conversation = st.session_state.conversation
+
+if st.session_state.chat_history:
+    with st.expander(f"🗨️ 对话历史（{len(st.session_state.chat_history)} 个问题）", expanded=False):
+        for past_question, past_answer in st.session_state.chat_history:
+            st.markdown(f"**问：** {past_question}")
+            st.markdown(past_answer)
+    session_stats = conversation.stats()
+    st.caption(
+        f"上下文约 {session_stats['context_tokens']} tokens，累计用量 "
+        f"{session_stats['prompt_tokens'] + session_stats['completion_tokens']} tokens，"
+        f"复用工具结果 {session_stats['memo_hits']} 次"
+    )
+    if st.button("🧹 开始新对话"):
+        conversation.reset()
+        st.session_state.chat_history = []
+        st.rerun()
+
 # 问题输入
 question = st.text_input("输入您的问题:", placeholder="在这里输入您想问的问题...")
+show_timing = st.checkbox("⏱️ 显示各阶段耗时", value=False, help="回答完成后列出检索、嵌入、模型调用和工具调用的耗时")
 
 # 查询按钮
 if st.button("🔍 查询", use_container_width=True):
     if question:
-        with st.spinner("正在查询知识库..."):
-            try:
-                # 使用现有函数查询知识库
-                agent_question = f"根据在{collection_name}知识库中查询到的信息，回答以下问题：{question}"
-                response = run_conversation(agent_question)
-                # 显示答案
-                st.subheader("🤖 回答:")
-                st.write(response)
-            except Exception as e:
-                st.error(f"❌ 查询时出错: {str(e)}")
-                st.info("请确保您已经安装了必要的依赖并正确实现了查询功能")
+        try:
+            # 使用现有函数查询知识库
+            agent_question = f"根据在{collection_name}知识库中查询到的信息，回答以下问题：{question}"
+            st.subheader("🤖 回答:")
+            reasoning_expander = st.expander("🧠 推理过程", expanded=False)
+            reasoning_placeholder = reasoning_expander.empty()
+            tool_status = st.container()
+            finished = {}
+
+            def answer_stream():
+                """把事件流中的回答增量交给 st.write_stream，其余事件就地渲染"""
+                reasoning = ""
+                for event in stream_conversation(agent_question, collection_name=collection_name, question=question,
+                                                 session=conversation):
+                    if event["type"] == "cached":
+                        tool_status.info(f"⚡ 命中答案缓存（相似度 {event['similarity']:.3f}，原问题：{event['question']}）")
+                    elif event["type"] == "reasoning":
+                        reasoning += event["delta"]
+                        reasoning_placeholder.markdown(reasoning)
+                    elif event["type"] == "tool_start":
+                        tool_status.info(f"🔧 正在调用工具 {event['name']}: {event['arguments']}")
+                    elif event["type"] == "tool_end":
+                        if event.get("memoized"):
+                            tool_status.success(f"♻️ 工具 {event['name']} 复用了本次对话中之前的结果")
+                        else:
+                            tool_status.success(f"✅ 工具 {event['name']} 已完成（{event['elapsed']:.1f} 秒）")
+                    elif event["type"] == "answer":
+                        yield event["delta"]
+                    elif event["type"] == "done":
+                        finished["trace_id"] = event.get("trace_id")
+                        st.session_state.chat_history.append((question, event["content"]))
+                        if event.get("stopped"):
+                            tool_status.warning("⚠️ 已达到本问题的轮数或 token 上限，回答可能不完整")
+
+            # 显示答案（逐字输出）
+            st.write_stream(answer_stream())
+
+            if show_timing and finished.get("trace_id"):
+                spans = tracing.trace_spans(finished["trace_id"])
+                if spans:
+                    started = spans[0]["start"]
+                    with st.expander("⏱️ 本次请求耗时", expanded=True):
+                        st.dataframe(
+                            [
+                                {
+                                    "阶段": span["name"],
+                                    "开始 (ms)": round((span["start"] - started) * 1000, 1),
+                                    "耗时 (ms)": round(span["duration"] * 1000, 1),
+                                    "属性": ", ".join(f"{k}={v}" for k, v in span["attrs"].items()),
+                                    "错误": span["error"] or "",
+                                }
+                                for span in spans
+                            ],
+                            use_container_width=True,
+                        )
+        except Exception as e:
+            st.error(f"❌ 查询时出错: {str(e)}")
+            st.info("请确保您已经安装了必要的依赖并正确实现了查询功能")
     else:
         st.warning("请输入一个问题")
 
@@ -149,23 +272,30 @@ st.header("📊 知识库状态")
 if st.button("📈 获取知识库统计信息", use_container_width=True):
     # 从向量数据库获取统计信息
     try:
-        vectorstore = load_vector_db(collection_name)
+        store = load_vector_db(collection_name)
         
-        if vectorstore:
-            doc_count = vectorstore._collection.count()
-            
-            st.success(f"📁 集合 '{collection_name}' 包含 {doc_count} 个文档片段")
+        if store:
+            doc_count = store.count()
             
-            # 尝试获取唯一源文件列表
-            all_docs = vectorstore.get()
-            unique_sources = set()
+            st.success(f"📁 集合 '{collection_name}' 包含 {doc_count} 个文档片段（{store.backend} 后端）")
             
-            for doc in all_docs['metadatas']:
-                if 'source_file' in doc:
-                    unique_sources.add(doc['source_file'])
+            # 从文件目录获取文件列表
+            files = load_file_catalog(collection_name)
             
-            if unique_sources:
-                st.info(f"📚 知识库中包含以下文件: {', '.join(list(unique_sources))}")
+            if files:
+                st.info(f"📚 知识库中包含 {len(files)} 个文件")
+                st.dataframe(
+                    [
+                        {
+                            "文件": f["source_file"],
+                            "片段数": f["chunk_count"],
+                            "大小 (KB)": round(f["bytes"] / 1024, 1) if f["bytes"] is not None else None,
+                            "导入时间": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(f["ingested_at"])) if f["ingested_at"] else None,
+                        }
+                        for f in files
+                    ],
+                    use_container_width=True,
+                )
             else:
                 st.info("💡 知识库中暂无文档文件信息")
         else:
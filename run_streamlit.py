@@ -1,4 +1,3 @@
-import streamlit as st
 from pathlib import Path
 import subprocess
 import sys
@@ -9,7 +8,8 @@ def run_streamlit_app():
     app_path = Path(__file__).parent / "main_streamlit.py"
     
     if not app_path.exists():
-        st.error(f"找不到应用文件: {app_path}")
+        # 启动器本身不导入 streamlit，应用在子进程中运行
+        print(f"找不到应用文件: {app_path}")
         return
     
     # 使用subprocess运行streamlit应用
@@ -76,9 +76,9 @@ def check_persistence():
     from tools.query_db import load_vector_db
     
     print("\n💾 检查数据库持久化...")
-    vectorstore = load_vector_db()
-    if vectorstore:
-        count = vectorstore._collection.count()
+    store = load_vector_db()
+    if store:
+        count = store.count()
         print(f"数据库中现有 {count} 个文档片段")
         if count > 0:
             print("✅ 数据库持久化工作正常")
@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 配置在导入 tools 时读取，必须在导入之前设置：测试使用 FAISS 后端和近似的 token 计数，不加载真实模型
+os.environ["ZHIKU_VECTOR_BACKEND"] = "faiss"
+os.environ["ZHIKU_CHUNK_TOKENIZER"] = "approx"
+os.environ["ZHIKU_PERSIST_DIRECTORY"] = tempfile.mkdtemp(prefix="zhiku_test_")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.fake_embeddings import HashingEmbeddings  # noqa: E402
+from tools.registry import register_embeddings  # noqa: E402
+
+
+class CountingEmbeddings(HashingEmbeddings):
+    """记录送入模型的文本数的哈希嵌入模型"""
+
+    def __init__(self):
+        super().__init__(dim=64)
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+@pytest.fixture
+def embeddings():
+    model = CountingEmbeddings()
+    register_embeddings(model)
+    return model
+
+
+@pytest.fixture
+def persist_dir(tmp_path):
+    return str(tmp_path / "db")
+
+
+@pytest.fixture
+def write_file(tmp_path):
+    def write(relative_path, text):
+        path = tmp_path / "files" / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+        return str(path)
+    return write
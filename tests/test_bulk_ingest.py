@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from tools.bulk_ingest import bulk_ingest
+from tools.ingestion import delete_by_source_file
+from tools.registry import get_store
+
+
+def test_bulk_ingest_keeps_files_with_same_basename_apart(embeddings, persist_dir, write_file):
+    first = write_file("docs/a/README.txt", "第一个目录中的说明文件。")
+    write_file("docs/b/README.txt", "第二个目录中的说明文件，内容不同。")
+    docs_dir = os.path.dirname(os.path.dirname(first))
+
+    results = bulk_ingest([docs_dir], "kb", persist_dir, use_processes=False, progress_callback=None)
+    assert {name: r["status"] for name, r in results.items()} == {"a/README.txt": "ok", "b/README.txt": "ok"}
+    store = get_store("kb", persist_dir)
+    assert store.source_files() == {"a/README.txt", "b/README.txt"}
+    ids = store.get_ids()
+
+    # 再次导入时两个文件互不影响：没有新增，也没有把对方的片段当作过期片段删除
+    results = bulk_ingest([docs_dir], "kb", persist_dir, use_processes=False, progress_callback=None)
+    assert all(r["status"] == "ok" and r["added"] == 0 and r["deleted"] == 0 for r in results.values())
+    assert store.get_ids() == ids
+
+    assert delete_by_source_file("a/README.txt", "kb", persist_dir) > 0
+    assert store.source_files() == {"b/README.txt"}
+
+
+def test_bulk_ingest_rejects_duplicate_source_names(embeddings, persist_dir, write_file):
+    paths = [write_file("a/README.txt", "甲。"), write_file("b/README.txt", "乙。")]
+    with pytest.raises(ValueError):
+        bulk_ingest(paths, "kb", persist_dir, use_processes=False, progress_callback=None)
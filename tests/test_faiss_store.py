@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+
+from tools import vector_store  # noqa: E402
+from tools.vector_store import FaissStore  # noqa: E402
+
+
+def _fill(store, n=200, dim=16):
+    vectors = np.random.default_rng(0).standard_normal((n, dim)).astype("float32")
+    ids = [f"c{i}" for i in range(n)]
+    store.add(ids, vectors, [f"片段 {i}" for i in ids], [{"source_file": "a.txt"} for _ in ids])
+    return ids, vectors
+
+
+def _assert_searchable(store, ids, vectors, kept):
+    for i in kept[:20]:
+        doc, _ = store.search(vectors[i].tolist(), k=1)[0]
+        assert doc.id == ids[i]
+        assert doc.page_content == f"片段 {ids[i]}"
+
+
+def test_compact_round_trip(tmp_path):
+    store = FaissStore("kb", str(tmp_path))
+    ids, vectors = _fill(store)
+    store.delete(ids[::2])
+    kept = list(range(1, len(ids), 2))
+
+    store.compact()
+    assert store.count() == len(kept)
+    assert store.stats()["rows"] == len(kept)
+    _assert_searchable(store, ids, vectors, kept)
+    store.close()
+
+    reopened = FaissStore("kb", str(tmp_path))
+    assert reopened.get_ids() == [ids[i] for i in kept]
+    _assert_searchable(reopened, ids, vectors, kept)
+    reopened.close()
+
+
+def test_interrupted_compaction_is_finished_on_open(tmp_path, monkeypatch):
+    store = FaissStore("kb", str(tmp_path))
+    ids, vectors = _fill(store)
+    store.delete(ids[:150])
+    store.flush()
+
+    replace = os.replace
+
+    def crash(src, dst):
+        if src.endswith(vector_store.VECTORS_FILENAME + ".tmp"):
+            raise KeyboardInterrupt
+        return replace(src, dst)
+
+    # 行号已经重新编号、vectors.f32 尚未替换时中断
+    monkeypatch.setattr(vector_store.os, "replace", crash)
+    with pytest.raises(KeyboardInterrupt):
+        store.compact()
+    monkeypatch.undo()
+    store.close()
+
+    reopened = FaissStore("kb", str(tmp_path))
+    assert reopened.count() == 50
+    assert reopened.stats()["rows"] == 50
+    _assert_searchable(reopened, ids, vectors, list(range(150, 200)))
+    reopened.close()
+
+
+def test_opening_does_not_claim_collection(tmp_path):
+    FaissStore("kb", str(tmp_path)).close()
+    assert vector_store.list_collections(str(tmp_path)) == []
+
+
+def test_get_ids_with_filter_handles_large_source_files(tmp_path):
+    store = FaissStore("kb", str(tmp_path))
+    n = 40000
+    vectors = np.zeros((n, 4), dtype="float32")
+    ids = [f"c{i}" for i in range(n)]
+    store.add(ids, vectors, ids, [{"source_file": "big.txt"} for _ in ids])
+    store.add(["other"], np.ones((1, 4), dtype="float32"), ["other"], [{"source_file": "small.txt"}])
+
+    assert store.get_ids(where={"source_file": "big.txt"}) == ids
+    assert store.get_ids(where={"source_file": "small.txt"}) == ["other"]
+    store.close()
@@ -0,0 +1,40 @@
+from tools.ingestion import ingest_docs
+from tools.registry import get_store
+
+TEXT = (
+    "向量数据库把文档片段的向量保存在本地磁盘。\n\n"
+    "重新导入没有变化的文件时，已经写入的片段不会再次计算向量。\n\n"
+    "关键词检索使用 BM25 为片段打分。"
+)
+
+
+def test_reingest_unchanged_file_embeds_and_deletes_nothing(embeddings, persist_dir, write_file):
+    path = write_file("手册.txt", TEXT)
+    ingest_docs(path, "kb", persist_directory=persist_dir)
+    store = get_store("kb", persist_dir)
+    ids = store.get_ids()
+    assert ids
+
+    embeddings.embedded = 0
+    progress = []
+    ingest_docs(path, "kb", persist_directory=persist_dir, progress_callback=progress.append)
+
+    assert embeddings.embedded == 0
+    assert progress[-1]["chunks_written"] == 0
+    assert progress[-1]["chunks_unchanged"] == len(ids)
+    assert store.get_ids() == ids
+
+
+def test_reingest_changed_file_replaces_only_changed_chunks(embeddings, persist_dir, write_file):
+    path = write_file("手册.txt", TEXT)
+    ingest_docs(path, "kb", persist_directory=persist_dir, batch_size=1)
+    store = get_store("kb", persist_dir)
+    before = set(store.get_ids())
+
+    write_file("手册.txt", TEXT.replace("BM25", "TF-IDF"))
+    embeddings.embedded = 0
+    ingest_docs(path, "kb", persist_directory=persist_dir, batch_size=1)
+
+    after = set(store.get_ids())
+    assert embeddings.embedded == len(after - before)
+    assert len(after) == len(before)
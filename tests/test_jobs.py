@@ -0,0 +1,40 @@
+import time
+
+from tools import jobs
+from tools.jobs import JobQueue
+from tools.registry import get_store
+
+TEXT = "第一段：任务队列在后台线程中导入文件。\n\n第二段：进度按间隔写入数据库。\n\n第三段：结束时记录最终状态。"
+
+
+def _wait_finished(queue, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in jobs.FINISHED_STATUSES:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"任务 {job_id} 没有在 {timeout} 秒内结束")
+
+
+def test_finished_job_records_final_progress_despite_throttling(embeddings, persist_dir, write_file, monkeypatch):
+    # 节流间隔足够长时，运行期间的进度都不会写入，只能依靠结束时的补写
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 3600)
+    queue = JobQueue(persist_dir, workers=1).start()
+    try:
+        job = _wait_finished(queue, queue.submit(write_file("任务.txt", TEXT), "kb"))
+    finally:
+        queue.shutdown()
+
+    assert job["status"] == "succeeded"
+    assert job["chunks_written"] == len(get_store("kb", persist_dir).get_ids()) > 0
+
+
+def test_cli_list_without_collection_shows_every_collection(persist_dir, write_file, capsys):
+    queue = JobQueue(persist_dir, workers=1)
+    ids = [queue.submit(write_file("a.txt", TEXT), "kb"), queue.submit(write_file("b.txt", TEXT), "other")]
+
+    jobs.main(["list", "--persist-directory", persist_dir])
+
+    output = capsys.readouterr().out
+    assert all(job_id in output for job_id in ids)
@@ -0,0 +1,31 @@
+import pytest
+
+from tools.micro_batch import MicroBatchingEmbeddings
+
+
+class _ShortModel:
+    """每批少返回一个向量的嵌入模型"""
+
+    def embed_documents(self, texts):
+        return [[1.0, 0.0] for _ in texts[1:]]
+
+
+class _Model:
+    def embed_documents(self, texts):
+        return [[float(len(text)), 0.0] for text in texts]
+
+
+def test_mismatched_vector_count_fails_callers_instead_of_hanging():
+    batcher = MicroBatchingEmbeddings(_ShortModel(), window_ms=20, max_batch_size=8)
+    with pytest.raises(RuntimeError):
+        batcher.embed_queries(["一", "二", "三"])
+
+
+def test_batcher_keeps_running_after_a_failed_batch():
+    model = _Model()
+    batcher = MicroBatchingEmbeddings(model, window_ms=1, max_batch_size=8)
+    model.embed_documents = lambda texts: (_ for _ in ()).throw(KeyboardInterrupt())
+    with pytest.raises(KeyboardInterrupt):
+        batcher.embed_query("失败")
+    model.embed_documents = _Model().embed_documents
+    assert batcher.embed_query("正常") == [2.0, 0.0]
@@ -0,0 +1,39 @@
+from tools.ingestion import ingest_docs, delete_by_source_file
+from tools.query_db import query_vector_db, query_cache_stats
+
+QUERY = "向量数据库 检索"
+
+
+def _search(persist_dir):
+    before = query_cache_stats()["hits"]
+    docs = query_vector_db(QUERY, "kb", k=5, persist_directory=persist_dir)
+    return docs, query_cache_stats()["hits"] > before
+
+
+def test_query_cache_misses_after_ingest_and_delete(embeddings, persist_dir, write_file):
+    ingest_docs(write_file("a.txt", "向量数据库保存嵌入向量。"), "kb", persist_directory=persist_dir)
+    docs, hit = _search(persist_dir)
+    assert not hit
+    assert {d.metadata["source_file"] for d in docs} == {"a.txt"}
+    _, hit = _search(persist_dir)
+    assert hit
+
+    # 导入新文件后集合版本变化，旧的缓存结果不再命中
+    ingest_docs(write_file("b.txt", "检索时先计算查询的向量。"), "kb", persist_directory=persist_dir)
+    docs, hit = _search(persist_dir)
+    assert not hit
+    assert {d.metadata["source_file"] for d in docs} == {"a.txt", "b.txt"}
+
+    delete_by_source_file("b.txt", "kb", persist_directory=persist_dir)
+    docs, hit = _search(persist_dir)
+    assert not hit
+    assert {d.metadata["source_file"] for d in docs} == {"a.txt"}
+
+
+def test_cached_results_are_not_shared_with_callers(embeddings, persist_dir, write_file):
+    ingest_docs(write_file("a.txt", "向量数据库保存嵌入向量。"), "kb", persist_directory=persist_dir)
+    docs = query_vector_db(QUERY, "kb", k=5, persist_directory=persist_dir)
+    docs[0].metadata["source_file"] = "changed"
+
+    cached = query_vector_db(QUERY, "kb", k=5, persist_directory=persist_dir)
+    assert cached[0].metadata["source_file"] == "a.txt"
@@ -1,34 +1,171 @@
 import os
 import json
+import time
+import asyncio
+import threading
+import contextvars
+from types import SimpleNamespace
 from dotenv import load_dotenv
-from openai import OpenAI
-from langchain_tavily import TavilySearch
-from tools.query_db import query_vector_db  # 你的自定义模块
+from tools import settings, tracing, answer_cache, context_builder, chunking
+from tools.conversation import ConversationSession
+from tools.query_db import query_vector_db, query_vector_db_batch  # 你的自定义模块
 
 load_dotenv()
 
-# 初始化 DeepSeek 客户端
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com/v1"
-)
+# 模型服务地址可通过环境变量指向任何 OpenAI 兼容的服务（例如本地测试服务）
+DEEPSEEK_BASE_URL = settings.get("agent.base_url")
+DEEPSEEK_MODEL = settings.get("agent.model")
 
-# 定义工具（复用你现有的函数）
-from langchain_core.tools import tool
+# 模型和网络搜索的提供方：LLM_PROVIDER=mock 时使用本地模拟服务（tools/mock_llm.py），
+# SEARCH_PROVIDER=local 时使用本地语料的模拟搜索（tools/local_search.py），无需网络和 API Key
+LLM_PROVIDER = settings.get("agent.provider")
+SEARCH_PROVIDER = settings.get("search.provider")
 
-@tool
-def search_with_db(query: str, collection_name: str) -> str:
-    """进行数据库查询"""
-    docs = query_vector_db(query, collection_name)
-    return "\n".join([f"{doc.page_content}\n" for doc in docs])
+# DeepSeek 客户端和 Tavily 搜索工具在首次使用时才创建，导入本模块不会加载 openai 和 tavily
+_clients_lock = threading.Lock()
+_client = None
+_async_client = None
+_tavily_tool = None
+
+
+def _client_options():
+    if LLM_PROVIDER == "mock":
+        return {"api_key": "mock", "base_url": settings.get("agent.mock_url")}
+    if LLM_PROVIDER != "deepseek":
+        raise ValueError(f"未知的模型提供方: {LLM_PROVIDER}（可选 deepseek、mock）")
+    return {"api_key": os.getenv("DEEPSEEK_API_KEY"), "base_url": DEEPSEEK_BASE_URL}
+
+
+def get_client():
+    """获取共享的同步 DeepSeek 客户端"""
+    global _client
+    if _client is None:
+        with _clients_lock:
+            if _client is None:
+                from openai import OpenAI
+                _client = OpenAI(**_client_options())
+    return _client
+
+
+def get_async_client():
+    """获取共享的异步 DeepSeek 客户端"""
+    global _async_client
+    if _async_client is None:
+        with _clients_lock:
+            if _async_client is None:
+                from openai import AsyncOpenAI
+                _async_client = AsyncOpenAI(**_client_options())
+    return _async_client
+
+
+def get_tavily_tool():
+    """获取共享的网络搜索工具（Tavily，或 SEARCH_PROVIDER=local 时的本地模拟搜索）"""
+    global _tavily_tool
+    if _tavily_tool is None:
+        with _clients_lock:
+            if _tavily_tool is None:
+                if SEARCH_PROVIDER == "local":
+                    from tools.local_search import LocalSearch
+                    _tavily_tool = LocalSearch()
+                elif SEARCH_PROVIDER == "tavily":
+                    from langchain_tavily import TavilySearch
+                    _tavily_tool = TavilySearch()
+                else:
+                    raise ValueError(f"未知的搜索提供方: {SEARCH_PROVIDER}（可选 tavily、local）")
+    return _tavily_tool
+
+
+def __getattr__(name):
+    # 兼容直接访问模块属性 client / async_client / tavily_tool 的旧代码
+    getters = {"client": get_client, "async_client": get_async_client, "tavily_tool": get_tavily_tool}
+    if name in getters:
+        return getters[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# 单个工具调用的超时时间（秒）
+DEFAULT_TOOL_TIMEOUT = settings.get("agent.tool_timeout")
+TOOL_TIMEOUTS = {
+    "search_with_db": settings.get("agent.db_tool_timeout"),
+    "tavily_search": DEFAULT_TOOL_TIMEOUT,
+}
+
+# 知识库检索是否使用交叉编码器重排（需要本地的重排模型，见 tools/rerank.py）
+RERANK_ENABLED = settings.get("rerank.enabled")
+
+# 本次问答中装入上下文的片段ID，答案写入语义缓存时记录为引用的片段
+_cited_chunks = contextvars.ContextVar("cited_chunks", default=None)
+
+# 每次检索取回的候选数，去重和 MMR 之后按 token 预算装入上下文（见 tools.context_builder）
+CONTEXT_FETCH_K = settings.get("context.fetch_k")
+
+def _query_list(query, queries):
+    # 模型可以只传 query，也可以用 queries 一次传入多个子问题
+    texts = ([query] if query else []) + [q for q in (queries or []) if q]
+    if not texts:
+        raise ValueError("query 和 queries 不能都为空")
+    return list(dict.fromkeys(texts))
+
+def _search_context(collection_name, texts):
+    """
+    检索并组装上下文，返回 (上下文文本, 装入上下文的片段ID)
+
+    多个子问题一次批量检索，平分 token 预算，引用编号连续，已经装入的片段不再重复
+    """
+    if len(texts) == 1:
+        results = [query_vector_db(texts[0], collection_name, k=CONTEXT_FETCH_K, rerank=RERANK_ENABLED)]
+    else:
+        results = query_vector_db_batch(texts, collection_name, k=CONTEXT_FETCH_K, rerank=RERANK_ENABLED)
+    budget = context_builder.CONTEXT_TOKENS // len(texts)
+    sections, chunk_ids, index = [], set(), 1
+    with tracing.span("context.build", queries=len(texts)) as s:
+        for text, docs in zip(texts, results):
+            context, blocks = context_builder.build_context(
+                text, docs, budget, start_index=index, exclude_ids=chunk_ids
+            )
+            index += len(blocks)
+            for block in blocks:
+                chunk_ids.update(block["chunk_ids"])
+            if len(texts) == 1:
+                sections.append(context or "（知识库中没有找到相关内容）")
+            else:
+                sections.append(f"【查询：{text}】\n{context or '（没有新的结果）'}")
+        s.set(items=len(chunk_ids), blocks=index - 1)
+    return "\n\n".join(sections), chunk_ids
+
+def _cite(chunk_ids):
+    cited = _cited_chunks.get()
+    if cited is not None:
+        cited.update(chunk_ids)
+
+def search_with_db(query: str = None, collection_name: str = "knowledge_base", queries: list = None) -> str:
+    """进行数据库查询，多个子问题一次批量检索"""
+    context, chunk_ids = _search_context(collection_name, _query_list(query, queries))
+    _cite(chunk_ids)
+    return context
+
+async def asearch_with_db(query: str = None, collection_name: str = "knowledge_base", queries: list = None) -> str:
+    """search_with_db 的异步版本，检索和上下文组装在线程中执行"""
+    context, chunk_ids = await asyncio.to_thread(_search_context, collection_name, _query_list(query, queries))
+    _cite(chunk_ids)
+    return context
 
 # 包装 TavilySearch 为一个可调用函数
-tavily_tool = TavilySearch()
+def tavily_search(**kwargs):
+    return get_tavily_tool().invoke(kwargs)
+
+async def atavily_search(**kwargs):
+    return await get_tavily_tool().ainvoke(kwargs)
 
 # 将工具映射为函数名 -> 可调用对象
 TOOL_MAP = {
-    "search_with_db": search_with_db.func,
-    "tavily_search": tavily_tool.run,
+    "search_with_db": search_with_db,
+    "tavily_search": tavily_search,
+}
+
+# 异步版本的工具映射，供 run_conversation_async 并发调用
+ASYNC_TOOL_MAP = {
+    "search_with_db": asearch_with_db,
+    "tavily_search": atavily_search,
 }
 
 # 定义 tools 的 OpenAI 格式（供 API 使用）
@@ -37,14 +174,19 @@ tools = [
         "type": "function",
         "function": {
             "name": "search_with_db",
-            "description": "在个人知识库数据库中查询信息",
+            "description": "在个人知识库数据库中查询信息，结果的每一段以 [编号] 和来源开头，回答时可按编号标注出处；需要查多个子问题时把它们一起放在 queries 中，一次调用批量检索",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "query": {"type": "string", "description": "查询问题"},
+                    "queries": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "多个查询问题，与 query 二选一"
+                    },
                     "collection_name": {"type": "string", "description": "集合名称"}
                 },
-                "required": ["query", "collection_name"]
+                "required": ["collection_name"]
             }
         }
     },
@@ -64,26 +206,215 @@ tools = [
     }
 ]
 
-def run_conversation(user_query: str):
-    """执行一次完整的问答（可能包含多轮工具调用）"""
-    messages = [{"role": "user", "content": user_query}]
-    turn = 1
+async def _execute_tool_call(tool_call):
+    """执行单个工具调用，超时或出错时把错误信息作为工具结果返回"""
+    function_name = tool_call.function.name
+    if function_name not in ASYNC_TOOL_MAP:
+        return f"错误：未知工具 {function_name}"
+    timeout = TOOL_TIMEOUTS.get(function_name, DEFAULT_TOOL_TIMEOUT)
+    try:
+        function_args = json.loads(tool_call.function.arguments)
+        return await asyncio.wait_for(ASYNC_TOOL_MAP[function_name](**function_args), timeout)
+    except asyncio.TimeoutError:
+        return f"错误：工具 {function_name} 执行超时（{timeout} 秒）"
+    except Exception as e:
+        return f"错误：工具 {function_name} 执行失败: {e}"
 
-    while True:
-        # 调用 API，启用 thinking 模式
-        response = client.chat.completions.create(
-            model="deepseek-reasoner",
+async def _run_tool_call(tool_call, parent=None, cited=None, session=None):
+    """
+    执行工具调用并返回 (工具调用, 结果, 耗时, 记忆键, 是否来自记忆)；cited 收集知识库检索返回的片段ID
+
+    传入 session 时，会话中参数相同的调用直接使用记忆的结果
+    """
+    started = time.perf_counter()
+    key = session.memo_key(tool_call.function.name, tool_call.function.arguments) if session else None
+    with tracing.span(f"tool.{tool_call.function.name}", parent=parent) as s:
+        entry = session.recall(key) if session else None
+        if entry is not None:
+            result, chunk_ids = entry.result, entry.chunk_ids
+            s.set(memoized=True)
+        else:
+            # 每个工具调用运行在自己的任务中，这里设置的上下文变量只对本次调用可见
+            chunk_ids = set()
+            _cited_chunks.set(chunk_ids)
+            result = await _execute_tool_call(tool_call)
+            if str(result).startswith("错误："):
+                s.error = str(result)
+            elif session:
+                session.remember(key, result, chunk_ids)
+    if cited is not None:
+        cited.update(chunk_ids)
+    return tool_call, result, time.perf_counter() - started, key, entry is not None
+
+async def astream_conversation(user_query: str, collection_name=None, question=None, session=None):
+    """
+    以流的形式执行一次完整的问答，依次产出带类型的事件：
+
+    - {"type": "cached", "turn", "question", "similarity", "created_at"}: 命中答案缓存，之后只有 answer 和 done
+    - {"type": "reasoning", "turn", "delta"}: 推理过程的增量文本
+    - {"type": "answer", "turn", "delta"}: 回答的增量文本
+    - {"type": "tool_start", "turn", "id", "name", "arguments"}: 工具开始执行
+    - {"type": "tool_end", "turn", "id", "name", "result", "elapsed", "memoized"}: 工具执行完毕，memoized 表示使用了会话中记忆的结果
+    - {"type": "done", "turn", "content", "trace_id", "cached", "stopped"}: 最终答案；trace_id 可用于 tracing.trace_spans()
+      查看各阶段耗时，stopped 为 "max_turns" 或 "max_tokens" 时表示达到了会话的上限
+
+    传入 session（tools.conversation.ConversationSession）时在同一会话中继续对话，之前的问答和工具结果都在上下文中；
+    不传时每次都是新的会话。
+
+    传入 collection_name 时使用语义答案缓存（见 tools.answer_cache）：question（默认为 user_query）
+    与之前的问题足够相似时直接返回之前的答案，不调用模型。追问依赖之前的对话，只有会话中的第一个问题使用缓存
+    """
+    session = session if session is not None else ConversationSession()
+    if not session.lock.acquire(blocking=False):
+        raise RuntimeError("该会话正在回答另一个问题")
+    # 生成器在每次 yield 之间可能运行在不同的上下文中，span 显式传递 parent 而不依赖当前上下文
+    conversation_span = tracing.start_span("agent.conversation", question_index=session.questions + 1)
+    question = question or user_query
+    try:
+        lookup = None
+        if collection_name and answer_cache.ENABLED and session.questions == 0:
+            lookup = await _alookup_answer(question, collection_name, conversation_span)
+        if lookup and lookup[0]:
+            cached = lookup[0]
+            session.add_answer(user_query, cached["answer"])
+            conversation_span.set(cache_hit=True, turns=0)
+            conversation_span.end()
+            yield {"type": "cached", "turn": 0, "question": cached["question"],
+                   "similarity": cached["similarity"], "created_at": cached["created_at"]}
+            yield {"type": "answer", "turn": 0, "delta": cached["answer"]}
+            yield {"type": "done", "turn": 0, "content": cached["answer"],
+                   "trace_id": conversation_span.trace_id, "cached": True, "stopped": None}
+            return
+
+        cited = set()
+        cacheable = True
+        async for event in _astream_turns(user_query, conversation_span, cited, session):
+            if event["type"] == "tool_end":
+                # 网络搜索的结果会过时，工具出错时答案也不可靠，这两种答案不写入缓存
+                if event["name"] != "search_with_db" or event["result"].startswith("错误："):
+                    cacheable = False
+            if event["type"] == "done":
+                conversation_span.set(turns=event["turn"], cache_hit=False, context_tokens=session.estimated_tokens())
+                if event["stopped"]:
+                    conversation_span.set(stopped=event["stopped"])
+                if lookup and cacheable and cited and event["content"] and not event["stopped"]:
+                    await _astore_answer(question, collection_name, event["content"], cited, lookup)
+                conversation_span.end()
+                event["trace_id"] = conversation_span.trace_id
+                event["cached"] = False
+            yield event
+    except BaseException as e:
+        conversation_span.end(error=e)
+        raise
+    finally:
+        conversation_span.end()
+        session.lock.release()
+
+async def _stream_completion(messages, llm_span, tool_choice="auto"):
+    """调用 API（启用 thinking 模式）并逐个产出流式分片，出错时结束 llm_span 并记录错误"""
+    try:
+        # include_usage 让最后一个分片带上 token 用量
+        stream = await get_async_client().chat.completions.create(
+            model=DEEPSEEK_MODEL,
             messages=messages,
             tools=tools,
+            tool_choice=tool_choice,
             extra_body={"thinking": {"type": "enabled"}},
-            stream=False  # 为简化示例，不使用流式
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            yield chunk
+    except Exception as e:
+        llm_span.end(error=e)
+        raise
+
+async def _alookup_answer(question, collection_name, parent):
+    """在线程池中查找答案缓存，出错时返回 None（按未启用缓存处理）"""
+    loop = asyncio.get_running_loop()
+
+    def lookup():
+        with tracing.span("answer_cache.lookup", parent=parent, collection=collection_name) as s:
+            result = answer_cache.lookup(question, collection_name)
+            s.set(cache_hit=result[0] is not None)
+            return result
+
+    try:
+        return await loop.run_in_executor(None, lookup)
+    except Exception as e:
+        print(f"查找答案缓存时出错: {e}")
+        return None
+
+async def _astore_answer(question, collection_name, answer, cited, lookup):
+    _, embedding, version = lookup
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(
+            None, lambda: answer_cache.store(question, collection_name, answer, sorted(cited), embedding, version)
         )
+    except Exception as e:
+        print(f"写入答案缓存时出错: {e}")
 
-        # 获取助手消息
-        assistant_message = response.choices[0].message
-        reasoning_content = assistant_message.reasoning_content
-        content = assistant_message.content
-        tool_calls = assistant_message.tool_calls
+async def _astream_turns(user_query, conversation_span, cited, session):
+    session.begin(user_query)
+    turn = 1
+    stopped = None
+
+    while True:
+        compacted = session.compact()
+        llm_span = tracing.start_span("llm.call", parent=conversation_span, turn=turn, model=DEEPSEEK_MODEL)
+        if compacted:
+            llm_span.set(compacted=compacted)
+        if stopped:
+            llm_span.set(stopped=stopped)
+        reasoning_parts = []
+        content_parts = []
+        # 工具调用的参数是分片到达的，按 index 拼接
+        partial_calls = {}
+        usage_recorded = False
+        # 达到上限后的最后一轮不允许再调用工具，模型只能根据已有信息回答
+        async for chunk in _stream_completion(session.messages, llm_span, "none" if stopped else "auto"):
+            if "first_token_ms" not in llm_span.attrs:
+                llm_span.set(first_token_ms=round((time.time() - llm_span.start) * 1000, 1))
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                _record_usage(llm_span, usage)
+                session.record_usage(llm_span.attrs["prompt_tokens"], llm_span.attrs["completion_tokens"])
+                usage_recorded = True
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            reasoning_delta = getattr(delta, "reasoning_content", None)
+            if reasoning_delta:
+                reasoning_parts.append(reasoning_delta)
+                yield {"type": "reasoning", "turn": turn, "delta": reasoning_delta}
+            if delta.content:
+                content_parts.append(delta.content)
+                yield {"type": "answer", "turn": turn, "delta": delta.content}
+            for call_delta in delta.tool_calls or []:
+                call = partial_calls.setdefault(call_delta.index, {"id": None, "name": "", "arguments": ""})
+                if call_delta.id:
+                    call["id"] = call_delta.id
+                if call_delta.function and call_delta.function.name:
+                    call["name"] += call_delta.function.name
+                if call_delta.function and call_delta.function.arguments:
+                    call["arguments"] += call_delta.function.arguments
+
+        llm_span.set(tool_calls=len(partial_calls))
+        llm_span.end()
+        reasoning_content = "".join(reasoning_parts)
+        content = "".join(content_parts)
+        if not usage_recorded:
+            # 服务没有返回用量时按估计值计入上限
+            session.record_usage(session.estimated_tokens(), chunking.token_length(reasoning_content + content))
+        tool_calls = [
+            SimpleNamespace(id=call["id"], function=SimpleNamespace(name=call["name"], arguments=call["arguments"]))
+            for _, call in sorted(partial_calls.items())
+        ]
+        if stopped and tool_calls:
+            # 模型仍然要求调用工具时丢弃这些调用，历史中不能留下没有结果的工具调用
+            tool_calls = []
+            content = content or f"（已达到本问题的{'轮数' if stopped == 'max_turns' else 'token 用量'}上限，未能得到最终答案）"
         # 打印调试信息（可选）
         print(f"\n--- Turn {turn} ---")
         if reasoning_content:
@@ -91,37 +422,100 @@ def run_conversation(user_query: str):
         if content:
             print(f"最终答案：{content}")
         if tool_calls:
-            print(f"需要调用的工具：{tool_calls}")
+            print(f"需要调用的工具：{[(c.function.name, c.function.arguments) for c in tool_calls]}")
 
         # 将完整的助手消息添加到历史中（包含 reasoning_content）
-        messages.append(assistant_message)
+        assistant_message = {"role": "assistant", "content": content, "reasoning_content": reasoning_content}
+        if tool_calls:
+            assistant_message["tool_calls"] = [
+                {"id": c.id, "type": "function", "function": {"name": c.function.name, "arguments": c.function.arguments}}
+                for c in tool_calls
+            ]
+        session.add_assistant(assistant_message)
 
         # 如果没有工具调用，说明已得到最终答案，结束循环
         if not tool_calls:
-            break
+            yield {"type": "done", "turn": turn, "content": content, "stopped": stopped}
+            return
 
-        # 处理所有工具调用
+        # 并发执行本轮所有工具调用，耗时约等于最慢的那个工具
         for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
-
-            # 调用对应的本地函数
-            if function_name in TOOL_MAP:
-                result = TOOL_MAP[function_name](**function_args)
-            else:
-                result = f"错误：未知工具 {function_name}"
+            yield {"type": "tool_start", "turn": turn, "id": tool_call.id,
+                   "name": tool_call.function.name, "arguments": tool_call.function.arguments}
+        results = {}
+        calls = [_run_tool_call(tool_call, conversation_span, cited, session) for tool_call in tool_calls]
+        for finished in asyncio.as_completed(calls):
+            tool_call, result, elapsed, key, memoized = await finished
+            results[tool_call.id] = (key, result)
+            yield {"type": "tool_end", "turn": turn, "id": tool_call.id, "name": tool_call.function.name,
+                   "result": str(result), "elapsed": elapsed, "memoized": memoized}
 
-            # 将工具结果添加到消息历史
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "content": str(result)
-            })
+        # 按原顺序将工具结果添加到消息历史
+        for tool_call in tool_calls:
+            session.add_tool_result(tool_call, *results[tool_call.id])
 
         turn += 1
+        stopped = session.limit_reached(turn)
+
+def _record_usage(llm_span, usage):
+    """把接口返回的 token 用量记录到 span 上"""
+    llm_span.set(
+        prompt_tokens=getattr(usage, "prompt_tokens", None) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", None) or 0,
+    )
+    details = getattr(usage, "completion_tokens_details", None)
+    reasoning_tokens = getattr(details, "reasoning_tokens", None) if details else None
+    if reasoning_tokens:
+        llm_span.set(reasoning_tokens=reasoning_tokens)
+    cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached_tokens:
+        llm_span.set(prompt_cache_hit_tokens=cached_tokens)
+
+async def run_conversation_async(user_query: str, collection_name=None, question=None, session=None):
+    """执行一次完整的问答（可能包含多轮工具调用），同一轮的工具调用并发执行"""
+    answer = None
+    # 把事件流读完再返回，生成器正常结束后才会释放会话
+    async for event in astream_conversation(user_query, collection_name, question, session):
+        if event["type"] == "done":
+            # 最终答案（最后一条助手消息的 content）
+            answer = event["content"]
+    return answer
+
+# 同步包装共用一个后台事件循环：AsyncOpenAI 的连接池绑定在创建它的事件循环上，
+# 每次 asyncio.run() 新建循环会导致连接无法复用甚至报错
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="agent-loop", daemon=True).start()
+        return _loop
+
+def run_conversation(user_query: str, collection_name=None, question=None, session=None):
+    """执行一次完整的问答（run_conversation_async 的同步包装）"""
+    future = asyncio.run_coroutine_threadsafe(
+        run_conversation_async(user_query, collection_name, question, session), _get_loop()
+    )
+    return future.result()
 
-    # 返回最终答案（最后一条助手消息的 content）
-    return assistant_message.content
+def stream_conversation(user_query: str, collection_name=None, question=None, session=None):
+    """
+    astream_conversation 的同步生成器版本，可直接用于 Streamlit 等同步代码
+    """
+    loop = _get_loop()
+    events = astream_conversation(user_query, collection_name, question, session)
+    try:
+        while True:
+            try:
+                event = asyncio.run_coroutine_threadsafe(events.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+            yield event
+    finally:
+        asyncio.run_coroutine_threadsafe(events.aclose(), loop).result()
 
 # 使用示例
 if __name__ == "__main__":
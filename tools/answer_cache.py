@@ -0,0 +1,220 @@
+"""
+问答的语义缓存：问题的向量与之前问过的问题足够相似时，直接返回之前的最终答案，不再调用推理模型
+
+每条缓存记录 (问题向量, 集合, 集合版本号, 最终答案, 答案引用的片段ID)，存放在数据库目录下的 answer_cache.sqlite3。
+缓存在以下情况下失效：
+
+- 集合内容变化（导入或删除文档后版本号递增，旧版本的记录在下一次查找时删除）
+- 答案引用的任一片段被删除（ingestion 删除片段时调用 invalidate_chunks）
+- 超过 TTL，或条目数超过上限时按最近命中时间淘汰
+
+查找时把同一集合、同一版本的问题向量读入内存矩阵，与新问题计算余弦相似度，超过阈值即命中。
+"""
+import os
+import time
+import sqlite3
+import threading
+from array import array
+from contextlib import closing
+
+from tools import settings, manifest
+
+ANSWER_CACHE_FILENAME = "answer_cache.sqlite3"
+
+ENABLED = settings.get("answer_cache.enabled")
+
+# 余弦相似度阈值：越高越保守，只有换了说法的同一个问题才会命中
+THRESHOLD = settings.get("answer_cache.threshold")
+
+TTL_SECONDS = settings.get("answer_cache.ttl")
+
+MAX_ENTRIES = settings.get("answer_cache.max_entries")
+
+# SQLite 单条语句的参数个数有限制，批量删除时按此大小分组
+_SQL_BATCH = 500
+
+_initialized = set()
+_lock = threading.Lock()
+# (数据库路径, 集合) -> 该集合当前版本的问题向量矩阵
+_matrices = {}
+_hits = 0
+_misses = 0
+
+
+def _connect(persist_directory):
+    path = os.path.abspath(os.path.join(persist_directory, ANSWER_CACHE_FILENAME))
+    if path in _initialized and os.path.exists(path):
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+    os.makedirs(persist_directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS answers ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, version TEXT NOT NULL, "
+        "question TEXT NOT NULL, embedding BLOB NOT NULL, answer TEXT NOT NULL, "
+        "created_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, last_hit REAL);"
+        "CREATE INDEX IF NOT EXISTS idx_answers_collection ON answers(collection, version);"
+        "CREATE TABLE IF NOT EXISTS answer_chunks ("
+        "answer_id INTEGER NOT NULL REFERENCES answers(id) ON DELETE CASCADE, chunk_id TEXT NOT NULL, "
+        "PRIMARY KEY (answer_id, chunk_id));"
+        "CREATE INDEX IF NOT EXISTS idx_answer_chunks_chunk ON answer_chunks(chunk_id);"
+    )
+    _initialized.add(path)
+    return conn
+
+
+def _normalize(vector):
+    import numpy as np
+
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def embed_question(question):
+    """计算问题的单位向量（与检索使用同一个嵌入模型和嵌入缓存）"""
+    from tools.registry import get_embeddings
+
+    return _normalize(get_embeddings().embed_query(question))
+
+
+def _load_matrix(conn, path, collection_name, version):
+    """返回 (记录ID列表, 向量矩阵)；记录数和最大ID不变时复用内存中的矩阵"""
+    import numpy as np
+
+    signature = conn.execute(
+        "SELECT COUNT(*), MAX(id) FROM answers WHERE collection = ? AND version = ?",
+        (collection_name, version),
+    ).fetchone()
+    key = (path, collection_name)
+    with _lock:
+        cached = _matrices.get(key)
+        if cached is not None and cached[0] == (version, signature):
+            return cached[1], cached[2]
+    rows = conn.execute(
+        "SELECT id, embedding FROM answers WHERE collection = ? AND version = ? ORDER BY id",
+        (collection_name, version),
+    ).fetchall()
+    ids = [row[0] for row in rows]
+    matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) if rows else None
+    with _lock:
+        _matrices[key] = ((version, signature), ids, matrix)
+    return ids, matrix
+
+
+def lookup(question, collection_name, persist_directory=settings.PERSIST_DIRECTORY, threshold=THRESHOLD):
+    """
+    按语义相似度查找缓存的答案
+
+    Returns:
+        tuple: (命中的记录或 None, 问题向量, 集合版本号)；向量和版本号在未命中时传给 store()，
+            命中的记录包含 id、question、answer、similarity、chunk_ids、created_at
+    """
+    global _hits, _misses
+    embedding = embed_question(question)
+    version = manifest.get_version(collection_name, persist_directory)
+    path = os.path.abspath(os.path.join(persist_directory, ANSWER_CACHE_FILENAME))
+    with closing(_connect(persist_directory)) as conn:
+        # 顺带删除旧版本和过期的记录
+        with conn:
+            conn.execute(
+                "DELETE FROM answers WHERE collection = ? AND (version != ? OR created_at < ?)",
+                (collection_name, version, time.time() - TTL_SECONDS),
+            )
+        ids, matrix = _load_matrix(conn, path, collection_name, version)
+        entry = None
+        if matrix is not None and matrix.shape[1] == embedding.shape[0]:
+            similarities = matrix @ embedding
+            best = int(similarities.argmax())
+            if similarities[best] >= threshold:
+                row = conn.execute(
+                    "SELECT id, question, answer, created_at FROM answers WHERE id = ?", (ids[best],)
+                ).fetchone()
+                if row is not None:
+                    chunk_ids = [c for (c,) in conn.execute(
+                        "SELECT chunk_id FROM answer_chunks WHERE answer_id = ?", (row[0],)
+                    )]
+                    entry = {
+                        "id": row[0], "question": row[1], "answer": row[2], "created_at": row[3],
+                        "similarity": float(similarities[best]), "chunk_ids": chunk_ids,
+                    }
+                    with conn:
+                        conn.execute(
+                            "UPDATE answers SET hits = hits + 1, last_hit = ? WHERE id = ?", (time.time(), row[0])
+                        )
+    with _lock:
+        if entry is None:
+            _misses += 1
+        else:
+            _hits += 1
+    return entry, embedding, version
+
+
+def store(question, collection_name, answer, chunk_ids, embedding, version, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    保存最终答案；version 应是开始回答前取得的版本号，回答期间集合发生变化时这条记录会立即失效
+    """
+    blob = array("f", [float(x) for x in embedding]).tobytes()
+    now = time.time()
+    with closing(_connect(persist_directory)) as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO answers (collection, version, question, embedding, answer, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (collection_name, version, question, blob, answer, now),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO answer_chunks (answer_id, chunk_id) VALUES (?, ?)",
+            [(cursor.lastrowid, chunk_id) for chunk_id in chunk_ids],
+        )
+        count = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count > MAX_ENTRIES:
+            # 一次多淘汰 10%，避免每次写入都触发淘汰
+            conn.execute(
+                "DELETE FROM answers WHERE id IN ("
+                "SELECT id FROM answers ORDER BY COALESCE(last_hit, created_at) LIMIT ?)",
+                (count - int(MAX_ENTRIES * 0.9),),
+            )
+    return cursor.lastrowid
+
+
+def invalidate_chunks(collection_name, chunk_ids, persist_directory=settings.PERSIST_DIRECTORY):
+    """删除引用了这些片段的缓存答案，返回删除的条数"""
+    chunk_ids = list(chunk_ids)
+    if not chunk_ids:
+        return 0
+    deleted = 0
+    with closing(_connect(persist_directory)) as conn, conn:
+        for i in range(0, len(chunk_ids), _SQL_BATCH):
+            batch = chunk_ids[i:i + _SQL_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            deleted += conn.execute(
+                f"DELETE FROM answers WHERE collection = ? AND id IN ("
+                f"SELECT answer_id FROM answer_chunks WHERE chunk_id IN ({placeholders}))",
+                [collection_name, *batch],
+            ).rowcount
+    return deleted
+
+
+def drop_collection(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """删除集合的全部缓存答案"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.execute("DELETE FROM answers WHERE collection = ?", (collection_name,))
+
+
+def stats(persist_directory=settings.PERSIST_DIRECTORY):
+    """返回本进程的命中统计和缓存中的条目数"""
+    with _lock:
+        hits, misses = _hits, _misses
+    with closing(_connect(persist_directory)) as conn:
+        entries = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+        "entries": entries,
+        "max_entries": MAX_ENTRIES,
+        "threshold": THRESHOLD,
+    }
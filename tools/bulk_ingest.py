@@ -0,0 +1,311 @@
+"""
+批量导入：把目录或多个文件并行导入向量数据库
+
+流水线分为三个阶段，阶段之间通过有界队列连接以实现背压：
+1. 解析分块：在进程池中并行加载和分块文件
+2. 嵌入：由一个专用线程把多个文件的片段合并成大批次后计算向量
+3. 写入：由一个专用线程按批次把向量写入向量存储，并维护文件清单
+
+用法：
+    python -m tools.bulk_ingest ./docs --collection knowledge_base --workers 4
+"""
+import os
+import sys
+import queue
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tools import settings
+from tools.ingestion import SUPPORTED_EXTENSIONS, split_file, plan_upsert, record_written, record_deleted
+from tools.registry import get_embeddings, get_store
+from tools import manifest
+
+_DONE = object()
+
+
+def collect_files(paths):
+    """
+    把目录展开为其中所有受支持的文件，返回 (文件路径, 源文件名) 列表，保持输入顺序
+
+    目录中的文件以相对于该目录的路径（以 / 分隔）作为源文件名，不同子目录中的同名文件不会被当成同一个文件；
+    直接给出的文件以文件名作为源文件名
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                        file_path = os.path.join(root, name)
+                        files.append((file_path, os.path.relpath(file_path, path).replace(os.sep, "/")))
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+
+class _FileTask:
+    """单个文件在流水线中的状态"""
+
+    def __init__(self, path, source_filename):
+        self.path = path
+        self.source_filename = source_filename
+        self.ids = []
+        self.added = []
+        self.stale_ids = []
+        self.error = None
+
+
+def _print_progress(progress):
+    print(
+        f"[批量导入] 文件 {progress['files_done'] + progress['files_failed']}/{progress['total_files']}"
+        f"（失败 {progress['files_failed']}），已解析 {progress['files_parsed']} 个文件，"
+        f"已嵌入 {progress['chunks_embedded']} 个片段，已写入 {progress['chunks_written']} 个片段"
+    )
+
+
+def bulk_ingest(paths, collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY,
+                source_filenames=None, workers=None, use_processes=True,
+                embed_batch_size=256, write_batch_size=512, queue_size=4,
+                progress_callback=_print_progress):
+    """
+    并行批量导入多个文件（upsert 模式）
+
+    Args:
+        paths (list): 文件或目录路径列表，目录会被递归展开
+        collection_name (str): 集合名称
+        persist_directory (str): 持久化目录
+        source_filenames (list): 与 paths 一一对应的源文件名（仅在全部为文件时使用），
+            默认取文件名，目录中的文件取相对于该目录的路径
+        workers (int): 解析分块的并行进程数，默认为 CPU 核数
+        use_processes (bool): 为 False 时用线程池解析（适合不便创建子进程的环境）
+        embed_batch_size (int): 每次送入嵌入模型的片段数
+        write_batch_size (int): 每次写入数据库的片段数
+        queue_size (int): 阶段之间队列的容量
+        progress_callback (callable): 接收进度字典的回调
+
+    Returns:
+        dict: 源文件名 -> {"status": "ok"/"failed", "added": int, "deleted": int, "error": str}
+    """
+    entries = collect_files(paths)
+    files = [path for path, _ in entries]
+    if source_filenames is None:
+        source_filenames = [name for _, name in entries]
+    elif len(source_filenames) != len(files):
+        raise ValueError("source_filenames must match the number of files")
+    # 同名的两个文件会共用清单记录，重新导入时互相把对方的片段当作过期片段删除，必须在开始前拒绝
+    duplicates = sorted(name for name, count in Counter(source_filenames).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"源文件名重复，无法区分这些文件: {', '.join(duplicates)}")
+
+    store = get_store(collection_name, persist_directory)
+    embeddings = get_embeddings()
+
+    results = {}
+    progress = {
+        "total_files": len(files), "files_parsed": 0, "files_done": 0, "files_failed": 0,
+        "chunks_embedded": 0, "chunks_written": 0,
+    }
+    progress_lock = threading.Lock()
+    last_reported = {}
+
+    def report(**increments):
+        with progress_lock:
+            for key, value in increments.items():
+                progress[key] += value
+
+    def emit_progress():
+        # 进度回调只在调用方线程中执行（例如 Streamlit 的脚本线程）
+        with progress_lock:
+            snapshot = dict(progress)
+        if progress_callback and snapshot != last_reported:
+            last_reported.update(snapshot)
+            progress_callback(snapshot)
+
+    def fail(task, error):
+        if task.error is None:
+            task.error = error
+            results[task.source_filename] = {"status": "failed", "added": 0, "deleted": 0, "error": str(error)}
+            print(f"导入文件 '{task.source_filename}' 失败: {error}")
+            report(files_failed=1)
+
+    parsed_queue = queue.Queue(maxsize=queue_size)
+    embedded_queue = queue.Queue(maxsize=queue_size)
+
+    def embed_stage():
+        pending = []
+        finished_tasks = []
+
+        def flush():
+            if pending:
+                texts = [doc.page_content for _, _, doc in pending]
+                try:
+                    vectors = embeddings.embed_documents(texts)
+                except Exception as e:
+                    for task in {id(t): t for t, _, _ in pending}.values():
+                        fail(task, e)
+                    vectors = None
+                if vectors is not None:
+                    embedded_queue.put(list(zip(pending, vectors)))
+                    report(chunks_embedded=len(pending))
+                pending.clear()
+            for task in finished_tasks:
+                embedded_queue.put(task)
+            finished_tasks.clear()
+
+        while True:
+            task = parsed_queue.get()
+            if task is _DONE:
+                break
+            for chunk_id, doc in task.added:
+                pending.append((task, chunk_id, doc))
+                if len(pending) >= embed_batch_size:
+                    flush()
+            finished_tasks.append(task)
+        flush()
+        embedded_queue.put(_DONE)
+
+    def write_stage():
+        buffer = []
+        finished_tasks = []
+
+        def flush():
+            live = [(task, chunk_id, doc, vector) for (task, chunk_id, doc), vector in buffer if task.error is None]
+            buffer.clear()
+            if live:
+                write(live)
+            # 缓冲区写出后，之前标记为已完成嵌入的文件才能收尾
+            for task in finished_tasks:
+                finalize(task)
+            finished_tasks.clear()
+
+        def write(live):
+            try:
+                store.add(
+                    [chunk_id for _, chunk_id, _, _ in live],
+                    [vector for _, _, _, vector in live],
+                    [doc.page_content for _, _, doc, _ in live],
+                    [doc.metadata for _, _, doc, _ in live],
+                )
+            except Exception as e:
+                for task in {id(t): t for t, _, _, _ in live}.values():
+                    fail(task, e)
+                return
+            # 每写入一批就更新清单，中断后重新导入时已写入的片段不会再次嵌入
+            by_task = {}
+            for task, chunk_id, doc, _ in live:
+                entry = by_task.setdefault(id(task), (task, [], []))
+                entry[1].append(chunk_id)
+                entry[2].append(doc)
+            for task, ids, docs in by_task.values():
+                # 清单写入失败只影响这个文件，异常不能结束写入线程，否则其他阶段会阻塞在队列上
+                try:
+                    record_written(collection_name, task.source_filename, ids, docs, persist_directory)
+                except Exception as e:
+                    fail(task, e)
+            report(chunks_written=len(live))
+
+        def finalize(task):
+            if task.error is not None:
+                return
+            try:
+                if task.stale_ids:
+                    store.delete(task.stale_ids)
+                    record_deleted(collection_name, task.source_filename, task.stale_ids, persist_directory)
+                manifest.add_chunk_ids(collection_name, task.source_filename, task.ids, persist_directory)
+                manifest.record_file(collection_name, task.source_filename, *manifest.file_digest(task.path), persist_directory)
+            except Exception as e:
+                fail(task, e)
+                return
+            results[task.source_filename] = {
+                "status": "ok", "added": len(task.added), "deleted": len(task.stale_ids), "error": None,
+            }
+            report(files_done=1)
+
+        while True:
+            item = embedded_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _FileTask):
+                # 文件的全部片段都已在之前的批次中，等缓冲区写出后再收尾
+                finished_tasks.append(item)
+                if not buffer:
+                    flush()
+                continue
+            buffer.extend(item)
+            if len(buffer) >= write_batch_size:
+                flush()
+        flush()
+
+    embed_thread = threading.Thread(target=embed_stage, name="bulk-ingest-embed", daemon=True)
+    write_thread = threading.Thread(target=write_stage, name="bulk-ingest-write", daemon=True)
+    embed_thread.start()
+    write_thread.start()
+
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    max_workers = workers or os.cpu_count() or 1
+    try:
+        with executor_cls(max_workers=max_workers) as executor:
+            todo = list(zip(files, source_filenames))
+            in_flight = {}
+            # 只保持有限数量的文件在解析中，避免解析结果在内存中堆积
+            while todo or in_flight:
+                while todo and len(in_flight) < max_workers + queue_size:
+                    path, source_filename = todo.pop(0)
+                    task = _FileTask(path, source_filename)
+                    in_flight[executor.submit(split_file, path, source_filename)] = task
+                done, _ = wait(list(in_flight), timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    try:
+                        docs = future.result()
+                        task.ids, task.added, task.stale_ids = plan_upsert(
+                            store, collection_name, task.source_filename, docs, persist_directory
+                        )
+                    except Exception as e:
+                        fail(task, e)
+                        continue
+                    report(files_parsed=1)
+                    parsed_queue.put(task)
+                emit_progress()
+    finally:
+        parsed_queue.put(_DONE)
+        for thread in (embed_thread, write_thread):
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+                emit_progress()
+        store.flush()
+    emit_progress()
+
+    print(f"批量导入完成：成功 {progress['files_done']} 个文件，失败 {progress['files_failed']} 个文件")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量导入目录或文件到知识库")
+    parser.add_argument("paths", nargs="+", help="文件或目录路径")
+    parser.add_argument("--collection", default="knowledge_base", help="集合名称")
+    parser.add_argument("--persist-directory", default=settings.PERSIST_DIRECTORY, help="数据库持久化目录")
+    parser.add_argument("--workers", type=int, default=None, help="解析分块的并行进程数")
+    parser.add_argument("--embed-batch-size", type=int, default=256, help="嵌入批大小")
+    parser.add_argument("--write-batch-size", type=int, default=512, help="写入批大小")
+    args = parser.parse_args(argv)
+
+    results = bulk_ingest(
+        args.paths,
+        collection_name=args.collection,
+        persist_directory=args.persist_directory,
+        workers=args.workers,
+        embed_batch_size=args.embed_batch_size,
+        write_batch_size=args.write_batch_size,
+    )
+    failed = {name: r for name, r in results.items() if r["status"] != "ok"}
+    for name, r in failed.items():
+        print(f"  失败: {name}: {r['error']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+"""
+按文档结构分块：不同格式使用不同的切分策略，片段长度按嵌入模型的分词器计算 token 数
+
+- Markdown：按标题层级切成章节（独占一段的“一、”“第一章”这类中文编号标题也算一级），片段记录所在的标题路径
+- PDF：每页是一个父片段，页内把被换行打断的句子重新拼接后按句切分
+- TXT / DOCX：按空行切成段落，识别“第一章”“1.2 安装”这类编号标题作为章节
+- Markdown 和 TXT / DOCX 的章节正文同样先拼接按固定宽度换行的句子，列表项、标题、表格和代码块保持原样
+
+章节（或 PDF 页）内部按中英文句子边界（。！？；.!?）切分，再把句子装入不超过 token 预算的片段，
+相邻片段之间保留若干句重叠。每个片段的元数据中记录 section（标题路径）、parent_id（所属章节/页的ID）
+和 chunk_index（在章节内的序号），可以据此找回同一章节的相邻片段。
+"""
+import os
+import re
+import math
+import hashlib
+import threading
+
+from langchain_core.documents import Document
+
+from tools import settings
+
+# 每个片段的 token 上限；bge 系列模型最多接受 512 个 token，超出部分会被截断，白白浪费嵌入计算
+CHUNK_TOKENS = settings.get("chunking.chunk_tokens")
+
+# 相邻片段之间重叠的 token 数
+CHUNK_OVERLAP_TOKENS = settings.get("chunking.overlap_tokens")
+
+# 计算 token 数使用的分词器，默认与嵌入模型一致；设为 approx 时使用按字符估算的近似值
+TOKENIZER_PATH = settings.get("chunking.tokenizer")
+
+_SENTENCE_END = re.compile(r"([。！？；!?;…]+[”’」』）)\"']*|\.(?=\s)|\n+)")
+_MARKDOWN_HEADER = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_MARKDOWN_FENCE = re.compile(r"^\s*(```|~~~)")
+# 编号标题：第一章、第3节、一、1.2 安装、1) 概述
+_NUMBERED_HEADER = re.compile(
+    r"^(第[一二三四五六七八九十百千\d]+[章节部分篇条]|[一二三四五六七八九十]+、|\d+(\.\d+)*[、.)）]?\s)"
+)
+# Markdown 中只识别中文编号标题，“1. ”是有序列表的语法
+_CHINESE_NUMBERED_HEADER = re.compile(r"^(第[一二三四五六七八九十百千\d]+[章节部分篇条]|[一二三四五六七八九十]+、)")
+# Markdown 中编号标题的层级，低于所有 # 标题
+_NUMBERED_HEADER_LEVEL = 7
+# 不与上一行拼接的行：列表项、标题、引用、表格
+_BLOCK_START = re.compile(r"^\s*([-*+]\s|\d+[.)、]\s|#|>|\|)")
+_TERMINAL_PUNCTUATION = "。！？；!?;.…:：”’」』）)"
+# 标题末尾可以是括号或引号（如“二、RAG（检索增强生成）”），只有句末标点说明这是一句正文
+_HEADING_TERMINAL_PUNCTUATION = "。！？；!?;.…:：，,"
+_CJK = re.compile(r"[㐀-䶿一-鿿]")
+_APPROX_TOKEN = re.compile(r"[㐀-䶿一-鿿]|[A-Za-z]+|\d+|\S")
+
+_lock = threading.Lock()
+_tokenizer = None
+
+
+def _load_tokenizer():
+    """加载计算 token 数使用的分词器，加载失败时返回 None（退回近似计算）"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _lock:
+            if _tokenizer is None:
+                path = TOKENIZER_PATH or settings.EMBEDDING_MODEL_PATH
+                tokenizer = False
+                if path != "approx":
+                    try:
+                        from transformers import AutoTokenizer
+                        tokenizer = AutoTokenizer.from_pretrained(path)
+                    except Exception as e:
+                        print(f"加载分词器失败，按字符近似计算 token 数: {e}")
+                _tokenizer = tokenizer
+    return _tokenizer or None
+
+
+def _approx_length(text):
+    # 汉字约为一个 token，英文单词按每 4 个字母一个 token 估算
+    count = 0
+    for match in _APPROX_TOKEN.finditer(text):
+        token = match.group()
+        count += math.ceil(len(token) / 4) if token[0].isascii() and token[0].isalpha() else 1
+    return count
+
+
+def token_lengths(texts):
+    """批量计算每段文本的 token 数（不含特殊 token）"""
+    if not texts:
+        return []
+    tokenizer = _load_tokenizer()
+    if tokenizer is None:
+        return [_approx_length(text) for text in texts]
+    return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+
+def token_length(text):
+    """计算一段文本的 token 数"""
+    return token_lengths([text])[0]
+
+
+def split_sentences(text):
+    """按中英文句子边界和换行切分文本，每句保留自身的标点和换行"""
+    parts = _SENTENCE_END.split(text)
+    sentences = []
+    # re.split 带捕获组时，分隔符出现在奇数位置，拼回前一句的末尾
+    for i in range(0, len(parts), 2):
+        sentence = parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+        if sentence.strip():
+            sentences.append(sentence)
+        elif sentences:
+            sentences[-1] += sentence
+    return sentences
+
+
+def _hard_split(sentence, length, max_tokens):
+    """把超过预算的单句按字符均分成若干段"""
+    pieces = math.ceil(length / max_tokens)
+    size = math.ceil(len(sentence) / pieces)
+    return [sentence[i:i + size] for i in range(0, len(sentence), size)]
+
+
+def pack_sentences(sentences, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    按顺序把句子装入不超过 max_tokens 的片段，下一个片段以上一个片段末尾不超过 overlap_tokens 的句子开头
+    """
+    units = []
+    for sentence, length in zip(sentences, token_lengths(sentences)):
+        if length > max_tokens:
+            pieces = _hard_split(sentence, length, max_tokens)
+            units.extend(zip(pieces, token_lengths(pieces)))
+        else:
+            units.append((sentence, length))
+
+    chunks = []
+    current, current_tokens = [], 0
+    for unit in units:
+        if current and current_tokens + unit[1] > max_tokens:
+            chunks.append("".join(text for text, _ in current).strip())
+            # 从末尾往前保留不超过重叠预算的句子
+            overlap, overlap_size = [], 0
+            for previous in reversed(current):
+                if overlap_size + previous[1] > overlap_tokens or overlap_size + previous[1] + unit[1] > max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += previous[1]
+            current, current_tokens = overlap, overlap_size
+        current.append(unit)
+        current_tokens += unit[1]
+    if current:
+        text = "".join(text for text, _ in current).strip()
+        if text:
+            chunks.append(text)
+    return chunks
+
+
+def split_markdown_sections(text):
+    """
+    按标题把 Markdown 切成章节，代码块中的 # 不视为标题
+
+    Returns:
+        list: [(标题路径列表, 章节正文), ...]，正文包含标题行本身
+    """
+    sections = []
+    path = []
+    lines = []
+    in_fence = False
+    all_lines = text.splitlines(keepends=True)
+    for i, line in enumerate(all_lines):
+        if _MARKDOWN_FENCE.match(line):
+            in_fence = not in_fence
+        header = None if in_fence else _MARKDOWN_HEADER.match(line)
+        if header:
+            level, title = len(header.group(1)), header.group(2)
+        elif not in_fence and _is_markdown_numbered_heading(all_lines, i):
+            level, title = _NUMBERED_HEADER_LEVEL, line.strip()
+        else:
+            level = None
+        if level:
+            if "".join(lines).strip():
+                sections.append(([title for _, title in path], "".join(lines)))
+            path = [(lv, t) for lv, t in path if lv < level] + [(level, title)]
+            lines = [line]
+        else:
+            lines.append(line)
+    if "".join(lines).strip():
+        sections.append(([title for _, title in path], "".join(lines)))
+    return sections
+
+
+def _is_numbered_heading(paragraph, pattern=_NUMBERED_HEADER):
+    line = paragraph.strip()
+    return (
+        "\n" not in line
+        and len(line) <= 40
+        and line[-1] not in _HEADING_TERMINAL_PUNCTUATION
+        and bool(pattern.match(line))
+    )
+
+
+def _is_markdown_numbered_heading(lines, i):
+    """第 i 行是否为独占一段（前后都是空行）的中文编号标题"""
+    return (
+        bool(lines[i].strip())
+        and (i == 0 or not lines[i - 1].strip())
+        and (i + 1 == len(lines) or not lines[i + 1].strip())
+        and _is_numbered_heading(lines[i], _CHINESE_NUMBERED_HEADER)
+    )
+
+
+def split_paragraph_sections(text):
+    """
+    按空行切分段落，遇到编号标题时开始新的章节（适用于 TXT 和 DOCX 提取出的文本）
+
+    Returns:
+        list: [(标题路径列表, 章节正文), ...]
+    """
+    sections = []
+    title = None
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if not paragraph.strip():
+            continue
+        if _is_numbered_heading(paragraph):
+            if paragraphs:
+                sections.append(([title] if title else [], "\n\n".join(paragraphs)))
+            title = paragraph.strip()
+            paragraphs = [paragraph]
+        else:
+            paragraphs.append(paragraph)
+    if paragraphs:
+        sections.append(([title] if title else [], "\n\n".join(paragraphs)))
+    return sections
+
+
+def join_broken_lines(text):
+    """
+    拼接 PDF 中被排版换行打断的句子：上一行不以句末标点结尾时与下一行合并，中文之间不加空格
+    """
+    result = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            if result and result[-1] != "\n":
+                result.append("\n")
+            continue
+        if result and result[-1] != "\n" and result[-1][-1] not in _TERMINAL_PUNCTUATION:
+            joiner = "" if _CJK.match(result[-1][-1]) or _CJK.match(line[0]) else " "
+            result[-1] = result[-1] + joiner + line
+        else:
+            if result and result[-1] != "\n":
+                result.append("\n")
+            result.append(line)
+    return "".join(result)
+
+
+def join_wrapped_lines(text):
+    """
+    拼接 Markdown 和纯文本中按固定宽度换行的句子：上一行不以句末标点结尾，且本行不是列表项、标题、
+    引用或表格时与上一行合并；空行、代码块和编号标题保持不变
+    """
+    result = []
+    in_fence = False
+    joinable = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if _MARKDOWN_FENCE.match(line):
+            in_fence = not in_fence
+            result.append(line)
+            joinable = False
+            continue
+        if in_fence or not stripped:
+            result.append(line)
+            joinable = False
+            continue
+        previous = result[-1].rstrip() if joinable else ""
+        if previous and previous[-1] not in _TERMINAL_PUNCTUATION and not _BLOCK_START.match(line):
+            joiner = "" if _CJK.match(previous[-1]) or _CJK.match(stripped[0]) else " "
+            result[-1] = previous + joiner + stripped
+        else:
+            result.append(line)
+        # 标题和表格行之后的内容不拼接到它们上面
+        joinable = not stripped.startswith(("#", "|")) and not _is_numbered_heading(stripped, _CHINESE_NUMBERED_HEADER)
+    return "\n".join(result)
+
+
+def strategy_for(file_path):
+    """根据扩展名选择切分策略：markdown、pdf 或 paragraph"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".md":
+        return "markdown"
+    if extension == ".pdf":
+        return "pdf"
+    return "paragraph"
+
+
+def _parent_id(source_file, *parts):
+    digest = hashlib.sha256("\0".join([source_file, *map(str, parts)]).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def chunk_page(page, strategy, source_filename, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    把加载器产出的一页（或整个文件）切成片段
+
+    Returns:
+        list: 带 source_file、section、parent_id、chunk_index 元数据的 Document 列表
+    """
+    text = page.page_content
+    if strategy == "markdown":
+        sections = [(path, join_wrapped_lines(body)) for path, body in split_markdown_sections(text)]
+    elif strategy == "pdf":
+        # 每页作为一个父片段
+        sections = [([], join_broken_lines(text))]
+    else:
+        # 先在原文上识别编号标题，再拼接各章节内被换行打断的句子
+        sections = [(path, join_wrapped_lines(body)) for path, body in split_paragraph_sections(text)]
+
+    docs = []
+    for index, (path, body) in enumerate(sections):
+        section = " > ".join(path)
+        # PDF 以页号、其他格式以章节序号和标题路径区分父片段
+        parent_id = _parent_id(source_filename, page.metadata.get("page", ""), index, section)
+        for chunk_index, chunk in enumerate(pack_sentences(split_sentences(body), max_tokens, overlap_tokens)):
+            metadata = dict(page.metadata)
+            metadata.update({
+                "source_file": source_filename,
+                "section": section,
+                "parent_id": parent_id,
+                "chunk_index": chunk_index,
+            })
+            docs.append(Document(page_content=chunk, metadata=metadata))
+    return docs
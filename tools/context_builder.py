@@ -0,0 +1,268 @@
+"""
+上下文组装：检索结果送入模型之前的整理步骤
+
+1. 去重：内容完全相同的片段只保留一个；字符 shingle 的 MinHash 估计 Jaccard 相似度超过阈值的近似重复片段
+   （例如同一文件的重复上传、内容几乎相同的不同版本）只保留排名靠前的一个
+2. MMR：按“与查询相关、与已选片段不同”的原则重新排序，向量来自嵌入缓存（导入时已经计算过）
+3. 合并与装填：按 MMR 顺序依次装入 token 预算；与已装入片段相邻（同一章节、chunk_index 相邻）
+   或文本首尾重叠的片段合并进同一段，重叠部分只保留一次
+4. 引用：每段以 [编号] 来源文件、章节和页码开头，模型可以在回答中按编号标注出处
+
+    text, blocks = build_context("如何配置嵌入模型", docs, token_budget=1200)
+"""
+import re
+import zlib
+
+from tools import settings, chunking
+
+# 一次检索送入模型的上下文 token 上限
+CONTEXT_TOKENS = settings.get("context.token_budget")
+
+# MMR 中相关性的权重，1 表示只看相关性，0 表示只看多样性
+MMR_LAMBDA = settings.get("context.mmr_lambda")
+
+# MinHash 估计的 Jaccard 相似度超过该值时视为近似重复
+DEDUP_THRESHOLD = settings.get("context.dedup_threshold")
+
+SHINGLE_SIZE = 5
+NUM_PERM = 64
+# 没有 chunk_index 元数据的旧片段，首尾重叠至少这么多字符才合并
+MIN_MERGE_OVERLAP = 20
+MAX_OVERLAP_CHARS = 4000
+
+_PRIME = (1 << 31) - 1
+_WHITESPACE = re.compile(r"\s+")
+_permutations = None
+
+
+def _normalize(text):
+    return _WHITESPACE.sub(" ", text).strip().casefold()
+
+
+def _get_permutations():
+    global _permutations
+    if _permutations is None:
+        import numpy as np
+
+        rng = np.random.RandomState(20240601)
+        _permutations = (
+            rng.randint(1, _PRIME, size=NUM_PERM, dtype=np.uint64),
+            rng.randint(0, _PRIME, size=NUM_PERM, dtype=np.uint64),
+        )
+    return _permutations
+
+
+def minhash(text, shingle_size=SHINGLE_SIZE):
+    """计算文本字符 shingle 集合的 MinHash 签名（NUM_PERM 个 uint64）"""
+    import numpy as np
+
+    text = _normalize(text)
+    shingles = {text[i:i + shingle_size] for i in range(max(1, len(text) - shingle_size + 1))}
+    hashes = np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) % _PRIME for s in shingles), dtype=np.uint64, count=len(shingles)
+    )
+    a, b = _get_permutations()
+    # a、b 和哈希值都小于 2^31，乘积不会超出 uint64
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % _PRIME).min(axis=1)
+
+
+def estimate_jaccard(signature_a, signature_b):
+    """由两个 MinHash 签名估计 Jaccard 相似度"""
+    return float((signature_a == signature_b).mean())
+
+
+def dedup(docs, threshold=DEDUP_THRESHOLD):
+    """按顺序去掉完全重复和近似重复的片段，保留先出现（排名靠前）的一个"""
+    kept, signatures, seen = [], [], set()
+    for doc in docs:
+        key = _normalize(doc.page_content)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        signature = minhash(doc.page_content)
+        if any(estimate_jaccard(signature, other) >= threshold for other in signatures):
+            continue
+        kept.append(doc)
+        signatures.append(signature)
+    return kept
+
+
+def mmr(query_vector, doc_vectors, lambda_mult=MMR_LAMBDA, k=None):
+    """
+    最大边际相关性排序
+
+    Returns:
+        list: 按选择顺序排列的下标
+    """
+    import numpy as np
+
+    vectors = np.asarray(doc_vectors, dtype=np.float32)
+    if not len(vectors):
+        return []
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+    k = min(k or len(vectors), len(vectors))
+    selected = [int(relevance.argmax())]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(scores.argmax())
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+def _mmr_order(query_text, docs, embeddings, lambda_mult):
+    """按 MMR 重新排序；计算向量失败时保持检索顺序"""
+    if len(docs) <= 2 or lambda_mult >= 1:
+        return docs
+    try:
+        if embeddings is None:
+            from tools.registry import get_embeddings
+            embeddings = get_embeddings()
+        query_vector = embeddings.embed_query(query_text)
+        doc_vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    except Exception as e:
+        print(f"计算 MMR 向量时出错，保持检索顺序: {e}")
+        return docs
+    return [docs[i] for i in mmr(query_vector, doc_vectors, lambda_mult)]
+
+
+def _overlap(a, b, max_chars=MAX_OVERLAP_CHARS):
+    """返回 a 的后缀与 b 的前缀重合的最大长度"""
+    if not a or not b:
+        return 0
+    start = max(0, len(a) - min(len(b), max_chars))
+    i = a.find(b[0], start)
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(b[0], i + 1)
+    return 0
+
+
+def _join(a, b):
+    overlap = _overlap(a, b)
+    return a + b[overlap:] if overlap else a + "\n" + b
+
+
+class _Block:
+    """上下文中的一段：来自同一来源、位置相邻的若干片段"""
+
+    def __init__(self, doc):
+        self.docs = [doc]
+        self.text = doc.page_content
+        self.metadata = doc.metadata
+
+    def _position(self, doc):
+        """doc 能接在本段之前返回 -1、之后返回 1，不相邻返回 0"""
+        metadata = doc.metadata
+        if metadata.get("source_file") != self.metadata.get("source_file"):
+            return 0
+        index = metadata.get("chunk_index")
+        if index is not None and metadata.get("parent_id") is not None:
+            if metadata.get("parent_id") != self.metadata.get("parent_id"):
+                return 0
+            indexes = [d.metadata.get("chunk_index") for d in self.docs]
+            if index == min(indexes) - 1:
+                return -1
+            if index == max(indexes) + 1:
+                return 1
+            return 0
+        # 旧数据没有片段序号，按文本首尾重叠判断
+        if _overlap(self.text, doc.page_content) >= MIN_MERGE_OVERLAP:
+            return 1
+        if _overlap(doc.page_content, self.text) >= MIN_MERGE_OVERLAP:
+            return -1
+        return 0
+
+    def merged_text(self, doc):
+        position = self._position(doc)
+        if position == 1:
+            return _join(self.text, doc.page_content)
+        if position == -1:
+            return _join(doc.page_content, self.text)
+        return None
+
+    def add(self, doc, text):
+        self.docs.append(doc)
+        self.text = text
+
+
+def _citation(index, metadata):
+    parts = [f"[{index}] 来源：{metadata.get('source_file') or metadata.get('source') or '未知'}"]
+    if metadata.get("section"):
+        parts.append(metadata["section"])
+    if isinstance(metadata.get("page"), int):
+        parts.append(f"第 {metadata['page'] + 1} 页")
+    return " · ".join(parts)
+
+
+def build_context(query_text, docs, token_budget=CONTEXT_TOKENS, embeddings=None, lambda_mult=MMR_LAMBDA,
+                  dedup_threshold=DEDUP_THRESHOLD, start_index=1, exclude_ids=()):
+    """
+    把检索结果整理成带引用编号的上下文
+
+    Args:
+        query_text (str): 查询，用于 MMR 的相关性
+        docs (list): 按检索排名排列的文档片段
+        token_budget (int): 上下文（含引用行）的 token 上限
+        embeddings: 计算 MMR 向量的嵌入模型，默认使用共享的嵌入模型
+        start_index (int): 第一段的引用编号，多次调用拼接上下文时保持编号连续
+        exclude_ids (set): 已经出现在上下文中的片段ID，不再重复装入
+
+    Returns:
+        tuple: (上下文文本, 段列表)；每段是包含 index、source_file、section、page、chunk_ids、text、tokens 的字典
+    """
+    docs = [doc for doc in docs if not getattr(doc, "id", None) or doc.id not in exclude_ids]
+    docs = dedup(docs, dedup_threshold)
+    docs = _mmr_order(query_text, docs, embeddings, lambda_mult)
+
+    blocks, used = [], 0
+    for doc in docs:
+        merged = False
+        for block in blocks:
+            text = block.merged_text(doc)
+            if text is None:
+                continue
+            cost = chunking.token_length(text) - chunking.token_length(block.text)
+            if used + cost <= token_budget:
+                block.add(doc, text)
+                used += cost
+            merged = True
+            break
+        if merged:
+            continue
+        cost = chunking.token_length(doc.page_content) + chunking.token_length(_citation(0, doc.metadata))
+        if used + cost <= token_budget:
+            blocks.append(_Block(doc))
+            used += cost
+        elif not blocks:
+            # 排名第一的片段本身就超出预算时，按句截取能装下的部分
+            budget = token_budget - chunking.token_length(_citation(0, doc.metadata))
+            sentences = chunking.split_sentences(doc.page_content)
+            texts = chunking.pack_sentences(sentences, max(budget, 1), 0)
+            if texts:
+                block = _Block(doc)
+                block.text = texts[0]
+                blocks.append(block)
+                used += chunking.token_length(texts[0])
+
+    result, sections = [], []
+    for offset, block in enumerate(blocks):
+        index = start_index + offset
+        sections.append(f"{_citation(index, block.metadata)}\n{block.text}")
+        result.append({
+            "index": index,
+            "source_file": block.metadata.get("source_file"),
+            "section": block.metadata.get("section"),
+            "page": block.metadata.get("page"),
+            "chunk_ids": [d.id for d in block.docs if getattr(d, "id", None)],
+            "text": block.text,
+            "tokens": chunking.token_length(block.text),
+        })
+    return "\n\n".join(sections), result
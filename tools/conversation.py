@@ -0,0 +1,226 @@
+"""
+多轮问答的会话状态
+
+ConversationSession 保存一次对话的完整消息历史，跨问题、跨 Streamlit 重新运行复用：
+
+- 工具结果按 (工具, 参数) 记忆：同一会话中重复的调用不再执行，结果仍在上下文中时只回一句引用，
+  不再把全文发送一遍；参数包含 collection_name 时键中带上集合版本号，集合变化后自动失效
+- 估计的上下文 token 数超过 COMPACT_TOKENS 时，从最早的开始把工具结果压缩成引用行或摘要，
+  最近一轮的工具结果保持原文；之前问题中的推理过程不再发送
+- 每个问题的模型调用轮数和 token 用量有上限，达到上限后最后一次调用不再允许调用工具
+
+    session = ConversationSession()
+    for question in ["什么是向量数据库", "它和关系型数据库有什么区别"]:
+        answer = run_conversation(question, session=session)
+
+一个会话同一时间只能回答一个问题。
+"""
+import re
+import json
+import time
+import threading
+
+from tools import settings, chunking
+
+# 每个问题最多调用模型的轮数（含最后一次不带工具的回答）
+MAX_TURNS = settings.get("conversation.max_turns")
+
+# 每个问题累计的 token 用量上限（各轮 prompt + completion）
+MAX_TOKENS = settings.get("conversation.max_tokens")
+
+# 上下文估计超过该 token 数时压缩较早的工具结果
+COMPACT_TOKENS = settings.get("conversation.compact_tokens")
+
+# 工具结果的记忆有效期（秒），网络搜索等结果过期后重新执行
+MEMO_TTL = settings.get("conversation.memo_ttl")
+
+# 没有引用行的工具结果压缩后保留的字符数
+SUMMARY_CHARS = 200
+
+_CITATION_LINE = re.compile(r"^(\[\d+\] 来源：|【查询：)")
+
+
+def summarize_tool_result(name, arguments, content):
+    """把工具结果压缩成引用行（知识库检索）或开头的摘要（其他工具）"""
+    header = f"（已压缩的 {name} 结果，参数 {arguments}；需要原文时可以用相同参数重新调用）"
+    citations = [line for line in content.splitlines() if _CITATION_LINE.match(line)]
+    if citations:
+        return "\n".join([header, *citations])
+    if len(content) <= SUMMARY_CHARS:
+        return f"{header}\n{content}"
+    return f"{header}\n{content[:SUMMARY_CHARS]}…（省略 {len(content) - SUMMARY_CHARS} 字）"
+
+
+class _MemoEntry:
+    def __init__(self, result, chunk_ids):
+        self.result = result
+        self.chunk_ids = set(chunk_ids)
+        self.created = time.time()
+        # 原文所在的消息下标，压缩后为 None
+        self.message_index = None
+
+
+class ConversationSession:
+    """一次对话的消息历史、工具结果记忆和用量统计"""
+
+    def __init__(self, max_turns=MAX_TURNS, max_tokens=MAX_TOKENS, compact_tokens=COMPACT_TOKENS,
+                 memo_ttl=MEMO_TTL):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.compact_tokens = compact_tokens
+        self.memo_ttl = memo_ttl
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """清空对话，开始新的会话"""
+        self.messages = []
+        # 与 messages 一一对应的估计 token 数
+        self._tokens = []
+        # 工具消息下标 -> (工具名, 参数)，压缩时用于生成摘要
+        self._tool_calls = {}
+        self._compacted = set()
+        self._memo = {}
+        self.questions = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.question_tokens = 0
+        self.memo_hits = 0
+        self.compactions = 0
+
+    def _append(self, message):
+        self.messages.append(message)
+        self._tokens.append(_estimate(message))
+        return len(self.messages) - 1
+
+    def _replace(self, index, message):
+        self.messages[index] = message
+        self._tokens[index] = _estimate(message)
+
+    def begin(self, user_query):
+        """开始回答一个新问题：去掉之前问题的推理过程，追加用户消息"""
+        for i, message in enumerate(self.messages):
+            if message.get("reasoning_content"):
+                self._replace(i, {k: v for k, v in message.items() if k != "reasoning_content"})
+        self._append({"role": "user", "content": user_query})
+        self.questions += 1
+        self.question_tokens = 0
+
+    def add_assistant(self, message):
+        self._append(message)
+
+    def add_answer(self, user_query, answer):
+        """记录一个不经过模型得到的问答（例如命中答案缓存），后续问题仍能看到它"""
+        self.begin(user_query)
+        self._append({"role": "assistant", "content": answer})
+
+    def memo_key(self, name, arguments):
+        """工具调用的记忆键；参数无法解析时返回 None（不记忆）"""
+        try:
+            args = json.loads(arguments or "{}")
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(args, dict):
+            return None
+        version = None
+        if args.get("collection_name"):
+            from tools import manifest
+            try:
+                version = manifest.get_version(args["collection_name"])
+            except Exception:
+                return None
+        return name, json.dumps(args, ensure_ascii=False, sort_keys=True), version
+
+    def recall(self, key):
+        """返回未过期的记忆结果，没有时返回 None"""
+        entry = self._memo.get(key) if key else None
+        if entry is None:
+            return None
+        if time.time() - entry.created > self.memo_ttl:
+            del self._memo[key]
+            return None
+        self.memo_hits += 1
+        return entry
+
+    def remember(self, key, result, chunk_ids=()):
+        # 出错的结果不记忆，下次重新执行
+        if key and not str(result).startswith("错误："):
+            self._memo[key] = _MemoEntry(str(result), chunk_ids)
+
+    def add_tool_result(self, tool_call, key, result):
+        """追加工具结果；同样的结果原文仍在上下文中时只追加一句引用"""
+        name, arguments = tool_call.function.name, tool_call.function.arguments
+        content = str(result)
+        entry = self._memo.get(key) if key else None
+        if entry is not None and entry.message_index is not None:
+            content = f"（与之前一次相同参数的 {name} 调用结果相同，见上文）"
+        index = self._append({"role": "tool", "tool_call_id": tool_call.id, "content": content})
+        self._tool_calls[index] = (name, arguments, key)
+        if entry is not None and entry.message_index is None:
+            entry.message_index = index
+
+    def estimated_tokens(self):
+        return sum(self._tokens)
+
+    def compact(self):
+        """
+        上下文超过 compact_tokens 时，从最早的开始压缩工具结果，直到低于阈值
+
+        最后一条助手消息之后的工具结果（模型下一轮要用的）保持原文。返回压缩的条数
+        """
+        total = self.estimated_tokens()
+        if total <= self.compact_tokens:
+            return 0
+        last_assistant = max((i for i, m in enumerate(self.messages) if m["role"] == "assistant"), default=-1)
+        compacted = 0
+        for index in sorted(self._tool_calls):
+            if total <= self.compact_tokens or index > last_assistant:
+                break
+            if index in self._compacted:
+                continue
+            name, arguments, key = self._tool_calls[index]
+            message = self.messages[index]
+            before = self._tokens[index]
+            self._replace(index, {**message, "content": summarize_tool_result(name, arguments, message["content"])})
+            self._compacted.add(index)
+            total -= before - self._tokens[index]
+            entry = self._memo.get(key) if key else None
+            if entry is not None and entry.message_index == index:
+                # 原文已不在上下文中，之后相同的调用要重新给出全文
+                entry.message_index = None
+            compacted += 1
+        self.compactions += compacted
+        return compacted
+
+    def record_usage(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.question_tokens += prompt_tokens + completion_tokens
+
+    def limit_reached(self, turn):
+        """第 turn 轮之前检查上限，返回 "max_turns"、"max_tokens" 或 None"""
+        if turn >= self.max_turns:
+            return "max_turns"
+        if self.question_tokens >= self.max_tokens:
+            return "max_tokens"
+        return None
+
+    def stats(self):
+        return {
+            "questions": self.questions,
+            "messages": len(self.messages),
+            "context_tokens": self.estimated_tokens(),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "memo_entries": len(self._memo),
+            "memo_hits": self.memo_hits,
+            "compactions": self.compactions,
+        }
+
+
+def _estimate(message):
+    """估计一条消息的 token 数（使用分块的分词器，与模型的计数不完全一致）"""
+    text = (message.get("content") or "") + (message.get("reasoning_content") or "")
+    for call in message.get("tool_calls") or []:
+        text += call["function"]["name"] + call["function"]["arguments"]
+    return chunking.token_length(text) + 4 if text else 4
@@ -0,0 +1,183 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from tools import settings, tracing
+
+# 嵌入缓存默认存放在数据库目录旁边，重置数据库时不会被一起删除
+DEFAULT_CACHE_PATH = settings.get("storage.embedding_cache_path")
+DEFAULT_MAX_ENTRIES = settings.get("embedding.cache_max_entries")
+
+# SQLite 单条语句的参数个数有限制，批量查询时按此大小分组
+_SQL_BATCH = 500
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """归一化文本：去掉首尾空白并合并连续空白"""
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def model_id_from_path(model_path):
+    """从本地模型路径中取出模型目录名作为缓存的模型标识"""
+    parts = [p for p in re.split(r"[\\/]", model_path) if p]
+    return parts[-1] if parts else model_path
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带持久化缓存的嵌入函数包装器
+
+    以 (模型标识, 归一化文本哈希) 为键把向量以 float32 形式存入 SQLite，
+    命中缓存的文本不再经过模型；归一化只用于缓存键，送入模型的仍是原文。
+    超过 max_entries 时按最近访问时间淘汰。
+    """
+
+    def __init__(self, embeddings, model_id, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # 条目数的上界估计：打开时统计一次，之后累加写入数，超过上限时才重新统计
+        self._entries = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _key(self, kind, text):
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{self.model_id}:{kind}:{digest}"
+
+    def _lookup(self, keys):
+        conn = self._connect()
+        found = {}
+        for i in range(0, len(keys), _SQL_BATCH):
+            batch = keys[i:i + _SQL_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[key] = vector.tolist()
+        if found:
+            now = time.time()
+            with conn:
+                conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        return found
+
+    def _store(self, items):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items],
+            )
+        with self._lock:
+            if self._entries is None:
+                self._entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            else:
+                # 覆盖已有的键也计入，估计值只会偏大
+                self._entries += len(items)
+            if self._entries <= self.max_entries:
+                return
+            self._entries = self._evict(conn)
+
+    def _evict(self, conn):
+        """按最近访问时间淘汰到上限的 90%，返回淘汰后的条目数"""
+        count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return count
+        # 一次多淘汰 10%，之后要再写入约 10% 的条目才会再次统计和淘汰
+        excess = count - int(self.max_entries * 0.9)
+        with conn:
+            conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                (excess,),
+            )
+        return count - excess
+
+    def _embed(self, texts, kind):
+        if not texts:
+            return []
+        keys = [self._key(kind, t) for t in texts]
+        found = self._lookup(list(set(keys)))
+
+        # 未命中的文本去重后一次性批量送入模型
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            missing_texts = list(missing.values())
+            with tracing.span("embed.model", items=len(missing_texts), kind=kind):
+                if kind == "query" and len(missing_texts) == 1:
+                    vectors = [self.embeddings.embed_query(missing_texts[0])]
+                else:
+                    vectors = self.embeddings.embed_documents(missing_texts)
+            new_items = list(zip(missing.keys(), vectors))
+            self._store(new_items)
+            found.update(new_items)
+
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        tracing.add(cache_hits=len(texts) - len(missing), cache_misses=len(missing))
+        return [list(found[key]) for key in keys]
+
+    def embed_documents(self, texts):
+        return self._embed(list(texts), "doc")
+
+    def embed_query(self, text):
+        return self._embed([text], "query")[0]
+
+    def embed_queries(self, texts):
+        """
+        批量计算查询向量，未命中的查询一次性送入模型
+
+        要求模型对查询和文档使用相同的编码方式（默认的 bge 配置即是如此）
+        """
+        return self._embed(list(texts), "query")
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        entries = self._connect().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
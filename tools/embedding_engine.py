@@ -0,0 +1,442 @@
+"""
+CPU 嵌入推理引擎：长度分桶、自动批大小、固定线程数，以及可选的 ONNX Runtime / int8 量化推理
+
+- 输入先按 token 长度排序，长度相近的文本组成一批，每批只补齐到该批最长的长度，减少无效的填充计算
+- 每批同时受条数上限和 token 总数上限约束，短文本自动组成更大的批次
+- batch_size 为 "auto" 时，首次遇到足够多的输入会用这些输入测量几种批大小的吞吐量并选出最快的
+- 后端：torch（fp32）、int8（PyTorch 动态 int8 量化）、onnx（ONNX Runtime fp32）、onnx-int8（ONNX Runtime 动态 int8 量化）
+- 池化方式和是否归一化读取自 sentence-transformers 的模型配置，与 HuggingFaceEmbeddings 得到的向量一致
+
+非 fp32 后端在导出或 validate 时与 fp32 参考向量比较余弦相似度，结果保存在模型目录下的
+onnx/validation.json 中；加载时只检查保存的结果，低于容差时退回 fp32 后端。
+
+用法：
+    python -m tools.embedding_engine export --model <模型目录>
+    python -m tools.embedding_engine validate --backend onnx-int8 --tolerance 0.99
+    python -m tools.embedding_engine bench --backend torch int8 onnx onnx-int8 --texts 512
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import threading
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+
+from tools import settings
+
+BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+
+# 推理线程数，默认使用全部 CPU 核心
+EMBED_THREADS = settings.get("embedding.threads") or os.cpu_count()
+
+# 每批的条数上限；auto 表示首次使用时自动测量
+EMBED_BATCH_SIZE = settings.get("embedding.batch_size")
+
+# 每批的 token 总数上限（批大小 × 该批最长长度），避免长文本批次占用过多内存
+EMBED_MAX_BATCH_TOKENS = settings.get("embedding.max_batch_tokens")
+
+# 非 fp32 后端与参考向量的最低余弦相似度
+EMBED_TOLERANCE = settings.get("embedding.tolerance")
+
+# 自动选择批大小时尝试的候选值，以及开始测量所需的最少输入数
+BATCH_SIZE_CANDIDATES = (8, 16, 32, 64, 128)
+AUTO_TUNE_MIN_TEXTS = 64
+
+ONNX_DIRNAME = "onnx"
+VALIDATION_FILENAME = "validation.json"
+
+# 校验使用的样例文本，覆盖中英文和不同长度
+VALIDATION_TEXTS = [
+    "如何配置嵌入模型的路径？",
+    "向量数据库把文档片段的向量持久化到本地磁盘，重启后无需重新导入。",
+    "The retrieval service batches concurrent query embeddings into a single forward pass.",
+    "检索增强生成先从知识库中找出与问题最相关的片段，再把它们交给大模型生成回答。" * 6,
+    "错误码 E1024 表示索引文件损坏，请运行 python -m tools.vector_store compact 重新构建。",
+    "量化",
+    "Chunks are packed by sentence boundaries and measured with the embedding model's tokenizer. " * 8,
+    "第一章 概述\n本手册介绍个人知识库管理助手的安装、配置和使用方法。",
+]
+
+
+def read_model_config(model_path):
+    """
+    读取 sentence-transformers 的模型配置：池化方式、是否归一化和最大长度
+
+    Returns:
+        dict: {"pooling": "cls" 或 "mean", "normalize": bool, "max_length": int}
+    """
+    config = {"pooling": "cls", "normalize": True, "max_length": 512}
+    modules_path = os.path.join(model_path, "modules.json")
+    if os.path.exists(modules_path):
+        with open(modules_path, encoding="utf-8") as f:
+            modules = json.load(f)
+        config["normalize"] = any(m.get("type", "").endswith("Normalize") for m in modules)
+        for module in modules:
+            if module.get("type", "").endswith("Pooling"):
+                pooling_path = os.path.join(model_path, module.get("path", ""), "config.json")
+                if os.path.exists(pooling_path):
+                    with open(pooling_path, encoding="utf-8") as f:
+                        pooling = json.load(f)
+                    config["pooling"] = "cls" if pooling.get("pooling_mode_cls_token") else "mean"
+    st_config_path = os.path.join(model_path, "sentence_bert_config.json")
+    if os.path.exists(st_config_path):
+        with open(st_config_path, encoding="utf-8") as f:
+            config["max_length"] = json.load(f).get("max_seq_length") or config["max_length"]
+    return config
+
+
+def onnx_path(model_path, quantized=False):
+    """ONNX 模型文件的默认位置：模型目录下的 onnx/ 子目录"""
+    return os.path.join(model_path, ONNX_DIRNAME, "model_int8.onnx" if quantized else "model.onnx")
+
+
+def validation_path(model_path):
+    """保存各后端校验结果的文件，与导出的 ONNX 模型放在一起"""
+    return os.path.join(model_path, ONNX_DIRNAME, VALIDATION_FILENAME)
+
+
+def _fingerprint(model_path, backend):
+    # ONNX 模型重新导出后，之前的校验结果作废
+    if backend in ("onnx", "onnx-int8"):
+        path = onnx_path(model_path, quantized=backend == "onnx-int8")
+        if os.path.exists(path):
+            stat = os.stat(path)
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+
+def load_validation(model_path, backend):
+    """返回保存的校验结果，没有保存或模型文件已变化时返回 None"""
+    path = validation_path(model_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            result = json.load(f).get(backend)
+    except (OSError, ValueError):
+        return None
+    if not result or result.get("fingerprint") != _fingerprint(model_path, backend):
+        return None
+    return result
+
+
+def save_validation(model_path, results):
+    """把 {后端: 校验结果} 合并写入 validation.json；模型目录不可写时只打印提示"""
+    path = validation_path(model_path)
+    try:
+        saved = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+        for backend, result in results.items():
+            saved[backend] = dict(result, fingerprint=_fingerprint(model_path, backend))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(saved, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 无法保存嵌入后端的校验结果: {e}")
+
+
+def export_onnx(model_path, output_path=None, quantize=True):
+    """
+    把模型导出为 ONNX，并可选地生成动态 int8 量化版本
+
+    Returns:
+        str: fp32 ONNX 文件路径
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    output_path = output_path or onnx_path(model_path)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModel.from_pretrained(model_path).eval()
+    sample = tokenizer(["导出示例", "export sample text"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    class _Wrapper(torch.nn.Module):
+        # 以关键字参数调用模型，不依赖 forward 的参数顺序
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)))[0]
+
+    # 新版 PyTorch 默认使用 dynamo 导出器，这里固定使用支持 dynamic_axes 的 TorchScript 导出器
+    extra = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    print(f"正在导出 ONNX 模型: {output_path}")
+    with torch.inference_mode():
+        torch.onnx.export(
+            _Wrapper(model), tuple(sample[name] for name in input_names), output_path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=17, **extra,
+        )
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantized_path = os.path.join(os.path.dirname(output_path), "model_int8.onnx")
+        print(f"正在生成 int8 量化模型: {quantized_path}")
+        quantize_dynamic(output_path, quantized_path, weight_type=QuantType.QInt8)
+    return output_path
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    按长度分桶、批量推理的嵌入模型
+
+    Args:
+        model_path (str): 本地模型目录（transformers 格式）
+        backend (str): torch、int8、onnx 或 onnx-int8
+        batch_size (int | str): 每批条数上限，"auto" 时首次使用自动测量
+        max_batch_tokens (int): 每批 token 总数上限
+        threads (int): 推理线程数
+    """
+
+    def __init__(self, model_path, backend="torch", batch_size=EMBED_BATCH_SIZE,
+                 max_batch_tokens=EMBED_MAX_BATCH_TOKENS, threads=EMBED_THREADS):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unsupported embedding backend: {backend}")
+        from transformers import AutoTokenizer
+
+        self.model_path = model_path
+        self.backend = backend
+        self.batch_size = None if batch_size == "auto" else int(batch_size)
+        self.max_batch_tokens = max_batch_tokens
+        self.threads = threads
+        self.config = read_model_config(model_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        # 快速分词器不支持多线程同时调用
+        self._tokenizer_lock = threading.Lock()
+        self._tune_lock = threading.Lock()
+        self._session = None
+        self._model = None
+        self._load()
+
+    def _load(self):
+        if self.backend in ("onnx", "onnx-int8"):
+            import onnxruntime as ort
+            path = onnx_path(self.model_path, quantized=self.backend == "onnx-int8")
+            if not os.path.exists(path):
+                export_onnx(self.model_path, onnx_path(self.model_path), quantize=self.backend == "onnx-int8")
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.threads
+            options.inter_op_num_threads = 1
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self._input_names = {i.name for i in self._session.get_inputs()}
+        else:
+            import torch
+            from transformers import AutoModel
+            torch.set_num_threads(self.threads)
+            model = AutoModel.from_pretrained(self.model_path).eval()
+            if self.backend == "int8":
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self._model = model
+        print(f"嵌入引擎已加载: {self.model_path}（{self.backend}，{self.threads} 线程）")
+
+    def _forward(self, features):
+        """对一批已补齐的输入执行前向计算，返回池化（并归一化）后的向量"""
+        mask = features["attention_mask"]
+        if self._session is not None:
+            feed = {name: value.astype(np.int64) for name, value in features.items() if name in self._input_names}
+            hidden = self._session.run(None, feed)[0]
+        else:
+            import torch
+            with torch.inference_mode():
+                hidden = self._model(**{name: torch.from_numpy(value) for name, value in features.items()})[0].numpy()
+        if self.config["pooling"] == "cls":
+            vectors = hidden[:, 0]
+        else:
+            weights = mask[..., None].astype(hidden.dtype)
+            vectors = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+        if self.config["normalize"]:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.astype(np.float32)
+
+    def _tokenize(self, texts):
+        with self._tokenizer_lock:
+            return self.tokenizer(list(texts), truncation=True, max_length=self.config["max_length"])
+
+    def _batches(self, lengths, batch_size):
+        """按长度从长到短排序后切成批次，每批同时受条数和 token 总数约束"""
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+        batch = []
+        for index in order:
+            # 排序后第一个元素就是该批最长的
+            longest = lengths[batch[0]] if batch else lengths[index]
+            if batch and (len(batch) >= batch_size or (len(batch) + 1) * longest > self.max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(int(index))
+        if batch:
+            yield batch
+
+    def _encode(self, encoded, batch_size):
+        count = len(encoded["input_ids"])
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        vectors = [None] * count
+        for batch in self._batches(lengths, batch_size):
+            with self._tokenizer_lock:
+                features = self.tokenizer.pad(
+                    {name: [encoded[name][i] for i in batch] for name in encoded.keys()},
+                    return_tensors="np",
+                )
+            for i, vector in zip(batch, self._forward(dict(features))):
+                vectors[i] = vector
+        return vectors
+
+    def tune_batch_size(self, texts, candidates=BATCH_SIZE_CANDIDATES):
+        """
+        用给定文本测量每个候选批大小的吞吐量，选出最快的一个；吞吐量明显下降后不再尝试更大的批
+        """
+        sample = list(texts[:max(candidates) * 2])
+        encoded = self._tokenize(sample)
+        self._encode(encoded, candidates[0])  # 预热
+        best, best_rate = candidates[0], 0.0
+        for candidate in candidates:
+            started = time.perf_counter()
+            self._encode(encoded, candidate)
+            rate = len(sample) / (time.perf_counter() - started)
+            if rate > best_rate:
+                best, best_rate = candidate, rate
+            elif rate < best_rate * 0.9:
+                break
+        self.batch_size = best
+        print(f"嵌入批大小已自动设为 {best}（{best_rate:.1f} 条/秒）")
+        return best
+
+    def encode(self, texts):
+        """计算一组文本的向量，返回 float32 数组，顺序与输入一致"""
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.batch_size is None and len(texts) >= AUTO_TUNE_MIN_TEXTS:
+            with self._tune_lock:
+                if self.batch_size is None:
+                    self.tune_batch_size(texts)
+        batch_size = self.batch_size or BATCH_SIZE_CANDIDATES[2]
+        return np.stack(self._encode(self._tokenize(texts), batch_size))
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+def validate(candidate, reference, texts=VALIDATION_TEXTS, tolerance=EMBED_TOLERANCE):
+    """
+    比较两个嵌入模型对同一组文本的向量
+
+    Returns:
+        dict: {"min_cosine", "mean_cosine", "passed"}
+    """
+    a = np.asarray(candidate.embed_documents(texts), dtype=np.float32)
+    b = np.asarray(reference.embed_documents(texts), dtype=np.float32)
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return {
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "passed": bool(cosine.min() >= tolerance),
+    }
+
+
+def validate_backends(model_path, backends, tolerance=EMBED_TOLERANCE, engines=None, **options):
+    """
+    用同一个 fp32 参考模型校验多个后端，并保存结果供加载时使用
+
+    Args:
+        engines (dict): 已经加载的 {后端: 引擎}，避免重复加载
+
+    Returns:
+        dict: 后端 -> {"min_cosine", "mean_cosine", "passed"}
+    """
+    engines = dict(engines or {})
+    reference = engines.get("torch") or EmbeddingEngine(model_path, "torch", **options)
+    results = {}
+    for backend in backends:
+        engine = engines.get(backend) or EmbeddingEngine(model_path, backend, **options)
+        results[backend] = validate(engine, reference, tolerance=tolerance)
+    save_validation(model_path, {backend: r for backend, r in results.items() if backend != "torch"})
+    return results
+
+
+def load_engine(model_path, backend="torch", tolerance=EMBED_TOLERANCE, **options):
+    """
+    加载嵌入引擎；非 fp32 后端检查导出或 validate 时保存的校验结果（没有保存时校验一次并保存），
+    不满足容差时退回 fp32 后端
+    """
+    engine = EmbeddingEngine(model_path, backend, **options)
+    if backend == "torch" or tolerance is None:
+        return engine
+    result = load_validation(model_path, backend)
+    if result is None:
+        print(f"{backend} 后端没有保存的校验结果，正在与 fp32 参考向量比较...")
+        result = validate_backends(model_path, [backend], tolerance, engines={backend: engine}, **options)[backend]
+    if result["min_cosine"] >= tolerance:
+        print(f"{backend} 后端校验通过（最低余弦相似度 {result['min_cosine']:.4f}）")
+        return engine
+    print(f"⚠️ {backend} 后端的最低余弦相似度 {result['min_cosine']:.4f} 低于 {tolerance}，改用 fp32 后端")
+    return EmbeddingEngine(model_path, "torch", **options)
+
+
+def main(argv=None):
+    from tools.registry import EMBEDDING_MODEL_PATH
+
+    parser = argparse.ArgumentParser(description="CPU 嵌入推理引擎")
+    parser.add_argument("command", choices=["export", "validate", "bench"],
+                        help="export: 导出 ONNX 模型并校验；validate: 与 fp32 参考向量比较并保存结果；bench: 测量吞吐量")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_PATH, help="本地模型目录")
+    parser.add_argument("--backend", nargs="+", default=["onnx-int8"], choices=BACKENDS, help="要校验或测量的后端")
+    parser.add_argument("--tolerance", type=float, default=EMBED_TOLERANCE, help="最低余弦相似度")
+    parser.add_argument("--texts", type=int, default=512, help="bench 使用的文本数")
+    parser.add_argument("--batch-size", default=EMBED_BATCH_SIZE, help="每批条数上限，auto 自动测量")
+    parser.add_argument("--threads", type=int, default=EMBED_THREADS, help="推理线程数")
+    args = parser.parse_args(argv)
+
+    if args.command in ("export", "validate"):
+        if args.command == "export":
+            export_onnx(args.model)
+            backends = ["onnx", "onnx-int8"]
+        else:
+            backends = args.backend
+        # 校验结果保存在模型目录中，服务启动时不再重复校验
+        results = validate_backends(args.model, backends, args.tolerance,
+                                    batch_size=args.batch_size, threads=args.threads)
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return 0 if all(r["passed"] for r in results.values()) else 1
+
+    reference = EmbeddingEngine(args.model, "torch", batch_size=args.batch_size, threads=args.threads)
+    results = {}
+
+    texts = [VALIDATION_TEXTS[i % len(VALIDATION_TEXTS)] + f" {i}" for i in range(args.texts)]
+    for backend in args.backend:
+        engine = reference if backend == "torch" else EmbeddingEngine(
+            args.model, backend, batch_size=args.batch_size, threads=args.threads)
+        engine.embed_documents(texts[:AUTO_TUNE_MIN_TEXTS])  # 预热并确定批大小
+        started = time.perf_counter()
+        engine.embed_documents(texts)
+        elapsed = time.perf_counter() - started
+        results[backend] = {
+            "texts_per_s": len(texts) / elapsed,
+            "batch_size": engine.batch_size,
+            **validate(engine, reference, tolerance=args.tolerance),
+        }
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+import hashlib
+import math
+
+from langchain_core.embeddings import Embeddings
+
+from tools.lexical_index import tokenize
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    基于特征哈希的轻量嵌入模型，无需下载模型、不依赖网络
+
+    把分词结果哈希到固定维度并做 L2 归一化，相同词汇越多的文本向量越接近。
+    只用于基准测试和离线测试，不能替代真实的语义模型。
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for token in tokenize(text):
+            digest = hashlib.md5(token.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
@@ -3,14 +3,22 @@ import uuid
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader, UnstructuredMarkdownLoader
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
 import shutil
 
-def ingest_docs(file_path, collection_name="knowledge_base", source_filename=None):
-    print(f"正在处理文档: {file_path}")
+from tools import settings
+from tools.registry import get_client, get_embeddings, get_store, invalidate
+from tools import manifest, lexical_index, chunking, tracing, answer_cache
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt', '.docx', '.md')
+
+def get_loader(file_path):
+    """
+    根据文件扩展名返回对应的文档加载器
+
+    langchain_community 的导入开销较大，只在真正加载文件时导入
+    """
+    from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+
     if file_path.endswith('.pdf'):
         print("正在加载PDF文件...")
         try:
@@ -37,163 +45,323 @@ def ingest_docs(file_path, collection_name="knowledge_base", source_filename=Non
         print("正在加载Markdown文件...")
         
         try:
-            loader = UnstructuredMarkdownLoader(file_path)
+            # 读取原始文本，保留标题层级供分块使用
+            loader = TextLoader(file_path, encoding='utf-8')
         except Exception as e:
             print(f"加载Markdown文件时出错: {e}")
             raise
     else:
         raise ValueError(f"Unsupported file type: {file_path}")
-    print(f"已加载 {len(loader.load())} 个文档片段")
-    documents = loader.load()
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    docs = text_splitter.split_documents(documents)
-    
+    return loader
+
+# 流式导入时每批写入的片段数，峰值内存由它而不是文件大小决定
+DEFAULT_BATCH_SIZE = settings.get("ingestion.batch_size")
+
+def iter_chunks(file_path, source_filename=None, on_page=None):
+    """
+    逐页加载并分块文件，以生成器形式产出带 source_file 元数据的文档片段
+
+    加载器通过 lazy_load() 每次只产出一页，整个文件不会同时驻留在内存中；
+    分块策略按文件格式选择（见 tools.chunking）；on_page 在每解析完一页时被调用
+    """
+    loader = get_loader(file_path)
+    strategy = chunking.strategy_for(file_path)
     # 为每个文档添加源文件元数据，使用完整的文件名
     source_filename = source_filename or os.path.basename(file_path)  # 提取文件名
-    print(f"为文档片段添加源文件元数据: {source_filename}")
-    for doc in docs:
-        doc.metadata['source_file'] = source_filename  # 使用完整的文件名而不是路径
-    
+    pages = iter(loader.lazy_load())
+    while True:
+        # span 只包住加载和分块本身，不跨越 yield
+        with tracing.span("ingest.load", file=source_filename) as s:
+            page = next(pages, None)
+            s.set(pages=0 if page is None else 1)
+        if page is None:
+            return
+        if on_page:
+            on_page()
+        with tracing.span("ingest.split", file=source_filename, strategy=strategy) as s:
+            chunks = chunking.chunk_page(page, strategy, source_filename)
+            s.set(chunks=len(chunks))
+        yield from chunks
+
+def split_file(file_path, source_filename=None):
+    """
+    加载并分块单个文件，返回带 source_file 元数据的文档片段列表
+
+    该函数是模块级函数，可以直接提交到进程池中执行
+    """
+    docs = list(iter_chunks(file_path, source_filename))
     print(f"已分块 {len(docs)} 个文档片段")
-    # 初始化嵌入模型
-    embeddings = HuggingFaceEmbeddings(
-        model_name=r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"
-    )
-    
-    # 创建Chroma向量数据库实例
-    vectorstore = Chroma(
-        collection_name=collection_name,
-        embedding_function=embeddings,
-        persist_directory="./db_storage"  # 持久化到本地目录
-    )
+    return docs
+
+def _batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def record_written(collection_name, source_filename, ids, docs, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    片段写入向量数据库后，同步更新文件清单和关键词索引，并递增集合版本号
+    """
+    manifest.add_chunk_ids(collection_name, source_filename, ids, persist_directory)
+    lexical_index.add_documents(collection_name, ids, docs, persist_directory)
+    manifest.bump_version(collection_name, persist_directory)
+
+def record_deleted(collection_name, source_filename, ids, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    片段从向量数据库删除后，同步更新文件清单、关键词索引和答案缓存，并递增集合版本号
+    """
+    manifest.remove_chunk_ids(collection_name, source_filename, ids, persist_directory)
+    lexical_index.delete_ids(collection_name, ids, persist_directory)
+    answer_cache.invalidate_chunks(collection_name, ids, persist_directory)
+    manifest.bump_version(collection_name, persist_directory)
+
+def get_existing_ids(store, collection_name, source_filename, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    返回某个文件当前已写入的片段ID集合
+    """
+    existing = manifest.get_chunk_ids(collection_name, source_filename, persist_directory)
+    if existing is None:
+        # 没有清单记录（旧版本导入的数据），从数据库中取回该文件已有的ID
+        existing = set(store.get_ids(where={"source_file": source_filename}))
+    return existing
+
+def plan_upsert(store, collection_name, source_filename, docs, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    比较文件清单，计算 upsert 需要新增和删除的片段
+
+    Returns:
+        tuple: (全部片段ID, 需要新增的 (ID, 片段) 列表, 需要删除的过期ID列表)
+    """
+    ids = manifest.chunk_ids_for(source_filename, docs)
+    existing = get_existing_ids(store, collection_name, source_filename, persist_directory)
+    stale_ids = list(existing - set(ids))
+    added = [(i, doc) for i, doc in zip(ids, docs) if i not in existing]
+    return ids, added, stale_ids
+
+class IngestionCancelled(Exception):
+    """导入被取消；已写入的批次保留在数据库中，重新导入同一文件时从断点继续"""
+
+
+def ingest_docs(file_path, collection_name="knowledge_base", source_filename=None, persist_directory=settings.PERSIST_DIRECTORY, mode="upsert", batch_size=DEFAULT_BATCH_SIZE, progress_callback=None):
+    """
+    加载、分块并把文档写入向量数据库
+
+    页面以流的形式经过分块、嵌入和写入，每次只处理 batch_size 个片段
+
+    Args:
+        file_path (str): 文档路径
+        collection_name (str): 集合名称
+        source_filename (str): 写入元数据的源文件名，默认取 file_path 的文件名
+        persist_directory (str): 持久化目录
+        mode (str): "upsert" 使用确定性片段ID，只写入新增片段并删除过期片段；
+            "append" 为每个片段生成随机ID直接追加
+        batch_size (int): 每批嵌入和写入的片段数
+        progress_callback (callable): 接收进度字典（pages_parsed、chunks_parsed、chunks_embedded、
+            chunks_written、chunks_unchanged）的回调；回调抛出 IngestionCancelled 可中止导入
+    """
+    if mode not in ("upsert", "append"):
+        raise ValueError(f"Unsupported ingest mode: {mode}")
+    source_filename = source_filename or os.path.basename(file_path)
+    with tracing.span("ingest.file", file=source_filename, collection=collection_name, mode=mode) as s:
+        store, total, added_count = _ingest(
+            file_path, collection_name, source_filename, persist_directory, mode, batch_size, progress_callback
+        )
+        s.set(chunks=total, items=added_count)
+    print(f"成功将 {added_count} 个新增文档片段添加到向量数据库中（未变化 {total - added_count} 个）")
+    return store
+
+def _ingest(file_path, collection_name, source_filename, persist_directory, mode, batch_size, progress_callback):
+    print(f"正在处理文档: {file_path}")
+    print(f"为文档片段添加源文件元数据: {source_filename}")
+
+    # 获取共享的向量存储和嵌入模型（嵌入模型在进程内只加载一次）
+    store = get_store(collection_name, persist_directory)
+    embeddings = get_embeddings()
     print("正在将文档添加到向量数据库中...")
-    # 为文档生成唯一ID并添加到向量数据库
-    ids = [str(uuid.uuid4()) for _ in docs]  # 为每个文档片段生成唯一ID
-    vectorstore.add_documents(documents=docs, ids=ids)
-    
-    print(f"成功将 {len(docs)} 个文档片段添加到向量数据库中")
-    return vectorstore
 
-def clear_vector_db(collection_name="knowledge_base", persist_directory="./db_storage"):
+    # upsert：按 (源文件, 片段内容) 生成确定性ID，与清单比较后只处理差异
+    existing = set()
+    if mode == "upsert":
+        existing = get_existing_ids(store, collection_name, source_filename, persist_directory)
+    seen = {}
+    all_ids = set()
+    total = added_count = 0
+    progress = {"pages_parsed": 0, "chunks_parsed": 0, "chunks_embedded": 0, "chunks_written": 0, "chunks_unchanged": 0}
+
+    def report():
+        if progress_callback:
+            progress_callback(dict(progress))
+
+    def on_page():
+        progress["pages_parsed"] += 1
+
+    try:
+        for batch in _batched(iter_chunks(file_path, source_filename, on_page), batch_size):
+            if mode == "append":
+                # 为每个文档片段生成随机ID并直接追加
+                ids = [str(uuid.uuid4()) for _ in batch]
+            else:
+                ids = manifest.chunk_ids_for(source_filename, batch, seen)
+            all_ids.update(ids)
+            added = [(i, doc) for i, doc in zip(ids, batch) if i not in existing]
+            progress["chunks_parsed"] += len(batch)
+            progress["chunks_unchanged"] += len(batch) - len(added)
+            report()
+            if added:
+                added_ids = [i for i, _ in added]
+                added_docs = [doc for _, doc in added]
+                texts = [doc.page_content for doc in added_docs]
+                with tracing.span("ingest.embed", items=len(texts)):
+                    vectors = embeddings.embed_documents(texts)
+                progress["chunks_embedded"] += len(added)
+                report()
+                with tracing.span("store.write", items=len(added_ids), backend=store.backend):
+                    store.add(added_ids, vectors, texts, [doc.metadata for doc in added_docs])
+                # 每批写入后立即记入清单，中断后重新导入时不会重复嵌入
+                with tracing.span("ingest.catalog", items=len(added_ids)):
+                    record_written(collection_name, source_filename, added_ids, added_docs, persist_directory)
+                progress["chunks_written"] += len(added)
+                report()
+            total += len(batch)
+            added_count += len(added)
+            print(f"已处理 {total} 个文档片段，新增 {added_count} 个")
+
+        stale_ids = list(existing - all_ids)
+        if stale_ids:
+            store.delete(stale_ids)
+            record_deleted(collection_name, source_filename, stale_ids, persist_directory)
+            print(f"已删除 {len(stale_ids)} 个过期的文档片段")
+        if mode == "upsert":
+            manifest.add_chunk_ids(collection_name, source_filename, list(all_ids), persist_directory)
+    finally:
+        # 中途取消或出错时也保存已写入的批次
+        with tracing.span("store.flush", backend=store.backend):
+            store.flush()
+    manifest.record_file(collection_name, source_filename, *manifest.file_digest(file_path), persist_directory)
+    return store, total, added_count
+
+def clear_vector_db(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY):
     """
     清除指定集合中的所有文档
     """
     print(f"正在清除集合 '{collection_name}' 中的所有数据...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name=r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"
-    )
+    store = get_store(collection_name, persist_directory)
     
-    # 创建Chroma向量数据库实例
-    vectorstore = Chroma(
-        collection_name=collection_name,
-        embedding_function=embeddings,
-        persist_directory=persist_directory
-    )
+    doc_count = store.count()
     
-    # 获取所有文档ID
-    all_docs = vectorstore.get()
-    doc_ids = all_docs['ids']
-    
-    if len(doc_ids) > 0:
+    if doc_count > 0:
         # 删除所有文档
-        vectorstore._collection.delete(ids=doc_ids)
-        print(f"已删除 {len(doc_ids)} 个文档")
+        store.clear()
+        invalidate(persist_directory, collection_name)
+        store = get_store(collection_name, persist_directory)
+        print(f"已删除 {doc_count} 个文档")
     else:
         print("集合中没有文档需要删除")
+    manifest.drop_collection(collection_name, persist_directory)
+    lexical_index.clear_collection(collection_name, persist_directory)
+    answer_cache.drop_collection(collection_name, persist_directory)
+    manifest.bump_version(collection_name, persist_directory)
     
     # 如果集合为空，可以考虑删除整个集合
-    count = vectorstore._collection.count()
+    count = store.count()
     print(f"集合 '{collection_name}' 中剩余 {count} 个文档")
 
-def delete_collection(collection_name="knowledge_base", persist_directory="./db_storage"):
+def delete_collection(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY):
     """
     删除整个集合
     """
     print(f"正在删除集合 '{collection_name}'...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name=r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"
-    )
-    
-    # 导入chromadb来操作集合
-    import chromadb
-    from chromadb.config import Settings
-    
-    # 创建客户端
-    client = chromadb.PersistentClient(path=persist_directory)
+    store = get_store(collection_name, persist_directory)
     
     try:
-        # 尝试获取集合，如果存在则删除
-        collection = client.get_collection(name=collection_name)
-        client.delete_collection(name=collection_name)
+        # 删除集合中的全部数据，后端会保留一个同名的空集合以保持结构一致
+        store.clear()
         print(f"集合 '{collection_name}' 已被删除")
     except Exception as e:
         print(f"集合 '{collection_name}' 不存在或删除失败: {e}")
-        
-    # 重新创建空集合，保持结构一致
-    client.create_collection(name=collection_name)
+    # 让该集合已缓存的句柄失效
+    invalidate(persist_directory, collection_name)
+    manifest.drop_collection(collection_name, persist_directory)
+    lexical_index.clear_collection(collection_name, persist_directory)
+    answer_cache.drop_collection(collection_name, persist_directory)
+    manifest.bump_version(collection_name, persist_directory)
     print(f"已重新创建空集合 '{collection_name}'")
 
-def reset_full_database(persist_directory="./db_storage"):
+def reset_full_database(persist_directory=settings.PERSIST_DIRECTORY):
     """
     完全重置数据库，删除整个数据库目录并重新创建
     """
+    # 先释放缓存的客户端和集合句柄，否则删除目录后仍会持有旧的文件句柄
+    invalidate(persist_directory)
     if os.path.exists(persist_directory):
         shutil.rmtree(persist_directory)
         print(f"数据库目录 '{persist_directory}' 已被完全删除")
     else:
         print(f"数据库目录 '{persist_directory}' 不存在")
     
-    # 测试重新初始化 - 创建一个临时的Chroma实例来创建目录
-    embeddings = HuggingFaceEmbeddings(
-        model_name=r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"
-    )
-    
-    # 创建一个临时实例以初始化数据库目录
-    temp_vectorstore = Chroma(
-        collection_name="temp",
-        embedding_function=embeddings,
-        persist_directory=persist_directory
-    )
+    # 重新初始化 - 创建一个临时集合来创建目录（无需加载嵌入模型）
+    get_client(persist_directory).get_or_create_collection(name="temp")
     print(f"数据库目录 '{persist_directory}' 已重新初始化")
 
-def delete_by_source_file(source_file, collection_name="knowledge_base", persist_directory="./db_storage"):
+def rebuild_catalog(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY, batch_size=1000):
+    """
+    扫描一次向量数据库，为启用文件目录之前导入的集合重建文件清单和文件目录
+
+    旧数据没有原始文件，目录中的大小和内容哈希为空
+    """
+    print(f"正在重建集合 '{collection_name}' 的文件目录...")
+    store = get_store(collection_name, persist_directory)
+    ids_by_file = {}
+    for batch in store.iter_batches(batch_size, include_embeddings=False):
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            source_file = metadata.get("source_file")
+            if source_file:
+                ids_by_file.setdefault(source_file, []).append(chunk_id)
+    manifest.drop_collection(collection_name, persist_directory)
+    for source_file, ids in ids_by_file.items():
+        manifest.add_chunk_ids(collection_name, source_file, ids, persist_directory)
+    print(f"文件目录中共有 {len(ids_by_file)} 个文件")
+    return manifest.list_files(collection_name, persist_directory)
+
+def delete_by_source_file(source_file, collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY):
     """
     根据源文件名删除对应的向量数据
     
     Args:
-        source_file (str): 源文件名（可以是完整路径或仅文件名）
+        source_file (str): 导入时记录的源文件名，或文件的完整路径（按基本文件名匹配）
         collection_name (str): 集合名称
         persist_directory (str): 持久化目录
     """
     print(f"正在删除源文件 '{source_file}' 对应的向量数据...")
     
-    embeddings = HuggingFaceEmbeddings(
-        model_name=r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"
-    )
-    
-    # 创建Chroma向量数据库实例
-    vectorstore = Chroma(
-        collection_name=collection_name,
-        embedding_function=embeddings,
-        persist_directory=persist_directory
-    )
-    
-    # 获取源文件的基本文件名，用于匹配
-    source_filename = os.path.basename(source_file)
+    store = get_store(collection_name, persist_directory)
     
-    # 查询包含该源文件的所有文档
-    results = vectorstore.get(where={"source_file": source_filename})
-    doc_ids = results['ids']
+    # 批量导入目录时以相对路径（如 a/README.txt）作为源文件名，先按原样匹配，再按基本文件名匹配
+    source_filename = source_file
+    doc_ids = store.get_ids(where={"source_file": source_filename})
+    if not doc_ids and os.path.basename(source_file) != source_file:
+        source_filename = os.path.basename(source_file)
+        doc_ids = store.get_ids(where={"source_file": source_filename})
     
     if len(doc_ids) > 0:
         # 删除匹配的文档
-        vectorstore._collection.delete(ids=doc_ids)
+        store.delete(doc_ids)
+        store.flush()
         print(f"已删除 {len(doc_ids)} 个与文件 '{source_filename}' 相关的文档")
     else:
         print(f"没有找到与文件 '{source_filename}' 相关的文档")
+    manifest.drop_file(collection_name, source_filename, persist_directory)
+    lexical_index.delete_source_file(collection_name, source_filename, persist_directory)
+    answer_cache.invalidate_chunks(collection_name, doc_ids, persist_directory)
+    manifest.bump_version(collection_name, persist_directory)
     
     # 统计集合中剩余文档数量
-    count = vectorstore._collection.count()
+    count = store.count()
     print(f"集合 '{collection_name}' 中剩余 {count} 个文档")
     
     return len(doc_ids)
@@ -0,0 +1,433 @@
+"""
+后台导入任务队列：任务保存在 SQLite 中，由工作线程池依次执行
+
+- 每个任务记录分阶段进度（已解析页数、已嵌入片段数、已写入片段数），界面可以随时轮询
+- 排队中的任务可以直接取消，运行中的任务在当前批次写入后停止
+- 任务运行期间由单独的线程定期写心跳；领取任务的进程退出后（同一主机上按进程号判断，
+  其他主机上按心跳超时判断），任务会重新排队；导入按批次写入清单，重新执行时跳过已写入的片段
+
+用法：
+    python -m tools.jobs worker --workers 2
+    python -m tools.jobs submit ./docs/手册.pdf --collection knowledge_base
+    python -m tools.jobs list
+    python -m tools.jobs cancel <任务ID>
+    python -m tools.jobs retry <任务ID>
+"""
+import os
+import sys
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import argparse
+import threading
+from contextlib import closing
+
+from tools import settings
+from tools.ingestion import ingest_docs, IngestionCancelled
+
+JOBS_FILENAME = "jobs.sqlite3"
+UPLOADS_DIRNAME = "uploads"
+
+# 每个进程中执行导入任务的线程数
+DEFAULT_WORKERS = settings.get("ingestion.job_workers")
+
+# 运行中的任务超过这么多秒没有心跳，视为所在进程已崩溃
+STALE_SECONDS = settings.get("ingestion.job_stale_seconds")
+
+# 心跳线程写入心跳的间隔（秒），与导入进度无关，加载模型等长时间没有进度的阶段也会按时写入
+HEARTBEAT_INTERVAL = min(10.0, STALE_SECONDS / 3)
+
+# 进度写入数据库的最小间隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+_COLUMNS = (
+    "id", "collection", "source_file", "file_path", "status", "cancel_requested",
+    "pages_parsed", "chunks_parsed", "chunks_embedded", "chunks_written", "chunks_unchanged",
+    "attempts", "error", "created_at", "started_at", "finished_at", "heartbeat",
+)
+
+
+# 已经建好表的数据库文件，避免每次连接都执行建表语句
+_initialized = set()
+
+_HOST = socket.gethostname()
+# 本进程的标识：主机名、进程号和随机串（进程号被新进程复用时也能区分）
+WORKER_ID = f"{_HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _connect(persist_directory):
+    path = os.path.abspath(os.path.join(persist_directory, JOBS_FILENAME))
+    if path in _initialized and os.path.exists(path):
+        return sqlite3.connect(path, timeout=30)
+    os.makedirs(persist_directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id TEXT PRIMARY KEY, collection TEXT NOT NULL, source_file TEXT NOT NULL, file_path TEXT NOT NULL, "
+        "status TEXT NOT NULL, cancel_requested INTEGER NOT NULL DEFAULT 0, "
+        "pages_parsed INTEGER NOT NULL DEFAULT 0, chunks_parsed INTEGER NOT NULL DEFAULT 0, "
+        "chunks_embedded INTEGER NOT NULL DEFAULT 0, chunks_written INTEGER NOT NULL DEFAULT 0, "
+        "chunks_unchanged INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, "
+        "error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL, heartbeat REAL, claim TEXT, "
+        "worker TEXT);"
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at);"
+    )
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if "worker" not in columns:
+        # 旧版本创建的任务表没有 worker 列
+        conn.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+    _initialized.add(path)
+    return conn
+
+
+def _row_to_job(row):
+    return dict(zip(_COLUMNS, row))
+
+
+def _worker_alive(worker):
+    """
+    判断领取任务的进程是否仍在运行
+
+    Returns:
+        bool | None: 无法判断（其他主机上的进程、旧版本没有记录进程的任务、Windows）时返回 None
+    """
+    if not worker:
+        return None
+    if worker == WORKER_ID:
+        return True
+    host, _, rest = worker.partition(":")
+    pid, _, _ = rest.partition(":")
+    # Windows 上 os.kill 会结束目标进程，不能用来探测
+    if host != _HOST or os.name == "nt" or not pid.isdigit():
+        return None
+    if int(pid) == os.getpid():
+        # 进程号相同但标识不同：本进程之前的一次运行（例如容器重启）
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return None
+    return True
+
+
+class JobQueue:
+    """
+    持久化的导入任务队列和工作线程池
+
+    多个进程可以共用同一个持久化目录：领取任务是单条 UPDATE 语句，同一任务只会被一个工作线程执行
+    """
+
+    def __init__(self, persist_directory=settings.PERSIST_DIRECTORY, workers=DEFAULT_WORKERS):
+        self.persist_directory = persist_directory
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    # ---- 任务管理 ----
+
+    def submit(self, file_path, collection_name="knowledge_base", source_filename=None):
+        """
+        提交导入任务，文件会被复制到持久化目录中，调用方可以随即删除原文件；
+        副本在任务成功后删除
+
+        Returns:
+            str: 任务ID
+        """
+        job_id = uuid.uuid4().hex
+        source_filename = source_filename or os.path.basename(file_path)
+        uploads = os.path.join(self.persist_directory, UPLOADS_DIRNAME)
+        os.makedirs(uploads, exist_ok=True)
+        stored_path = os.path.join(uploads, job_id + os.path.splitext(source_filename)[1].lower())
+        shutil.copyfile(file_path, stored_path)
+        with closing(_connect(self.persist_directory)) as conn, conn:
+            conn.execute(
+                "INSERT INTO jobs (id, collection, source_file, file_path, status, created_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, collection_name, source_filename, stored_path, time.time()),
+            )
+        print(f"已提交导入任务 {job_id}: {source_filename}")
+        return job_id
+
+    def get(self, job_id):
+        """返回任务状态字典，不存在时返回 None"""
+        with closing(_connect(self.persist_directory)) as conn:
+            row = conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def list(self, collection_name=None, limit=50):
+        """按提交时间倒序返回任务列表"""
+        condition, params = ("WHERE collection = ?", (collection_name,)) if collection_name else ("", ())
+        with closing(_connect(self.persist_directory)) as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs {condition} ORDER BY created_at DESC LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def cancel(self, job_id):
+        """
+        取消任务：排队中的任务立即取消，运行中的任务在当前批次写入后停止
+
+        Returns:
+            bool: 任务是否仍处于可取消的状态
+        """
+        with closing(_connect(self.persist_directory)) as conn, conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            ).rowcount
+            requested = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,)
+            ).rowcount
+        return bool(cancelled or requested)
+
+    def retry(self, job_id):
+        """把失败或已取消的任务重新排队，导入会从最后写入的批次之后继续"""
+        job = self.get(job_id)
+        if job is None or job["status"] not in ("failed", "cancelled") or not os.path.exists(job["file_path"]):
+            return False
+        with closing(_connect(self.persist_directory)) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', cancel_requested = 0, error = NULL, finished_at = NULL "
+                "WHERE id = ?",
+                (job_id,),
+            )
+        return True
+
+    def _remove_upload(self, job_id):
+        job = self.get(job_id)
+        if job and os.path.exists(job["file_path"]):
+            os.remove(job["file_path"])
+
+    # ---- 工作线程 ----
+
+    def start(self):
+        """启动工作线程，重复调用无副作用"""
+        with self._lock:
+            if self._threads:
+                return self
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"ingest-job-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def shutdown(self, wait=True):
+        """停止领取新任务；运行中的任务会在下一个进度回调时被中断并重新排队"""
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _requeue_orphans(self, conn, now):
+        """
+        把所在进程已经退出的运行中任务重新排队
+
+        同一主机上的进程直接检查进程是否存在；无法判断时（其他主机等）以心跳超时为准。
+        进程仍在运行的任务即使很慢也不会被重新排队
+        """
+        rows = conn.execute("SELECT id, claim, worker, heartbeat FROM jobs WHERE status = 'running'").fetchall()
+        for job_id, claim, worker, heartbeat in rows:
+            alive = _worker_alive(worker)
+            if alive is False or (alive is None and (heartbeat or 0) < now - STALE_SECONDS):
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', claim = NULL, worker = NULL "
+                    "WHERE id = ? AND status = 'running' AND claim IS ?",
+                    (job_id, claim),
+                )
+
+    def _claim(self):
+        """领取最早的排队任务，并把所在进程已退出的运行中任务重新排队"""
+        claim = uuid.uuid4().hex
+        now = time.time()
+        with closing(_connect(self.persist_directory)) as conn, conn:
+            self._requeue_orphans(conn, now)
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', claim = ?, worker = ?, started_at = ?, heartbeat = ?, "
+                "attempts = attempts + 1 "
+                "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) "
+                "AND status = 'queued'",
+                (claim, WORKER_ID, now, now),
+            ).rowcount
+            if not claimed:
+                return None
+            row = conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE claim = ?", (claim,)).fetchone()
+        job = _row_to_job(row)
+        job["claim"] = claim
+        return job
+
+    def _heartbeat(self, job, finished, lost):
+        """在任务执行期间定期写入心跳；任务已被重新领取时设置 lost"""
+        while not finished.wait(HEARTBEAT_INTERVAL):
+            try:
+                with closing(_connect(self.persist_directory)) as conn, conn:
+                    updated = conn.execute(
+                        "UPDATE jobs SET heartbeat = ? WHERE id = ? AND claim = ?",
+                        (time.time(), job["id"], job["claim"]),
+                    ).rowcount
+            except Exception as e:
+                print(f"更新导入任务 {job['id']} 的心跳时出错: {e}")
+                continue
+            if not updated:
+                lost.set()
+                return
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"领取导入任务时出错: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(1.0)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        job_id = job["id"]
+        last_write = [0.0]
+        stopped_by_shutdown = [False]
+        finished = threading.Event()
+        lost = threading.Event()
+
+        def write_progress(conn, progress):
+            conn.execute(
+                "UPDATE jobs SET pages_parsed = ?, chunks_parsed = ?, chunks_embedded = ?, "
+                "chunks_written = ?, chunks_unchanged = ?, heartbeat = ? WHERE id = ? AND claim = ?",
+                (progress["pages_parsed"], progress["chunks_parsed"], progress["chunks_embedded"],
+                 progress["chunks_written"], progress["chunks_unchanged"], time.time(), job_id, job["claim"]),
+            )
+
+        def on_progress(progress):
+            if lost.is_set():
+                # 任务已被其他工作线程重新领取，停止执行
+                raise IngestionCancelled()
+            now = time.monotonic()
+            if now - last_write[0] < PROGRESS_INTERVAL:
+                return
+            last_write[0] = now
+            with closing(_connect(self.persist_directory)) as conn, conn:
+                write_progress(conn, progress)
+                cancel_requested = conn.execute(
+                    "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()[0]
+            if self._stop.is_set():
+                stopped_by_shutdown[0] = True
+                raise IngestionCancelled()
+            if cancel_requested:
+                raise IngestionCancelled()
+
+        final = {}
+
+        def record(progress):
+            final.update(progress)
+            on_progress(progress)
+
+        print(f"开始执行导入任务 {job_id}: {job['source_file']}（第 {job['attempts']} 次）")
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(job, finished, lost), name=f"ingest-job-heartbeat-{job_id[:8]}", daemon=True
+        )
+        heartbeat.start()
+        try:
+            ingest_docs(
+                job["file_path"], job["collection"], job["source_file"],
+                persist_directory=self.persist_directory, progress_callback=record,
+            )
+            status, error = "succeeded", None
+        except IngestionCancelled:
+            status, error = ("queued", None) if stopped_by_shutdown[0] else ("cancelled", None)
+        except Exception as e:
+            print(f"导入任务 {job_id} 失败: {e}")
+            status, error = "failed", str(e)
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        with closing(_connect(self.persist_directory)) as conn, conn:
+            if final:
+                # 进度写入有节流，结束前补写最后一次进度，再记录最终状态
+                write_progress(conn, final)
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, claim = NULL, worker = NULL "
+                "WHERE id = ? AND claim = ?",
+                (status, error, time.time() if status in FINISHED_STATUSES else None, job_id, job["claim"]),
+            ).rowcount
+        if not updated:
+            # 任务已被重新领取，状态由新的执行者负责
+            print(f"导入任务 {job_id} 已被其他工作线程接管，本次执行的结果不再记录")
+            return
+        if status == "succeeded":
+            # 失败或取消的任务保留上传的文件，以便重试时从断点继续
+            self._remove_upload(job_id)
+        print(f"导入任务 {job_id} 结束: {status}")
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_job_queue(persist_directory=settings.PERSIST_DIRECTORY, workers=DEFAULT_WORKERS):
+    """
+    获取进程内共享并已启动的任务队列（例如 Streamlit 的多次重跑和多个会话共用同一个队列）
+    """
+    key = os.path.abspath(persist_directory)
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            queue = JobQueue(persist_directory, workers).start()
+            _queues[key] = queue
+        return queue
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="后台导入任务队列")
+    parser.add_argument("command", choices=["worker", "submit", "list", "cancel", "retry"],
+                        help="worker: 在前台运行工作线程；submit: 提交文件；list: 查看任务；cancel/retry: 取消或重试任务")
+    parser.add_argument("args", nargs="*", help="submit 的文件路径，或 cancel/retry 的任务ID")
+    parser.add_argument("--collection", default=None,
+                        help="集合名称；submit 默认为 knowledge_base，list 默认列出全部集合")
+    parser.add_argument("--persist-directory", default=settings.PERSIST_DIRECTORY, help="数据库持久化目录")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="工作线程数")
+    args = parser.parse_args(argv)
+
+    queue = JobQueue(args.persist_directory, args.workers)
+    if args.command == "worker":
+        queue.start()
+        print(f"导入任务工作线程已启动（{args.workers} 个），按 Ctrl+C 退出")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            queue.shutdown()
+    elif args.command == "submit":
+        for path in args.args:
+            print(queue.submit(path, args.collection or "knowledge_base"))
+    elif args.command == "list":
+        for job in queue.list(args.collection):
+            print(
+                f"{job['id']}  {job['status']:<9}  {job['source_file']}  "
+                f"页 {job['pages_parsed']}  嵌入 {job['chunks_embedded']}  写入 {job['chunks_written']}"
+                + (f"  错误: {job['error']}" if job["error"] else "")
+            )
+    else:
+        method = queue.cancel if args.command == "cancel" else queue.retry
+        for job_id in args.args:
+            print(f"{job_id}: {'成功' if method(job_id) else '任务不存在或状态不允许该操作'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+持久化倒排索引：为中文/英文混合文本提供 BM25 关键词检索
+
+分词规则（不依赖额外的分词库）：
+- 英文、数字以及 API 名称、错误码、型号等（如 get_client、E1024、AB-12）整体作为一个词
+- 连续的中文字符切成二元组（bigram），单个汉字保留为一元词
+
+用法：
+    python -m tools.lexical_index rebuild --collection knowledge_base
+"""
+import os
+import re
+import sys
+import json
+import math
+import sqlite3
+import argparse
+from collections import Counter
+from contextlib import closing
+
+from langchain_core.documents import Document
+
+from tools import settings
+
+INDEX_FILENAME = "lexical.sqlite3"
+
+# BM25 参数
+K1 = 1.5
+B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.\-]*[A-Za-z0-9]|[A-Za-z0-9]|[㐀-䶿一-鿿]+")
+_CJK = re.compile(r"[㐀-䶿一-鿿]")
+
+
+def tokenize(text):
+    """把文本切分为索引词列表"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        if _CJK.match(token):
+            if len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token.lower())
+    return tokens
+
+
+def _connect(persist_directory):
+    os.makedirs(persist_directory, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(persist_directory, INDEX_FILENAME), timeout=30)
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS docs ("
+        "collection TEXT NOT NULL, chunk_id TEXT NOT NULL, source_file TEXT, "
+        "length INTEGER NOT NULL, content TEXT NOT NULL, metadata TEXT NOT NULL, "
+        "PRIMARY KEY (collection, chunk_id));"
+        "CREATE INDEX IF NOT EXISTS idx_docs_source ON docs(collection, source_file);"
+        "CREATE TABLE IF NOT EXISTS postings ("
+        "collection TEXT NOT NULL, term TEXT NOT NULL, chunk_id TEXT NOT NULL, tf INTEGER NOT NULL, "
+        "PRIMARY KEY (collection, term, chunk_id)) WITHOUT ROWID;"
+        "CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings(collection, chunk_id);"
+        "CREATE TABLE IF NOT EXISTS stats ("
+        "collection TEXT PRIMARY KEY, doc_count INTEGER NOT NULL, total_length INTEGER NOT NULL);"
+    )
+    return conn
+
+
+def _bump_stats(conn, collection_name, doc_delta, length_delta):
+    conn.execute(
+        "INSERT INTO stats (collection, doc_count, total_length) VALUES (?, ?, ?) "
+        "ON CONFLICT(collection) DO UPDATE SET "
+        "doc_count = doc_count + excluded.doc_count, total_length = total_length + excluded.total_length",
+        (collection_name, doc_delta, length_delta),
+    )
+
+
+def _delete_where(conn, collection_name, condition, params):
+    rows = conn.execute(
+        f"SELECT chunk_id, length FROM docs WHERE collection = ? AND {condition}",
+        (collection_name, *params),
+    ).fetchall()
+    if not rows:
+        return 0
+    conn.executemany(
+        "DELETE FROM postings WHERE collection = ? AND chunk_id = ?",
+        [(collection_name, chunk_id) for chunk_id, _ in rows],
+    )
+    conn.executemany(
+        "DELETE FROM docs WHERE collection = ? AND chunk_id = ?",
+        [(collection_name, chunk_id) for chunk_id, _ in rows],
+    )
+    _bump_stats(conn, collection_name, -len(rows), -sum(length for _, length in rows))
+    return len(rows)
+
+
+def add_documents(collection_name, ids, docs, persist_directory=settings.PERSIST_DIRECTORY):
+    """把文档片段加入倒排索引，已存在的ID会被覆盖"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        for chunk_id, doc in zip(ids, docs):
+            _delete_where(conn, collection_name, "chunk_id = ?", (chunk_id,))
+            counts = Counter(tokenize(doc.page_content))
+            length = sum(counts.values())
+            conn.execute(
+                "INSERT INTO docs (collection, chunk_id, source_file, length, content, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (collection_name, chunk_id, doc.metadata.get("source_file"), length,
+                 doc.page_content, json.dumps(doc.metadata, ensure_ascii=False)),
+            )
+            conn.executemany(
+                "INSERT INTO postings (collection, term, chunk_id, tf) VALUES (?, ?, ?, ?)",
+                [(collection_name, term, chunk_id, tf) for term, tf in counts.items()],
+            )
+            _bump_stats(conn, collection_name, 1, length)
+
+
+def delete_ids(collection_name, ids, persist_directory=settings.PERSIST_DIRECTORY):
+    """从倒排索引中删除指定ID的片段"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        for chunk_id in ids:
+            _delete_where(conn, collection_name, "chunk_id = ?", (chunk_id,))
+
+
+def delete_source_file(collection_name, source_file, persist_directory=settings.PERSIST_DIRECTORY):
+    """删除某个源文件的全部片段，返回删除数量"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        return _delete_where(conn, collection_name, "source_file = ?", (source_file,))
+
+
+def clear_collection(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """清空某个集合的倒排索引"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.execute("DELETE FROM postings WHERE collection = ?", (collection_name,))
+        conn.execute("DELETE FROM docs WHERE collection = ?", (collection_name,))
+        conn.execute("DELETE FROM stats WHERE collection = ?", (collection_name,))
+
+
+def search(query_text, collection_name="knowledge_base", k=3, persist_directory=settings.PERSIST_DIRECTORY, filter=None):
+    """
+    BM25 关键词检索，不需要加载嵌入模型
+
+    Args:
+        filter (dict): 目前只支持按 {"source_file": ...} 过滤
+
+    Returns:
+        list: [(Document, score), ...]，按得分从高到低排列
+    """
+    filter = filter or {}
+    unsupported = set(filter) - {"source_file"}
+    if unsupported:
+        raise ValueError(f"Unsupported lexical filter keys: {sorted(unsupported)}")
+    source_condition = " AND d.source_file = ?" if "source_file" in filter else ""
+    source_params = (filter["source_file"],) if "source_file" in filter else ()
+
+    terms = Counter(tokenize(query_text))
+    if not terms or not os.path.exists(os.path.join(persist_directory, INDEX_FILENAME)):
+        return []
+
+    with closing(_connect(persist_directory)) as conn:
+        row = conn.execute(
+            "SELECT doc_count, total_length FROM stats WHERE collection = ?", (collection_name,)
+        ).fetchone()
+        if not row or row[0] <= 0:
+            return []
+        doc_count, total_length = row
+        avg_length = total_length / doc_count
+
+        scores = Counter()
+        for term, query_tf in terms.items():
+            postings = conn.execute(
+                "SELECT p.chunk_id, p.tf, d.length FROM postings p "
+                "JOIN docs d ON d.collection = p.collection AND d.chunk_id = p.chunk_id "
+                "WHERE p.collection = ? AND p.term = ?" + source_condition,
+                (collection_name, term, *source_params),
+            ).fetchall()
+            if not postings:
+                continue
+            df = len(postings)
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for chunk_id, tf, length in postings:
+                norm = tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length))
+                scores[chunk_id] += query_tf * idf * norm
+
+        top = scores.most_common(k)
+        if not top:
+            return []
+        placeholders = ",".join("?" * len(top))
+        rows = conn.execute(
+            f"SELECT chunk_id, content, metadata FROM docs WHERE collection = ? AND chunk_id IN ({placeholders})",
+            (collection_name, *[chunk_id for chunk_id, _ in top]),
+        ).fetchall()
+
+    by_id = {chunk_id: (content, metadata) for chunk_id, content, metadata in rows}
+    results = []
+    for chunk_id, score in top:
+        content, metadata = by_id[chunk_id]
+        results.append((Document(page_content=content, metadata=json.loads(metadata), id=chunk_id), score))
+    return results
+
+
+def rebuild(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY, batch_size=1000):
+    """
+    从向量数据库中重新构建某个集合的倒排索引（用于启用关键词检索前已导入的数据）
+    """
+    from tools.registry import get_store
+
+    print(f"正在重建集合 '{collection_name}' 的关键词索引...")
+    clear_collection(collection_name, persist_directory)
+    store = get_store(collection_name, persist_directory)
+    total = 0
+    for batch in store.iter_batches(batch_size, include_embeddings=False):
+        docs = [
+            Document(page_content=content, metadata=metadata)
+            for content, metadata in zip(batch["documents"], batch["metadatas"])
+        ]
+        add_documents(collection_name, batch["ids"], docs, persist_directory)
+        total += len(batch["ids"])
+    print(f"已为 {total} 个文档片段建立关键词索引")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="关键词索引维护工具")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: 从向量数据库重建关键词索引")
+    parser.add_argument("--collection", default="knowledge_base", help="集合名称")
+    parser.add_argument("--persist-directory", default=settings.PERSIST_DIRECTORY, help="数据库持久化目录")
+    args = parser.parse_args(argv)
+    rebuild(args.collection, args.persist_directory)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
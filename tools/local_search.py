@@ -0,0 +1,142 @@
+"""
+基于本地语料的模拟网络搜索，接口和返回格式与 langchain_tavily.TavilySearch 一致，用于离线测试和压力测试
+
+语料（search.corpus_path / ZHIKU_SEARCH_CORPUS）可以是：
+- 目录：其中每个 .txt / .md 文件是一个网页，标题取第一行
+- .jsonl 文件：每行一个 {"title", "url", "content"}
+- 留空：使用内置的合成语料
+
+检索使用内存中的 BM25（分词规则与 tools.lexical_index 相同），search.latency_ms 模拟网络延迟。
+
+    ZHIKU_SEARCH_PROVIDER=local ZHIKU_SEARCH_CORPUS=./pages python main.py
+"""
+import os
+import json
+import math
+import time
+import random
+import asyncio
+from collections import Counter
+
+from tools import settings
+
+CORPUS_PATH = settings.get("search.corpus_path")
+MAX_RESULTS = settings.get("search.max_results")
+LATENCY_MS = settings.get("search.latency_ms")
+
+# 返回结果中 content 的最大字符数
+SNIPPET_CHARS = 500
+
+# BM25 参数
+K1 = 1.5
+B = 0.75
+
+_TOPICS = [
+    "机器学习", "深度学习", "向量数据库", "检索增强生成", "知识图谱", "大语言模型", "推荐系统",
+    "自然语言处理", "模型量化", "分布式训练", "搜索引擎", "数据清洗",
+]
+_ASPECTS = ["最新进展", "入门教程", "常见问题", "性能优化", "行业应用", "开源工具"]
+
+
+def synthetic_corpus(size=200, seed=0):
+    """生成合成的中文网页，返回 [{"title", "url", "content"}, ...]"""
+    rng = random.Random(seed)
+    pages = []
+    for i in range(size):
+        topic, aspect = rng.choice(_TOPICS), rng.choice(_ASPECTS)
+        sentences = [
+            f"{topic}的{aspect}：{rng.choice(_TOPICS)}与{rng.choice(_TOPICS)}的结合在{2020 + rng.randint(0, 6)}年受到关注。"
+            for _ in range(rng.randint(4, 8))
+        ]
+        pages.append({
+            "title": f"{topic}{aspect}（第 {i} 篇）",
+            "url": f"https://example.com/{i}",
+            "content": "".join(sentences),
+        })
+    return pages
+
+
+def load_corpus(path):
+    """从目录或 .jsonl 文件读取语料"""
+    if os.path.isdir(path):
+        pages = []
+        for name in sorted(os.listdir(path)):
+            if not name.lower().endswith((".txt", ".md")):
+                continue
+            file_path = os.path.join(path, name)
+            with open(file_path, encoding="utf-8") as f:
+                content = f.read()
+            title = content.strip().splitlines()[0].lstrip("# ").strip() if content.strip() else name
+            pages.append({"title": title, "url": f"file://{os.path.abspath(file_path)}", "content": content})
+        return pages
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LocalSearch:
+    """本地语料的 BM25 搜索，invoke / ainvoke 与 TavilySearch 相同"""
+
+    def __init__(self, corpus_path=CORPUS_PATH, max_results=MAX_RESULTS, latency_ms=LATENCY_MS, pages=None):
+        from tools.lexical_index import tokenize
+
+        self._tokenize = tokenize
+        self.max_results = max_results
+        self.latency = latency_ms / 1000
+        if pages is None:
+            pages = load_corpus(corpus_path) if corpus_path else synthetic_corpus()
+        self.pages = pages
+        self._postings = {}
+        self._lengths = []
+        for i, page in enumerate(pages):
+            tokens = tokenize(f"{page.get('title', '')}\n{page.get('content', '')}")
+            self._lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self._postings.setdefault(term, []).append((i, tf))
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0
+
+    def search(self, query, max_results=None):
+        """返回 [(得分, 页面), ...]，按得分降序"""
+        scores = Counter()
+        count = len(self.pages)
+        for term in set(self._tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = K1 * (1 - B + B * self._lengths[i] / self._avg_length)
+                scores[i] += idf * tf * (K1 + 1) / (tf + norm)
+        return [(score, self.pages[i]) for i, score in scores.most_common(max_results or self.max_results)]
+
+    def _response(self, query, max_results, started):
+        results = self.search(query, max_results)
+        top = results[0][0] if results else 1
+        return {
+            "query": query,
+            "follow_up_questions": None,
+            "answer": None,
+            "images": [],
+            "results": [
+                {
+                    "url": page.get("url"),
+                    "title": page.get("title"),
+                    "content": page.get("content", "")[:SNIPPET_CHARS],
+                    "score": round(score / top, 4),
+                    "raw_content": None,
+                }
+                for score, page in results
+            ],
+            "response_time": round(time.perf_counter() - started, 3),
+        }
+
+    def invoke(self, kwargs):
+        started = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        return self._response(kwargs.get("query", ""), kwargs.get("max_results"), started)
+
+    async def ainvoke(self, kwargs):
+        started = time.perf_counter()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._response(kwargs.get("query", ""), kwargs.get("max_results"), started)
@@ -0,0 +1,209 @@
+import os
+import time
+import uuid
+import sqlite3
+import hashlib
+from contextlib import closing
+
+from tools import settings
+
+MANIFEST_FILENAME = "manifest.sqlite3"
+
+
+def chunk_id(source_file, content, occurrence=0):
+    """
+    根据源文件名和片段内容生成确定性的片段ID
+
+    同一文件中内容完全相同的片段用 occurrence 区分
+    """
+    digest = hashlib.sha256()
+    digest.update(source_file.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(content.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(str(occurrence).encode("ascii"))
+    return digest.hexdigest()[:32]
+
+
+def chunk_ids_for(source_file, docs, seen=None):
+    """
+    为一组文档片段依次生成确定性ID
+
+    流式处理同一文件的多个批次时，传入同一个 seen 字典以保持重复片段的序号连续
+    """
+    if seen is None:
+        seen = {}
+    ids = []
+    for doc in docs:
+        key = hashlib.sha1(doc.page_content.encode("utf-8")).digest()
+        occurrence = seen.get(key, 0)
+        seen[key] = occurrence + 1
+        ids.append(chunk_id(source_file, doc.page_content, occurrence))
+    return ids
+
+
+# 已经建好表的数据库文件，避免每次连接都执行建表语句
+_initialized = set()
+
+
+def _connect(persist_directory):
+    path = os.path.abspath(os.path.join(persist_directory, MANIFEST_FILENAME))
+    if path in _initialized and os.path.exists(path):
+        return sqlite3.connect(path, timeout=30)
+    os.makedirs(persist_directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(
+        "CREATE TABLE IF NOT EXISTS chunks ("
+        "collection TEXT NOT NULL, source_file TEXT NOT NULL, chunk_id TEXT NOT NULL, "
+        "PRIMARY KEY (collection, source_file, chunk_id));"
+        "CREATE TABLE IF NOT EXISTS versions ("
+        "collection TEXT PRIMARY KEY, version INTEGER NOT NULL);"
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+        "CREATE TABLE IF NOT EXISTS files ("
+        "collection TEXT NOT NULL, source_file TEXT NOT NULL, chunk_count INTEGER NOT NULL DEFAULT 0, "
+        "bytes INTEGER, ingested_at REAL, content_hash TEXT, "
+        "PRIMARY KEY (collection, source_file));"
+    )
+    # 每个数据库目录有一个随机的代号，重置数据库后版本号不会与之前的缓存冲突
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'generation'").fetchone() is None:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', ?)", (uuid.uuid4().hex,))
+    _initialized.add(path)
+    return conn
+
+
+def get_chunk_ids(collection_name, source_file, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    返回清单中记录的该文件的片段ID集合；没有清单记录时返回 None
+    """
+    with closing(_connect(persist_directory)) as conn:
+        rows = conn.execute(
+            "SELECT chunk_id FROM chunks WHERE collection = ? AND source_file = ?",
+            (collection_name, source_file),
+        ).fetchall()
+    return {row[0] for row in rows} if rows else None
+
+
+def _update_chunk_count(conn, collection_name, source_file):
+    """在同一个事务中按清单重新统计文件目录中的片段数"""
+    count = conn.execute(
+        "SELECT COUNT(*) FROM chunks WHERE collection = ? AND source_file = ?",
+        (collection_name, source_file),
+    ).fetchone()[0]
+    conn.execute(
+        "INSERT INTO files (collection, source_file, chunk_count) VALUES (?, ?, ?) "
+        "ON CONFLICT(collection, source_file) DO UPDATE SET chunk_count = excluded.chunk_count",
+        (collection_name, source_file, count),
+    )
+    return count
+
+
+def add_chunk_ids(collection_name, source_file, ids, persist_directory=settings.PERSIST_DIRECTORY):
+    """向文件清单中追加片段ID"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO chunks (collection, source_file, chunk_id) VALUES (?, ?, ?)",
+            [(collection_name, source_file, i) for i in ids],
+        )
+        _update_chunk_count(conn, collection_name, source_file)
+
+
+def remove_chunk_ids(collection_name, source_file, ids, persist_directory=settings.PERSIST_DIRECTORY):
+    """从文件清单中移除片段ID"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.executemany(
+            "DELETE FROM chunks WHERE collection = ? AND source_file = ? AND chunk_id = ?",
+            [(collection_name, source_file, i) for i in ids],
+        )
+        if _update_chunk_count(conn, collection_name, source_file) == 0:
+            conn.execute(
+                "DELETE FROM files WHERE collection = ? AND source_file = ?",
+                (collection_name, source_file),
+            )
+
+
+def drop_file(collection_name, source_file, persist_directory=settings.PERSIST_DIRECTORY):
+    """删除某个文件的全部清单记录"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.execute(
+            "DELETE FROM chunks WHERE collection = ? AND source_file = ?",
+            (collection_name, source_file),
+        )
+        conn.execute(
+            "DELETE FROM files WHERE collection = ? AND source_file = ?",
+            (collection_name, source_file),
+        )
+
+
+def drop_collection(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """删除某个集合的全部清单记录"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.execute("DELETE FROM chunks WHERE collection = ?", (collection_name,))
+        conn.execute("DELETE FROM files WHERE collection = ?", (collection_name,))
+
+
+def file_digest(file_path):
+    """
+    流式计算文件的大小和内容哈希
+
+    Returns:
+        tuple: (字节数, sha256 十六进制摘要)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+
+def record_file(collection_name, source_file, size=None, content_hash=None, persist_directory=settings.PERSIST_DIRECTORY):
+    """文件导入完成后，在文件目录中记录其大小、导入时间和内容哈希"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        _update_chunk_count(conn, collection_name, source_file)
+        conn.execute(
+            "UPDATE files SET bytes = ?, ingested_at = ?, content_hash = ? "
+            "WHERE collection = ? AND source_file = ?",
+            (size, time.time(), content_hash, collection_name, source_file),
+        )
+
+
+def list_files(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    返回集合的文件目录，不需要扫描向量数据库
+
+    Returns:
+        list: [{"source_file", "chunk_count", "bytes", "ingested_at", "content_hash"}, ...]，按文件名排序
+    """
+    with closing(_connect(persist_directory)) as conn:
+        rows = conn.execute(
+            "SELECT source_file, chunk_count, bytes, ingested_at, content_hash FROM files "
+            "WHERE collection = ? ORDER BY source_file",
+            (collection_name,),
+        ).fetchall()
+    return [
+        {"source_file": source_file, "chunk_count": chunk_count, "bytes": size,
+         "ingested_at": ingested_at, "content_hash": content_hash}
+        for source_file, chunk_count, size, ingested_at, content_hash in rows
+    ]
+
+
+def get_version(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    返回集合当前的版本标识，集合内容每次变化后都会不同
+    """
+    with closing(_connect(persist_directory)) as conn:
+        generation = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+        row = conn.execute("SELECT version FROM versions WHERE collection = ?", (collection_name,)).fetchone()
+    return f"{generation}:{row[0] if row else 0}"
+
+
+def bump_version(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """集合内容发生变化后递增其版本号，使依赖旧版本的缓存失效"""
+    with closing(_connect(persist_directory)) as conn, conn:
+        conn.execute(
+            "INSERT INTO versions (collection, version) VALUES (?, 1) "
+            "ON CONFLICT(collection) DO UPDATE SET version = version + 1",
+            (collection_name,),
+        )
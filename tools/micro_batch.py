@@ -0,0 +1,112 @@
+"""
+微批处理嵌入：把多个线程同时发起的查询嵌入请求合并成一次前向计算
+
+并发请求很多时，逐条计算查询向量会让模型反复执行只有一条输入的前向计算；
+这里的后台线程在一个很短的时间窗口内收集请求，凑成一批后一次算完，再把结果分发给各个调用方。
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+from tools import settings
+
+# 收集一批请求的最长等待时间（毫秒）
+BATCH_WINDOW_MS = settings.get("server.batch_window_ms")
+
+# 每批最多合并的查询数
+MAX_BATCH_SIZE = settings.get("server.max_batch_size")
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    """
+    嵌入模型包装器：embed_query 在时间窗口内合并成批，embed_documents 本身已经成批，直接转发
+
+    批量的查询向量优先使用被包装模型的 embed_queries，否则使用 embed_documents，
+    因此要求模型对查询和文档使用相同的编码方式（默认的 bge 配置即是如此）
+    """
+
+    def __init__(self, embeddings, window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def _embed_batch(self, texts):
+        embed_queries = getattr(self.embeddings, "embed_queries", None)
+        return embed_queries(texts) if embed_queries else self.embeddings.embed_documents(texts)
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            texts = [text for text, _ in batch]
+            # 任何异常都只让这一批的调用方失败，不能结束后台线程，否则之后的 embed_query 会一直等待
+            try:
+                vectors = list(self._embed_batch(texts))
+                if len(vectors) != len(batch):
+                    raise RuntimeError(f"嵌入模型返回了 {len(vectors)} 个向量，请求了 {len(batch)} 个")
+                for (_, future), vector in zip(batch, vectors):
+                    future.set_result(vector)
+            except BaseException as e:
+                self._fail(batch, e)
+                continue
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+
+    @staticmethod
+    def _fail(batch, error):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def embed_query(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def embed_queries(self, texts):
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self):
+        """返回被包装模型的缓存统计（如果有）"""
+        stats = getattr(self.embeddings, "stats", None)
+        return stats() if stats else None
+
+    def batch_stats(self):
+        """返回微批处理的统计：批次数、请求数和平均批大小"""
+        with self._lock:
+            batches, requests = self.batches, self.requests
+        return {
+            "batches": batches,
+            "requests": requests,
+            "mean_batch_size": requests / batches if batches else 0.0,
+            "window_ms": self.window * 1000.0,
+            "max_batch_size": self.max_batch_size,
+        }
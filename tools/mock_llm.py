@@ -0,0 +1,270 @@
+"""
+本地模拟的 OpenAI 兼容模型服务：按脚本返回工具调用和回答，可配置首 token 延迟和流式输出速度
+
+用于在没有网络和 API Key 的机器上运行和压测问答流程（需要安装 `pip install -e .[server]`）：
+
+    python -m tools.mock_llm --port 8700 --scenario db --first-token-ms 300 --chunk-ms 20
+    ZHIKU_LLM_PROVIDER=mock ZHIKU_MOCK_LLM_URL=http://127.0.0.1:8700/v1 python main.py
+
+脚本是一组步骤，第 n 个步骤对应同一问题中的第 n 次模型调用（按最后一条用户消息之后的助手消息数计算）；
+步骤为 {"tool_calls": [{"name", "arguments"}]} 或 {"content": 文本}，content 为空时生成一段回答。
+参数和文本中的 {question}、{collection} 替换为用户问题和 --collection。请求的 model 是脚本名时使用该脚本，
+tool_choice 为 "none" 时直接回答。--script 可以读入 JSON 文件：一个步骤列表，或“脚本名 -> 步骤列表”的字典。
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+_DB_CALL = {"name": "search_with_db", "arguments": {"query": "{question}", "collection_name": "{collection}"}}
+_WEB_CALL = {"name": "tavily_search", "arguments": {"query": "{question}"}}
+
+SCENARIOS = {
+    "direct": [{"content": None}],
+    "db": [{"tool_calls": [_DB_CALL]}, {"content": None}],
+    "web": [{"tool_calls": [_WEB_CALL]}, {"content": None}],
+    "db_web": [{"tool_calls": [_DB_CALL, _WEB_CALL]}, {"content": None}],
+    "multi": [{"tool_calls": [_DB_CALL]}, {"tool_calls": [_WEB_CALL]}, {"content": None}],
+}
+
+_FILLER = "根据检索到的资料，这里是模拟生成的回答内容。"
+
+
+def load_script(path):
+    """读取脚本文件，返回“脚本名 -> 步骤列表”"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {"script": data} if isinstance(data, list) else data
+
+
+def _fill(value, replacements):
+    if isinstance(value, str):
+        for key, text in replacements.items():
+            value = value.replace(key, text)
+        return value
+    if isinstance(value, dict):
+        return {k: _fill(v, replacements) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_fill(v, replacements) for v in value]
+    return value
+
+
+def _repeat(prefix, chars):
+    text = prefix
+    while len(text) < chars:
+        text += _FILLER
+    return text[:max(chars, len(prefix))]
+
+
+def _estimate_tokens(text):
+    # 中文约每 1.6 个字符一个 token，只用于返回大致的用量
+    return int(len(text) * 0.6) + 1
+
+
+class _Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tool_call_responses = 0
+        self.started = time.time()
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "tool_call_responses": self.tool_call_responses,
+            "uptime_s": round(time.time() - self.started, 3),
+        }
+
+
+def create_app(scenario="db", scripts=None, collection="knowledge_base", first_token_ms=200.0, chunk_ms=10.0,
+               chunk_chars=4, reasoning_chars=100, answer_chars=200, jitter=0.0):
+    """
+    创建模拟服务
+
+    Args:
+        scenario (str): 默认脚本名
+        scripts (dict): 额外的脚本，与内置的 SCENARIOS 合并
+        first_token_ms (float): 收到请求到第一个分片的延迟
+        chunk_ms (float): 相邻分片之间的延迟
+        chunk_chars (int): 每个分片的字符数
+        reasoning_chars (int): 每次回复的推理过程长度，0 表示没有推理过程
+        answer_chars (int): 生成的回答长度
+        jitter (float): 延迟的随机浮动比例，例如 0.2 表示 ±20%
+    """
+    scenarios = {**SCENARIOS, **(scripts or {})}
+    if scenario not in scenarios:
+        raise ValueError(f"未知的脚本: {scenario}（可选 {', '.join(scenarios)}）")
+    stats = _Stats()
+    app = FastAPI(title="mock llm")
+
+    def delay(ms):
+        if not ms:
+            return 0
+        return ms / 1000 * (1 + random.uniform(-jitter, jitter) if jitter else 1)
+
+    def plan(body):
+        """根据请求选出本次的步骤，返回 (推理过程, 回答, 工具调用列表)"""
+        messages = body.get("messages") or []
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+        question = (messages[last_user].get("content") or "") if last_user >= 0 else ""
+        steps = scenarios.get(body.get("model"), scenarios[scenario])
+        turn = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+        if body.get("tool_choice") == "none" or not body.get("tools"):
+            step = {"content": steps[-1].get("content")}
+        else:
+            step = steps[min(turn, len(steps) - 1)]
+        step = _fill(step, {"{question}": question, "{collection}": collection})
+        reasoning = _repeat(f"（模拟推理）第 {turn + 1} 次调用。", reasoning_chars) if reasoning_chars else ""
+        tool_calls = [
+            {"id": f"call_{uuid.uuid4().hex[:12]}", "name": call["name"],
+             "arguments": json.dumps(call.get("arguments", {}), ensure_ascii=False)}
+            for call in step.get("tool_calls") or []
+        ]
+        content = step.get("content")
+        if not tool_calls and not content:
+            cited = " [1]" if any("[1]" in str(m.get("content")) for m in messages if m.get("role") == "tool") else ""
+            content = _repeat(f"（模拟回答）关于“{question[:50]}”：", answer_chars) + cited
+        return reasoning, content or "", tool_calls
+
+    def usage(body, reasoning, content, tool_calls):
+        prompt = sum(_estimate_tokens(str(m.get("content") or "")) for m in body.get("messages") or [])
+        completion = _estimate_tokens(reasoning + content + "".join(c["arguments"] for c in tool_calls))
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "completion_tokens_details": {"reasoning_tokens": _estimate_tokens(reasoning) if reasoning else 0},
+        }
+
+    def pieces(text):
+        return [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+
+    def begin():
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+
+    async def stream(body, completion_id, reasoning, content, tool_calls):
+        model = body.get("model")
+
+        def chunk(delta, finish_reason=None):
+            data = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        # 在生成器内部计数：客户端在首个分片前断开时生成器不会启动，也就不会留下未减回的计数
+        begin()
+        try:
+            await asyncio.sleep(delay(first_token_ms))
+            yield chunk({"role": "assistant", "content": ""})
+            for field, text in (("reasoning_content", reasoning), ("content", content)):
+                for piece in pieces(text):
+                    yield chunk({field: piece})
+                    await asyncio.sleep(delay(chunk_ms))
+            for index, call in enumerate(tool_calls):
+                # 与真实接口一样，先发送 id 和名称，参数分片到达
+                yield chunk({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                             "function": {"name": call["name"], "arguments": ""}}]})
+                for piece in pieces(call["arguments"]):
+                    yield chunk({"tool_calls": [{"index": index, "function": {"arguments": piece}}]})
+                    await asyncio.sleep(delay(chunk_ms))
+            yield chunk({}, "tool_calls" if tool_calls else "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                data = {
+                    "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [], "usage": usage(body, reasoning, content, tool_calls),
+                }
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            stats.in_flight -= 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        reasoning, content, tool_calls = plan(body)
+        if tool_calls:
+            stats.tool_call_responses += 1
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:16]}"
+        if body.get("stream"):
+            return StreamingResponse(
+                stream(body, completion_id, reasoning, content, tool_calls), media_type="text/event-stream"
+            )
+        begin()
+        try:
+            chunks = len(pieces(reasoning)) + len(pieces(content)) + sum(len(pieces(c["arguments"])) for c in tool_calls)
+            await asyncio.sleep(delay(first_token_ms) + chunks * delay(chunk_ms))
+        finally:
+            stats.in_flight -= 1
+        message = {"role": "assistant", "content": content, "reasoning_content": reasoning or None}
+        if tool_calls:
+            message["tool_calls"] = [
+                {"id": c["id"], "type": "function", "function": {"name": c["name"], "arguments": c["arguments"]}}
+                for c in tool_calls
+            ]
+        return {
+            "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage(body, reasoning, content, tool_calls),
+        }
+
+    @app.get("/v1/models")
+    def models():
+        return {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "mock"} for name in scenarios]}
+
+    @app.get("/stats")
+    def get_stats():
+        """请求数、当前和最大并发请求数"""
+        return stats.to_dict()
+
+    @app.post("/stats/reset")
+    def reset_stats():
+        stats.reset()
+        return stats.to_dict()
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容模型服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8700, help="监听端口")
+    parser.add_argument("--scenario", default=None,
+                        help=f"默认脚本：{', '.join(SCENARIOS)} 或 --script 中的脚本名，默认为 db")
+    parser.add_argument("--script", default=None, help="JSON 脚本文件")
+    parser.add_argument("--collection", default="knowledge_base", help="脚本中 {collection} 替换成的集合名称")
+    parser.add_argument("--first-token-ms", type=float, default=200.0, help="首个分片的延迟（毫秒）")
+    parser.add_argument("--chunk-ms", type=float, default=10.0, help="相邻分片之间的延迟（毫秒）")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="每个分片的字符数")
+    parser.add_argument("--reasoning-chars", type=int, default=100, help="推理过程的长度，0 表示没有推理过程")
+    parser.add_argument("--answer-chars", type=int, default=200, help="生成的回答长度")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机浮动比例")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    scripts = load_script(args.script) if args.script else None
+    # 脚本文件只是一个步骤列表时默认使用它
+    scenario = args.scenario or ("script" if scripts and "script" in scripts else "db")
+    app = create_app(scenario, scripts, args.collection, args.first_token_ms, args.chunk_ms, args.chunk_chars,
+                     args.reasoning_chars, args.answer_chars, args.jitter)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import json
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from tools import settings
+
+DEFAULT_MAX_ENTRIES = settings.get("retrieval.query_cache_max_entries")
+DEFAULT_TTL_SECONDS = settings.get("retrieval.query_cache_ttl")
+
+
+def normalize_query(query_text):
+    """归一化查询：全角转半角、忽略大小写并合并空白"""
+    # embedding_cache 会导入 langchain_core.embeddings，推迟到第一次查询时再加载
+    from tools.embedding_cache import normalize_text
+    return normalize_text(unicodedata.normalize("NFKC", query_text)).casefold()
+
+
+def make_key(collection_name, query_text, k, filter=None, mode="vector", version=None, **extra):
+    """生成结果缓存的键，集合版本号是键的一部分"""
+    return (
+        collection_name,
+        normalize_query(query_text),
+        k,
+        json.dumps(filter, sort_keys=True, ensure_ascii=False) if filter else None,
+        mode,
+        version,
+        tuple(sorted(extra.items())),
+    )
+
+
+class QueryCache:
+    """
+    线程安全的 LRU + TTL 查询结果缓存
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """命中返回缓存值，否则返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """返回缓存命中统计，用于评估缓存容量"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "ttl": self.ttl,
+            }
+
+
+# 进程内共享的查询结果缓存
+query_cache = QueryCache()
@@ -1,55 +1,143 @@
 import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-import logging
+from tools import settings
+from tools.registry import get_store
+from tools import lexical_index, manifest, vector_store, tracing
+from tools.query_cache import query_cache, make_key
 
-# chromadb import for collection management
-import chromadb
-
-def load_vector_db(collection_name="knowledge_base"):
+def load_vector_db(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY):
     """
     加载已存储的向量数据库
     """
-    # 使用与存储时相同的嵌入模型
-    embeddings = HuggingFaceEmbeddings(
-        model_name=r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"
-    )
-    
     try:
-        # 从持久化目录加载向量数据库
-        vectorstore = Chroma(
-            collection_name=collection_name,
-            embedding_function=embeddings,
-            persist_directory="./db_storage"
-        )
+        # 从共享注册表获取向量存储（后端由集合决定，句柄在进程内复用）
+        store = get_store(collection_name, persist_directory)
         
-        count = vectorstore._collection.count()
+        count = store.count()
         print(f"成功从数据库中加载了 {count} 个文档片段")
         if count == 0:
             print("⚠️ 数据库中没有文档，请先添加一些文档到知识库中。")
         
-        return vectorstore
+        return store
     except Exception as e:
         print(f"⚠️ 加载数据库时出错: {e}")
         print("请确保已经添加了至少一个文档到知识库中。")
         return None
 
 
-def query_vector_db(query_text, collection_name="knowledge_base", k=3):
+# 倒数排名融合（RRF）的平滑常数
+RRF_K = 60
+
+def _doc_key(doc):
+    """用片段ID（没有时用来源+内容）识别同一个文档片段"""
+    return getattr(doc, "id", None) or (doc.metadata.get("source_file"), doc.page_content)
+
+
+def reciprocal_rank_fusion(result_lists, k, rrf_k=RRF_K):
+    """
+    使用倒数排名融合合并多路检索结果
+    """
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs[key] for key in ranked[:k]]
+
+
+def _cache_put(key, docs):
+    # 缓存保存独立的副本，调用方修改返回的片段（例如元数据）不会影响缓存
+    query_cache.put(key, tuple(doc.model_copy(deep=True) for doc in docs))
+
+
+def _cache_get(key):
+    """命中时返回缓存片段的副本，未命中返回 None"""
+    cached = query_cache.get(key)
+    if cached is None:
+        return None
+    return [doc.model_copy(deep=True) for doc in cached]
+
+
+def query_vector_db(query_text, collection_name="knowledge_base", k=3, persist_directory=settings.PERSIST_DIRECTORY, mode="vector", filter=None, use_cache=True, rerank=False, fetch_k=None):
     """
     查询向量数据库并返回最相似的结果
+
+    相同的查询会直接从结果缓存返回，集合内容变化（导入或删除）后缓存自动失效
+
+    Args:
+        mode (str): "vector" 语义检索；"lexical" BM25 关键词检索（不加载嵌入模型）；
+            "hybrid" 两路检索后用倒数排名融合合并
+        filter (dict): 元数据过滤条件，例如 {"source_file": "手册.pdf"}
+        use_cache (bool): 是否使用查询结果缓存
+        rerank (bool): 先检索 fetch_k 个候选，再用交叉编码器重排后返回前 k 个
+        fetch_k (int): 重排的候选数，默认 max(k * 5, 20)
     """
-    vectorstore = load_vector_db(collection_name)
+    if mode not in ("vector", "lexical", "hybrid"):
+        raise ValueError(f"Unsupported query mode: {mode}")
+    with tracing.span("retrieve", collection=collection_name, mode=mode, k=k, rerank=bool(rerank)) as s:
+        results = _query(query_text, collection_name, k, persist_directory, mode, filter, use_cache, rerank, fetch_k, s)
+        s.set(items=len(results))
+    return results
+
+
+def _query(query_text, collection_name, k, persist_directory, mode, filter, use_cache, rerank, fetch_k, span):
+    if rerank:
+        fetch_k = max(fetch_k or max(k * 5, 20), k)
+
+    key = None
+    if use_cache:
+        try:
+            version = manifest.get_version(collection_name, persist_directory)
+            key = make_key(collection_name, query_text, k, filter, mode, version,
+                           persist_directory=os.path.abspath(persist_directory),
+                           rerank=fetch_k if rerank else None)
+            cached = _cache_get(key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+        except Exception as e:
+            print(f"读取查询缓存时出错: {e}")
+            key = None
+
+    if rerank:
+        results = _rerank(query_text, _search(query_text, collection_name, fetch_k, persist_directory, mode, filter), k)
+    else:
+        results = _search(query_text, collection_name, k, persist_directory, mode, filter)
+    # 出错时返回的空结果不写入缓存
+    if key is not None and results:
+        _cache_put(key, results)
+    return list(results)
+
+
+def _search(query_text, collection_name, k, persist_directory, mode, filter):
+    if mode == "lexical":
+        try:
+            with tracing.span("lexical.search", k=k):
+                return [doc for doc, _ in lexical_index.search(query_text, collection_name, k, persist_directory, filter)]
+        except Exception as e:
+            print(f"关键词检索时出错: {e}")
+            return []
+
+    store = load_vector_db(collection_name, persist_directory)
     
-    if vectorstore is None:
+    if store is None:
         return []
     
     try:
+        if mode == "hybrid":
+            vector_docs = store.similarity_search(query_text, k=_hybrid_fetch_k(k), filter=filter)
+            return _fuse_lexical(query_text, vector_docs, collection_name, k, persist_directory, filter)
+
         # 执行相似性搜索
-        similar_docs = vectorstore.similarity_search(query_text, k=k)
+        similar_docs = store.similarity_search(query_text, k=k, filter=filter)
         
         return similar_docs
     except Exception as e:
@@ -57,12 +145,155 @@ def query_vector_db(query_text, collection_name="knowledge_base", k=3):
         return []
 
 
-def list_collections(persist_directory="./db_storage"):
+def _hybrid_fetch_k(k):
+    # 混合检索时两路各多取一些候选，融合后再截取前 k 个
+    return max(k * 4, 20)
+
+
+def _fuse_lexical(query_text, vector_docs, collection_name, k, persist_directory, filter):
+    """
+    补上关键词检索的一路结果，与向量检索结果做倒数排名融合
+
+    关键词检索出错时（例如关键词索引不支持的过滤条件）只使用向量检索的结果
+    """
+    fetch_k = _hybrid_fetch_k(k)
+    try:
+        with tracing.span("lexical.search", k=fetch_k):
+            lexical_docs = [doc for doc, _ in lexical_index.search(query_text, collection_name, fetch_k, persist_directory, filter)]
+    except Exception as e:
+        print(f"关键词检索时出错，只使用向量检索的结果: {e}")
+        return vector_docs[:k]
+    return reciprocal_rank_fusion([vector_docs, lexical_docs], k)
+
+
+def query_vector_db_batch(queries, collection_name="knowledge_base", k=3, persist_directory=settings.PERSIST_DIRECTORY, mode="vector", filter=None, use_cache=True, rerank=False, fetch_k=None):
+    """
+    批量查询：未命中缓存的查询一次性计算向量（一次前向计算），再批量执行向量检索
+
+    结果缓存与 query_vector_db 共用，单条查询和批量查询可以互相命中
+
+    Args:
+        queries (list): 查询文本，或 {"query": ..., "k": ..., "filter": ...} 形式的字典，
+            字典中缺省的 k 和 filter 使用参数中的值
+        其余参数与 query_vector_db 相同
+
+    Returns:
+        list: 与 queries 顺序一致的结果列表，每项是文档片段列表
+    """
+    if mode not in ("vector", "lexical", "hybrid"):
+        raise ValueError(f"Unsupported query mode: {mode}")
+    specs = []
+    for query in queries:
+        if isinstance(query, dict):
+            specs.append((query["query"], query.get("k") or k, query.get("filter", filter)))
+        else:
+            specs.append((query, k, filter))
+    if not specs:
+        return []
+
+    with tracing.span("retrieve.batch", collection=collection_name, mode=mode, rerank=bool(rerank), queries=len(specs)) as span:
+        results = [None] * len(specs)
+        keys = [None] * len(specs)
+        fetch_ks = [max(fetch_k or max(qk * 5, 20), qk) if rerank else qk for _, qk, _ in specs]
+        if use_cache:
+            try:
+                version = manifest.get_version(collection_name, persist_directory)
+                for i, (query_text, qk, qfilter) in enumerate(specs):
+                    keys[i] = make_key(collection_name, query_text, qk, qfilter, mode, version,
+                                       persist_directory=os.path.abspath(persist_directory),
+                                       rerank=fetch_ks[i] if rerank else None)
+                    results[i] = _cache_get(keys[i])
+            except Exception as e:
+                print(f"读取查询缓存时出错: {e}")
+                keys = [None] * len(specs)
+        missing = [i for i, result in enumerate(results) if result is None]
+        span.set(cache_hits=len(specs) - len(missing))
+
+        if missing:
+            searched = _search_batch(
+                [specs[i][0] for i in missing], collection_name, [fetch_ks[i] for i in missing],
+                persist_directory, mode, [specs[i][2] for i in missing],
+            )
+            for i, docs in zip(missing, searched):
+                if rerank:
+                    docs = _rerank(specs[i][0], docs, specs[i][1])
+                results[i] = list(docs)
+                if keys[i] is not None and docs:
+                    _cache_put(keys[i], docs)
+        span.set(items=sum(len(result) for result in results))
+    return [list(result) for result in results]
+
+
+def _search_batch(query_texts, collection_name, ks, persist_directory, mode, filters):
+    if mode == "lexical":
+        return [_search(q, collection_name, qk, persist_directory, mode, f) for q, qk, f in zip(query_texts, ks, filters)]
+
+    store = load_vector_db(collection_name, persist_directory)
+    if store is None:
+        return [[] for _ in query_texts]
+    try:
+        search_ks = [_hybrid_fetch_k(qk) for qk in ks] if mode == "hybrid" else ks
+        vector_results = store.similarity_search_batch(query_texts, search_ks, filters)
+        if mode == "hybrid":
+            return [
+                _fuse_lexical(q, docs, collection_name, qk, persist_directory, f)
+                for q, docs, qk, f in zip(query_texts, vector_results, ks, filters)
+            ]
+        return vector_results
+    except Exception as e:
+        print(f"批量查询数据库时出错: {e}")
+        return [[] for _ in query_texts]
+
+
+def _rerank(query_text, candidates, k):
+    try:
+        from tools.rerank import rerank
+        with tracing.span("rerank", items=len(candidates), k=k):
+            return rerank(query_text, candidates, k)
+    except Exception as e:
+        # 重排模型不可用时退回检索本身的排序
+        print(f"重排时出错，使用原始检索顺序: {e}")
+        return candidates[:k]
+
+
+# 异步查询使用的线程池（嵌入计算和向量检索都是阻塞调用）
+_query_executor = ThreadPoolExecutor(
+    max_workers=settings.get("retrieval.query_workers"), thread_name_prefix="query-db"
+)
+
+
+async def aquery_vector_db(query_text, collection_name="knowledge_base", k=3, **kwargs):
+    """
+    query_vector_db 的异步版本，在线程池中执行，不会阻塞事件循环
+    """
+    loop = asyncio.get_running_loop()
+    # run_in_executor 不会传递 contextvars，手动复制上下文，让检索的 span 挂在调用方的 span 下
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _query_executor, lambda: context.run(query_vector_db, query_text, collection_name, k, **kwargs)
+    )
+
+
+async def aquery_vector_db_batch(queries, collection_name="knowledge_base", k=3, **kwargs):
+    """
+    query_vector_db_batch 的异步版本，在线程池中执行
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _query_executor, lambda: context.run(query_vector_db_batch, queries, collection_name, k, **kwargs)
+    )
+
+
+def query_cache_stats():
+    """返回查询结果缓存的命中统计"""
+    return query_cache.stats()
+
+
+def list_collections(persist_directory=settings.PERSIST_DIRECTORY):
     """返回指定目录下的所有集合名称列表。"""
     try:
-        client = chromadb.PersistentClient(path=persist_directory)
-        cols = client.list_collections()
-        return [c.name for c in cols]
+        return vector_store.list_collections(persist_directory)
     except Exception as e:
         print(f"列出集合时出错: {e}")
         return []
@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from tools import settings
+load_dotenv()
+
+# 默认的本地嵌入模型路径
+EMBEDDING_MODEL_PATH = settings.EMBEDDING_MODEL_PATH
+
+# 嵌入推理后端：huggingface 使用 HuggingFaceEmbeddings；torch、int8、onnx、onnx-int8 使用 tools.embedding_engine
+EMBEDDING_BACKEND = settings.get("embedding.backend")
+
+# 是否启用持久化嵌入缓存（设为 0 关闭）
+EMBEDDING_CACHE_ENABLED = settings.get("embedding.cache")
+
+# 同时保持打开的集合句柄上限（LRU 淘汰）
+MAX_OPEN_COLLECTIONS = settings.get("vector_store.max_open_collections")
+
+_lock = threading.RLock()
+_embeddings = None
+_clients = {}
+_stores = OrderedDict()
+
+
+def get_embeddings():
+    """
+    获取进程内共享的嵌入模型，首次调用时才加载
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                print(f"正在加载嵌入模型: {EMBEDDING_MODEL_PATH}")
+                if EMBEDDING_BACKEND == "huggingface":
+                    from langchain_huggingface import HuggingFaceEmbeddings
+                    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_PATH)
+                else:
+                    from tools.embedding_engine import load_engine
+                    embeddings = load_engine(EMBEDDING_MODEL_PATH, EMBEDDING_BACKEND)
+                if EMBEDDING_CACHE_ENABLED:
+                    from tools.embedding_cache import CachedEmbeddings, model_id_from_path
+                    model_id = model_id_from_path(EMBEDDING_MODEL_PATH)
+                    # 量化和 ONNX 后端的向量与 fp32 略有差异，缓存分开存放
+                    backend = getattr(embeddings, "backend", "torch")
+                    if backend != "torch":
+                        model_id = f"{model_id}:{backend}"
+                    embeddings = CachedEmbeddings(embeddings, model_id)
+                _embeddings = embeddings
+    return _embeddings
+
+
+def register_embeddings(embeddings):
+    """
+    替换进程内共享的嵌入模型（例如基准测试或离线环境使用的轻量模型）
+
+    已缓存的向量存储会一并关闭，之后按需重新打开
+    """
+    global _embeddings
+    with _lock:
+        _embeddings = embeddings
+        while _stores:
+            _close_store(_stores.popitem()[1])
+
+
+def embedding_cache_stats():
+    """
+    返回嵌入缓存的命中统计；未启用缓存或模型尚未加载时返回 None
+    """
+    stats = getattr(_embeddings, "stats", None)
+    return stats() if stats else None
+
+
+def get_client(persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    获取指定目录对应的共享 chromadb.PersistentClient
+    """
+    key = os.path.abspath(persist_directory)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            import chromadb
+            client = chromadb.PersistentClient(path=persist_directory)
+            _clients[key] = client
+        return client
+
+
+def get_store(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    获取 (persist_directory, collection_name) 对应的共享向量存储（见 tools.vector_store）
+
+    后端由集合的数据决定；超过 MAX_OPEN_COLLECTIONS 时关闭最近最少使用的存储
+    """
+    key = (os.path.abspath(persist_directory), collection_name)
+    with _lock:
+        store = _stores.get(key)
+        if store is not None:
+            _stores.move_to_end(key)
+            return store
+
+        from tools.vector_store import open_store
+        store = open_store(collection_name, persist_directory)
+        _stores[key] = store
+        while len(_stores) > MAX_OPEN_COLLECTIONS:
+            _, evicted = _stores.popitem(last=False)
+            _close_store(evicted)
+        return store
+
+
+def warm_up(collection_name=None, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    预热：提前加载嵌入模型（以及可选的集合句柄），避免首个请求承担冷启动开销
+    """
+    get_embeddings()
+    if collection_name:
+        get_store(collection_name, persist_directory)
+
+
+def invalidate(persist_directory=None, collection_name=None):
+    """
+    使缓存的客户端和集合句柄失效
+
+    Args:
+        persist_directory (str): 只清理该目录下的句柄；为 None 时清理全部
+        collection_name (str): 只清理该集合的句柄，客户端保持不变
+    """
+    with _lock:
+        if persist_directory is None:
+            targets = set(_clients) | {key[0] for key in _stores}
+        else:
+            targets = [os.path.abspath(persist_directory)]
+
+        for key in list(_stores):
+            if key[0] in targets and collection_name in (None, key[1]):
+                _close_store(_stores.pop(key))
+
+        if collection_name is not None:
+            return
+
+        released = [_clients[path] for path in targets if path in _clients]
+        if released:
+            # chromadb 的系统缓存是进程级的，清理后所有客户端都需要重建
+            _release_system(released[0])
+            _clients.clear()
+            while _stores:
+                _close_store(_stores.popitem()[1])
+
+
+def _release_system(client):
+    """关闭 chromadb 内部缓存的系统实例，释放数据库文件句柄"""
+    try:
+        client.clear_system_cache()
+    except Exception as e:
+        print(f"释放数据库客户端时出错: {e}")
+
+
+def _close_store(store):
+    """关闭向量存储，把尚未保存的索引写回磁盘"""
+    try:
+        store.close()
+    except Exception as e:
+        print(f"关闭向量存储时出错: {e}")
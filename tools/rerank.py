@@ -0,0 +1,95 @@
+"""
+交叉编码器重排：对检索出的候选片段逐一与查询拼接打分，只保留最相关的前 k 个
+
+模型在进程内只加载一次；(查询, 片段ID) 的得分会被缓存，重复查询不再经过模型
+"""
+import hashlib
+import threading
+
+from tools import settings
+from tools.query_cache import QueryCache, normalize_query
+
+# 默认的本地重排模型路径，可通过环境变量覆盖
+RERANKER_MODEL_PATH = settings.get("rerank.model_path")
+
+# 查询与片段拼接后的最大长度（token）
+RERANKER_MAX_LENGTH = settings.get("rerank.max_length")
+
+# 一次前向计算的最大候选数，默认足以让常见的候选规模一次算完
+RERANK_BATCH_SIZE = settings.get("rerank.batch_size")
+
+_lock = threading.Lock()
+_reranker = None
+
+# 得分只取决于模型、查询和片段内容，不需要过期时间
+score_cache = QueryCache(
+    max_entries=settings.get("rerank.cache_max_entries"), ttl=float("inf")
+)
+
+
+def get_reranker():
+    """
+    获取进程内共享的交叉编码器，首次调用时才加载
+    """
+    global _reranker
+    if _reranker is None:
+        with _lock:
+            if _reranker is None:
+                from sentence_transformers import CrossEncoder
+                print(f"正在加载重排模型: {RERANKER_MODEL_PATH}")
+                _reranker = CrossEncoder(RERANKER_MODEL_PATH, max_length=RERANKER_MAX_LENGTH)
+    return _reranker
+
+
+def register_reranker(reranker):
+    """
+    替换共享的重排模型（例如测试使用的轻量模型），需要提供 predict(pairs, batch_size=...) 方法
+    """
+    global _reranker
+    with _lock:
+        _reranker = reranker
+        score_cache.clear()
+
+
+def _chunk_key(doc):
+    # 没有片段ID时用内容哈希代替
+    return getattr(doc, "id", None) or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+def score_documents(query_text, docs, batch_size=RERANK_BATCH_SIZE):
+    """
+    返回每个片段与查询的相关性得分（越大越相关），未缓存的片段在一次批量前向计算中打分
+    """
+    query_key = normalize_query(query_text)
+    scores = [None] * len(docs)
+    missing = []
+    for i, doc in enumerate(docs):
+        cached = score_cache.get((query_key, _chunk_key(doc)))
+        if cached is None:
+            missing.append(i)
+        else:
+            scores[i] = cached
+
+    if missing:
+        pairs = [(query_text, docs[i].page_content) for i in missing]
+        predicted = get_reranker().predict(pairs, batch_size=max(1, min(batch_size, len(pairs))))
+        for i, score in zip(missing, predicted):
+            scores[i] = float(score)
+            score_cache.put((query_key, _chunk_key(docs[i])), scores[i])
+    return scores
+
+
+def rerank(query_text, docs, k=3, batch_size=RERANK_BATCH_SIZE):
+    """
+    按交叉编码器得分重新排序候选片段，返回前 k 个
+    """
+    if not docs:
+        return []
+    scores = score_documents(query_text, docs, batch_size)
+    order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+    return [docs[i] for i in order[:k]]
+
+
+def rerank_cache_stats():
+    """返回重排得分缓存的命中统计"""
+    return score_cache.stats()
@@ -0,0 +1,201 @@
+"""
+本地 HTTP 检索服务：通过 HTTP 提供检索、导入、删除和列出集合等功能
+
+服务进程只加载一次嵌入模型，集合句柄由注册表复用；并发请求的查询嵌入会在几毫秒的时间窗口内合并成一次前向计算。
+导入请求提交到后台任务队列（见 tools.jobs），立即返回任务ID。/metrics 以 Prometheus 文本格式导出各阶段的耗时（见 tools.tracing）。
+
+用法：
+    python -m tools.server --host 127.0.0.1 --port 8600 --collection knowledge_base
+
+    curl -X POST http://127.0.0.1:8600/search -H "Content-Type: application/json" \\
+         -d '{"query": "如何配置嵌入模型", "collection": "knowledge_base", "k": 3}'
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+
+from tools import settings
+from tools import manifest, tracing, answer_cache
+from tools.registry import get_embeddings, register_embeddings, warm_up, embedding_cache_stats
+from tools.query_db import query_vector_db, query_vector_db_batch, list_collections, query_cache_stats
+from tools.ingestion import delete_by_source_file, delete_collection
+from tools.jobs import get_job_queue
+from tools.micro_batch import MicroBatchingEmbeddings
+
+
+
+class SearchRequest(BaseModel):
+    query: str
+    collection: str = "knowledge_base"
+    k: int = Field(3, ge=1, le=100)
+    mode: str = "vector"
+    filter: Optional[dict] = None
+    rerank: bool = False
+    fetch_k: Optional[int] = None
+
+
+class BatchQuery(BaseModel):
+    query: str
+    k: Optional[int] = Field(None, ge=1, le=100)
+    filter: Optional[dict] = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: list[BatchQuery] = Field(..., min_length=1, max_length=1000)
+    collection: str = "knowledge_base"
+    k: int = Field(3, ge=1, le=100)
+    mode: str = "vector"
+    filter: Optional[dict] = None
+    rerank: bool = False
+    fetch_k: Optional[int] = None
+
+
+def _serialize(doc):
+    return {"id": getattr(doc, "id", None), "content": doc.page_content, "metadata": doc.metadata}
+
+
+def create_app(persist_directory=settings.PERSIST_DIRECTORY, warm_collections=(), micro_batch=True):
+    """
+    创建服务应用
+
+    Args:
+        persist_directory (str): 数据库持久化目录
+        warm_collections (list): 启动时预先打开的集合
+        micro_batch (bool): 是否把并发的查询嵌入合并成批
+    """
+
+    @asynccontextmanager
+    async def lifespan(app):
+        # 启动时加载模型并打开集合，首个请求不承担冷启动开销
+        embeddings = get_embeddings()
+        if micro_batch and not isinstance(embeddings, MicroBatchingEmbeddings):
+            register_embeddings(MicroBatchingEmbeddings(embeddings))
+        for collection_name in warm_collections:
+            warm_up(collection_name, persist_directory)
+        get_job_queue(persist_directory)
+        print(f"检索服务已就绪，数据库目录: {persist_directory}")
+        yield
+
+    app = FastAPI(title="个人知识库检索服务", lifespan=lifespan)
+
+    # 路由使用普通函数，FastAPI 在线程池中执行它们，并发请求的查询嵌入因此可以被合并
+    @app.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    @app.post("/search")
+    def search(request: SearchRequest):
+        if request.mode not in ("vector", "lexical", "hybrid"):
+            raise HTTPException(status_code=400, detail=f"Unsupported query mode: {request.mode}")
+        docs = query_vector_db(
+            request.query, request.collection, request.k, persist_directory=persist_directory,
+            mode=request.mode, filter=request.filter, rerank=request.rerank, fetch_k=request.fetch_k,
+        )
+        return {"results": [_serialize(doc) for doc in docs]}
+
+    @app.post("/search/batch")
+    def search_batch(request: BatchSearchRequest):
+        """批量检索：所有查询的向量一次计算，结果与 queries 顺序一致"""
+        if request.mode not in ("vector", "lexical", "hybrid"):
+            raise HTTPException(status_code=400, detail=f"Unsupported query mode: {request.mode}")
+        results = query_vector_db_batch(
+            [q.model_dump(exclude_none=True) for q in request.queries], request.collection, request.k,
+            persist_directory=persist_directory, mode=request.mode, filter=request.filter,
+            rerank=request.rerank, fetch_k=request.fetch_k,
+        )
+        return {"results": [[_serialize(doc) for doc in docs] for docs in results]}
+
+    @app.get("/collections")
+    def collections():
+        return {"collections": list_collections(persist_directory)}
+
+    @app.get("/collections/{collection}/files")
+    def files(collection: str):
+        return {"files": manifest.list_files(collection, persist_directory)}
+
+    @app.delete("/collections/{collection}")
+    def drop_collection(collection: str):
+        delete_collection(collection, persist_directory)
+        return {"collection": collection, "deleted": True}
+
+    @app.delete("/collections/{collection}/files/{source_file:path}")
+    def delete_file(collection: str, source_file: str):
+        deleted = delete_by_source_file(source_file, collection, persist_directory)
+        if not deleted:
+            raise HTTPException(status_code=404, detail=f"未找到与 {source_file} 相关的文档")
+        return {"source_file": source_file, "deleted_chunks": deleted}
+
+    @app.post("/ingest", status_code=202)
+    def ingest(file: UploadFile = File(...), collection: str = Form("knowledge_base")):
+        suffix = os.path.splitext(file.filename or "")[1]
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+            shutil.copyfileobj(file.file, tmp_file)
+        try:
+            job_id = get_job_queue(persist_directory).submit(tmp_file.name, collection, file.filename)
+        finally:
+            os.unlink(tmp_file.name)
+        return {"job_id": job_id, "status": "queued"}
+
+    @app.get("/jobs/{job_id}")
+    def job(job_id: str):
+        result = get_job_queue(persist_directory).get(job_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail=f"任务不存在: {job_id}")
+        return result
+
+    @app.post("/jobs/{job_id}/cancel")
+    def cancel_job(job_id: str):
+        return {"job_id": job_id, "cancelled": get_job_queue(persist_directory).cancel(job_id)}
+
+    @app.get("/stats")
+    def stats():
+        embeddings = get_embeddings()
+        batch_stats = getattr(embeddings, "batch_stats", None)
+        return {
+            "query_cache": query_cache_stats(),
+            "embedding_cache": embedding_cache_stats(),
+            "micro_batch": batch_stats() if batch_stats else None,
+            "answer_cache": answer_cache.stats(persist_directory),
+            "spans": tracing.summarize(tracing.recent_spans()),
+        }
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        """各阶段耗时和计数，Prometheus 文本格式"""
+        return tracing.prometheus_text()
+
+    @app.get("/traces")
+    def traces(trace_id: Optional[str] = None, limit: int = 200):
+        """最近结束的 span，可按 trace_id 过滤"""
+        return tracing.recent_spans(trace_id, limit)
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地 HTTP 检索服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8600, help="监听端口")
+    parser.add_argument("--persist-directory", default=settings.PERSIST_DIRECTORY, help="数据库持久化目录")
+    parser.add_argument("--collection", nargs="*", default=[], help="启动时预先打开的集合")
+    parser.add_argument("--no-micro-batch", action="store_true", help="关闭查询嵌入的微批处理")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    app = create_app(args.persist_directory, args.collection, micro_batch=not args.no_micro_batch)
+    # 模型和集合句柄保存在进程内，因此只使用一个进程，并发由线程池承担
+    uvicorn.run(app, host=args.host, port=args.port, workers=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+集中配置：模型路径、存储目录、分块和检索参数都在这里定义
+
+优先级：环境变量（包括 .env）> 配置文件 > 默认值。配置文件默认是当前目录下的 zhiku.toml，
+可通过 ZHIKU_CONFIG 指定其他路径，例如：
+
+    [storage]
+    persist_directory = "./db_storage"
+
+    [embedding]
+    model_path = "/models/bge-large-zh-v1.5"
+    backend = "onnx-int8"
+
+    [chunking]
+    chunk_tokens = 384
+
+API Key 等密钥只从环境变量读取，不写入配置文件。查看当前生效的配置及其来源：
+
+    python -m tools.settings
+"""
+import os
+import sys
+import tomllib
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONFIG_PATH = os.getenv("ZHIKU_CONFIG", "zhiku.toml")
+
+# 配置项：“分组.名称” -> (环境变量, 默认值)；值的类型与默认值一致
+DEFAULTS = {
+    "storage.persist_directory": ("ZHIKU_PERSIST_DIRECTORY", "./db_storage"),
+    "storage.embedding_cache_path": ("ZHIKU_EMBEDDING_CACHE_PATH", "./embedding_cache/embeddings.sqlite3"),
+
+    "embedding.model_path": ("ZHIKU_EMBEDDING_MODEL", r"D:\code\model\model_store\BAAI\bge-large-zh-v1___5"),
+    "embedding.backend": ("ZHIKU_EMBEDDING_BACKEND", "huggingface"),
+    "embedding.cache": ("ZHIKU_EMBEDDING_CACHE", True),
+    "embedding.cache_max_entries": ("ZHIKU_EMBEDDING_CACHE_MAX_ENTRIES", 500000),
+    "embedding.threads": ("ZHIKU_EMBED_THREADS", 0),
+    "embedding.batch_size": ("ZHIKU_EMBED_BATCH_SIZE", "auto"),
+    "embedding.max_batch_tokens": ("ZHIKU_EMBED_MAX_BATCH_TOKENS", 16384),
+    "embedding.tolerance": ("ZHIKU_EMBED_TOLERANCE", 0.99),
+
+    "chunking.chunk_tokens": ("ZHIKU_CHUNK_TOKENS", 384),
+    "chunking.overlap_tokens": ("ZHIKU_CHUNK_OVERLAP_TOKENS", 48),
+    "chunking.tokenizer": ("ZHIKU_CHUNK_TOKENIZER", ""),
+
+    "ingestion.batch_size": ("ZHIKU_INGEST_BATCH_SIZE", 64),
+    "ingestion.job_workers": ("ZHIKU_JOB_WORKERS", 2),
+    "ingestion.job_stale_seconds": ("ZHIKU_JOB_STALE_SECONDS", 300.0),
+
+    "vector_store.backend": ("ZHIKU_VECTOR_BACKEND", "chroma"),
+    "vector_store.faiss_index_type": ("ZHIKU_FAISS_INDEX_TYPE", "hnsw"),
+    "vector_store.faiss_flush_every": ("ZHIKU_FAISS_FLUSH_EVERY", 20000),
+    "vector_store.max_open_collections": ("ZHIKU_MAX_OPEN_COLLECTIONS", 8),
+
+    "retrieval.query_cache_max_entries": ("ZHIKU_QUERY_CACHE_MAX_ENTRIES", 1024),
+    "retrieval.query_cache_ttl": ("ZHIKU_QUERY_CACHE_TTL", 600.0),
+    "retrieval.query_workers": ("ZHIKU_QUERY_WORKERS", 8),
+
+    "context.fetch_k": ("ZHIKU_CONTEXT_FETCH_K", 12),
+    "context.token_budget": ("ZHIKU_CONTEXT_TOKENS", 1200),
+    "context.mmr_lambda": ("ZHIKU_MMR_LAMBDA", 0.7),
+    "context.dedup_threshold": ("ZHIKU_DEDUP_THRESHOLD", 0.8),
+
+    "rerank.enabled": ("ZHIKU_RERANK", False),
+    "rerank.model_path": ("ZHIKU_RERANKER_MODEL", r"D:\code\model\model_store\BAAI\bge-reranker-base"),
+    "rerank.max_length": ("ZHIKU_RERANKER_MAX_LENGTH", 512),
+    "rerank.batch_size": ("ZHIKU_RERANK_BATCH_SIZE", 64),
+    "rerank.cache_max_entries": ("ZHIKU_RERANK_CACHE_MAX_ENTRIES", 20000),
+
+    "answer_cache.enabled": ("ZHIKU_ANSWER_CACHE", True),
+    "answer_cache.threshold": ("ZHIKU_ANSWER_CACHE_THRESHOLD", 0.95),
+    "answer_cache.ttl": ("ZHIKU_ANSWER_CACHE_TTL", 7 * 86400.0),
+    "answer_cache.max_entries": ("ZHIKU_ANSWER_CACHE_MAX_ENTRIES", 10000),
+
+    "server.batch_window_ms": ("ZHIKU_BATCH_WINDOW_MS", 5.0),
+    "server.max_batch_size": ("ZHIKU_MAX_BATCH_SIZE", 64),
+
+    "tracing.enabled": ("ZHIKU_TRACING", True),
+    "tracing.jsonl_path": ("ZHIKU_TRACE_PATH", ""),
+    "tracing.recent_spans": ("ZHIKU_TRACE_RECENT_SPANS", 5000),
+
+    "agent.base_url": ("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1"),
+    "agent.model": ("DEEPSEEK_MODEL", "deepseek-reasoner"),
+    "agent.tool_timeout": ("ZHIKU_TOOL_TIMEOUT", 60.0),
+    "agent.db_tool_timeout": ("ZHIKU_DB_TOOL_TIMEOUT", 30.0),
+    "agent.provider": ("ZHIKU_LLM_PROVIDER", "deepseek"),
+    "agent.mock_url": ("ZHIKU_MOCK_LLM_URL", "http://127.0.0.1:8700/v1"),
+
+    "search.provider": ("ZHIKU_SEARCH_PROVIDER", "tavily"),
+    "search.corpus_path": ("ZHIKU_SEARCH_CORPUS", ""),
+    "search.max_results": ("ZHIKU_SEARCH_MAX_RESULTS", 5),
+    "search.latency_ms": ("ZHIKU_SEARCH_LATENCY_MS", 0.0),
+
+    "conversation.max_turns": ("ZHIKU_MAX_TURNS", 8),
+    "conversation.max_tokens": ("ZHIKU_MAX_TOKENS_PER_QUESTION", 60000),
+    "conversation.compact_tokens": ("ZHIKU_COMPACT_TOKENS", 8000),
+    "conversation.memo_ttl": ("ZHIKU_TOOL_MEMO_TTL", 600.0),
+}
+
+
+def _load_file(path):
+    """读取配置文件并展开为“分组.名称”形式的字典，文件不存在时返回空字典"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        data = tomllib.load(f)
+    values = {}
+    for section, items in data.items():
+        if isinstance(items, dict):
+            for name, value in items.items():
+                values[f"{section}.{name}"] = value
+        else:
+            values[section] = items
+    unknown = set(values) - set(DEFAULTS)
+    if unknown:
+        print(f"⚠️ 配置文件 {path} 中有未知的配置项: {', '.join(sorted(unknown))}")
+    return values
+
+
+def _convert(value, default):
+    """把环境变量中的字符串转换为与默认值相同的类型"""
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+_file_values = _load_file(CONFIG_PATH)
+
+
+def get(key):
+    """返回配置项当前生效的值"""
+    env_name, default = DEFAULTS[key]
+    value = os.getenv(env_name)
+    if value is not None:
+        return _convert(value, default)
+    if key in _file_values:
+        return _file_values[key]
+    return default
+
+
+def source(key):
+    """返回配置项的来源：环境变量名、配置文件路径或 default"""
+    env_name, _ = DEFAULTS[key]
+    if os.getenv(env_name) is not None:
+        return env_name
+    if key in _file_values:
+        return CONFIG_PATH
+    return "default"
+
+
+# 最常用的配置，供函数参数的默认值使用
+PERSIST_DIRECTORY = get("storage.persist_directory")
+EMBEDDING_MODEL_PATH = get("embedding.model_path")
+
+
+def main(argv=None):
+    for key in DEFAULTS:
+        print(f"{key} = {get(key)!r}  ({source(key)})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
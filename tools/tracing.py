@@ -0,0 +1,300 @@
+"""
+轻量级埋点：记录导入、检索和问答各阶段的耗时、处理数量、token 用量和缓存命中
+
+    with tracing.span("ingest.embed", items=len(texts)) as s:
+        vectors = embeddings.embed_documents(texts)
+        s.set(dim=len(vectors[0]))
+
+span 可以嵌套，同一次请求（trace）中的 span 共享 trace_id。结束的 span 会：
+
+- 计入进程内的汇总（次数、耗时直方图、数量类属性之和），以 Prometheus 文本格式导出（HTTP 服务的 /metrics）
+- 放入最近 span 的环形缓冲区，供界面按 trace_id 展示单次请求的耗时
+- 配置了 tracing.jsonl_path 时逐行追加到 JSONL 文件，可用 python -m tools.tracing summary 离线汇总
+
+async 生成器在每次 yield 之间可能运行在不同的上下文中，跨 yield 的 span 应使用 start_span() / end()
+并显式传入 parent，而不是 with span(...)。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from tools import settings
+
+ENABLED = settings.get("tracing.enabled")
+
+# span 的 JSONL 输出文件，为空时不写文件
+JSONL_PATH = settings.get("tracing.jsonl_path")
+
+# 内存中保留的最近 span 数
+RECENT_SPANS = settings.get("tracing.recent_spans")
+
+# 耗时直方图的桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 这些数值属性会在汇总中累加并导出为计数器
+COUNTER_ATTRS = (
+    "items", "pages", "chunks", "cache_hits", "cache_misses",
+    "prompt_tokens", "completion_tokens", "reasoning_tokens",
+)
+
+_current = contextvars.ContextVar("zhiku_span", default=None)
+_lock = threading.Lock()
+_recent = deque(maxlen=RECENT_SPANS)
+_metrics = {}
+_jsonl_file = None
+
+
+class Span:
+    """一次被计时的操作；attrs 中记录处理数量、token 用量、缓存命中等属性"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "duration", "attrs", "error", "_started")
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.duration = None
+        self.attrs = dict(attrs or {})
+        self.error = None
+        self._started = time.perf_counter()
+
+    def set(self, **attrs):
+        """设置属性"""
+        self.attrs.update(attrs)
+
+    def add(self, **counts):
+        """累加数量类属性"""
+        for key, value in counts.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def end(self, error=None):
+        """结束计时并记录；重复调用只记录一次"""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = error if isinstance(error, str) else type(error).__name__
+        _record(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+def current_span():
+    """返回当前上下文中正在进行的 span，没有时返回 None"""
+    return _current.get()
+
+
+def start_span(name, parent=None, **attrs):
+    """
+    开始一个 span 但不设为当前 span，需要手动调用 end()
+
+    parent 默认为当前 span；传入 parent 时新 span 属于同一个 trace
+    """
+    return Span(name, parent if parent is not None else _current.get(), attrs)
+
+
+@contextmanager
+def span(name, parent=None, **attrs):
+    """在 with 块内计时，块内开始的 span 自动成为它的子 span；异常会记录在 error 中并继续抛出"""
+    current = start_span(name, parent, **attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=e)
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+
+def add(**counts):
+    """在当前 span 上累加数量类属性（例如缓存命中数），没有当前 span 时忽略"""
+    current = _current.get()
+    if current is not None:
+        current.add(**counts)
+
+
+def _open_jsonl():
+    global _jsonl_file
+    if _jsonl_file is None:
+        os.makedirs(os.path.dirname(os.path.abspath(JSONL_PATH)), exist_ok=True)
+        _jsonl_file = open(JSONL_PATH, "a", encoding="utf-8")
+    return _jsonl_file
+
+
+def _record(finished):
+    if not ENABLED:
+        return
+    record = finished.to_dict()
+    with _lock:
+        _recent.append(record)
+        metric = _metrics.get(finished.name)
+        if metric is None:
+            metric = _metrics[finished.name] = {
+                "count": 0, "errors": 0, "seconds": 0.0,
+                "buckets": [0] * len(BUCKETS), "counters": {},
+            }
+        metric["count"] += 1
+        metric["seconds"] += finished.duration
+        if finished.error:
+            metric["errors"] += 1
+        for i, bound in enumerate(BUCKETS):
+            if finished.duration <= bound:
+                metric["buckets"][i] += 1
+        for key in COUNTER_ATTRS:
+            value = finished.attrs.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric["counters"][key] = metric["counters"].get(key, 0) + value
+        if finished.attrs.get("cache_hit") is True:
+            metric["counters"]["cache_hits"] = metric["counters"].get("cache_hits", 0) + 1
+        if JSONL_PATH:
+            try:
+                f = _open_jsonl()
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                f.flush()
+            except OSError as e:
+                print(f"写入埋点文件时出错: {e}")
+
+
+def recent_spans(trace_id=None, limit=None):
+    """返回最近结束的 span（字典），可按 trace_id 过滤"""
+    with _lock:
+        spans = [s for s in _recent if trace_id is None or s["trace_id"] == trace_id]
+    return spans[-limit:] if limit else spans
+
+
+def trace_spans(trace_id):
+    """返回一次请求的全部 span，按开始时间排序"""
+    return sorted(recent_spans(trace_id), key=lambda s: s["start"])
+
+
+def reset():
+    """清空汇总和最近 span"""
+    with _lock:
+        _recent.clear()
+        _metrics.clear()
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def summarize(spans):
+    """
+    按 span 名称汇总次数、总耗时和分位数，按总耗时降序排列
+
+    Returns:
+        list: [{"name", "count", "errors", "total_s", "mean_ms", "p50_ms", "p95_ms", "max_ms", "counters"}, ...]
+    """
+    groups = {}
+    for s in spans:
+        groups.setdefault(s["name"], []).append(s)
+    rows = []
+    for name, items in groups.items():
+        durations = [s["duration"] for s in items]
+        counters = {}
+        for s in items:
+            for key in COUNTER_ATTRS:
+                value = s["attrs"].get(key)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    counters[key] = counters.get(key, 0) + value
+        rows.append({
+            "name": name,
+            "count": len(items),
+            "errors": sum(1 for s in items if s.get("error")),
+            "total_s": sum(durations),
+            "mean_ms": sum(durations) / len(durations) * 1000,
+            "p50_ms": _percentile(durations, 0.5) * 1000,
+            "p95_ms": _percentile(durations, 0.95) * 1000,
+            "max_ms": max(durations) * 1000,
+            "counters": counters,
+        })
+    return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text():
+    """以 Prometheus 文本格式导出汇总指标"""
+    with _lock:
+        metrics = {name: {**m, "buckets": list(m["buckets"]), "counters": dict(m["counters"])} for name, m in _metrics.items()}
+    lines = [
+        "# HELP zhiku_span_duration_seconds 各阶段耗时",
+        "# TYPE zhiku_span_duration_seconds histogram",
+    ]
+    for name, m in sorted(metrics.items()):
+        label = f'span="{_label(name)}"'
+        for bound, count in zip(BUCKETS, m["buckets"]):
+            lines.append(f'zhiku_span_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(f'zhiku_span_duration_seconds_bucket{{{label},le="+Inf"}} {m["count"]}')
+        lines.append(f"zhiku_span_duration_seconds_sum{{{label}}} {m['seconds']}")
+        lines.append(f"zhiku_span_duration_seconds_count{{{label}}} {m['count']}")
+    lines += ["# HELP zhiku_span_errors_total 出错的 span 数", "# TYPE zhiku_span_errors_total counter"]
+    for name, m in sorted(metrics.items()):
+        lines.append(f'zhiku_span_errors_total{{span="{_label(name)}"}} {m["errors"]}')
+    lines += ["# HELP zhiku_span_attr_total 各阶段处理的条目数、token 数和缓存命中数", "# TYPE zhiku_span_attr_total counter"]
+    for name, m in sorted(metrics.items()):
+        for key, value in sorted(m["counters"].items()):
+            lines.append(f'zhiku_span_attr_total{{span="{_label(name)}",attr="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def load_jsonl(path):
+    """读取 JSONL 埋点文件"""
+    spans = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                spans.append(json.loads(line))
+    return spans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="埋点数据汇总")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="按阶段汇总 JSONL 埋点文件")
+    summary_parser.add_argument("path", nargs="?", default=JSONL_PATH or None, help="JSONL 文件，默认 tracing.jsonl_path")
+    summary_parser.add_argument("--prefix", default=None, help="只汇总名称以此开头的 span，例如 llm.")
+    args = parser.parse_args(argv)
+
+    if not args.path:
+        print("请指定 JSONL 文件，或在配置中设置 tracing.jsonl_path")
+        return 1
+    spans = load_jsonl(args.path)
+    if args.prefix:
+        spans = [s for s in spans if s["name"].startswith(args.prefix)]
+    print(f"{'阶段':<24}{'次数':>8}{'总耗时(s)':>12}{'平均(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'最大(ms)':>10}  计数")
+    for row in summarize(spans):
+        counters = ", ".join(f"{k}={v:g}" for k, v in sorted(row["counters"].items()))
+        print(
+            f"{row['name']:<24}{row['count']:>8}{row['total_s']:>12.2f}{row['mean_ms']:>10.1f}"
+            f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['max_ms']:>10.1f}  {counters}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
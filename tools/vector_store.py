@@ -0,0 +1,1157 @@
+"""
+向量存储抽象：导入、查询和界面都通过统一的接口读写向量数据，不直接依赖具体的数据库
+
+后端：
+- chroma：默认后端，适合中小规模的知识库
+- faiss：本地 FAISS 索引（Flat / HNSW / IVF，IVF 可选 PQ 压缩），索引文件以内存映射方式打开，
+  原始向量保存在追加写入的 float32 文件中，片段内容和元数据保存在旁路的 SQLite 中；
+  也可以使用 int8 标量量化（sq8、hnsw_sq8）或二值符号编码（binary）的压缩索引，
+  一阶段检索后从内存映射的 float32 文件中取出候选向量做全精度重排
+
+集合使用哪个后端由持久化目录中的数据决定（存在 faiss/<集合>/config.json 即为 faiss），
+新建的集合使用环境变量 ZHIKU_VECTOR_BACKEND 指定的后端（默认 chroma）
+
+用法：
+    python -m tools.vector_store migrate --collection knowledge_base --to faiss --index-type hnsw
+    python -m tools.vector_store migrate --collection knowledge_base --to faiss --index-type binary --rescore 10
+    python -m tools.vector_store compact --collection knowledge_base
+    python -m tools.vector_store stats --collection knowledge_base
+"""
+import os
+import sys
+import json
+import math
+import atexit
+import shutil
+import uuid
+import sqlite3
+import argparse
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from langchain_core.documents import Document
+
+from tools import settings, tracing
+
+# 新建集合默认使用的后端
+DEFAULT_BACKEND = settings.get("vector_store.backend")
+
+FAISS_DIRNAME = "faiss"
+CONFIG_FILENAME = "config.json"
+INDEX_FILENAME = "index.faiss"
+VECTORS_FILENAME = "vectors.f32"
+SIDECAR_FILENAME = "meta.sqlite3"
+WRITE_LOCK_FILENAME = "write.lock"
+
+# chromadb.PersistentClient 在持久化目录中创建的数据库文件
+CHROMA_FILENAME = "chroma.sqlite3"
+
+# FAISS 后端支持的索引类型
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq", "sq8", "hnsw_sq8", "binary")
+
+# 需要先用已有向量训练的索引类型
+TRAINED_INDEX_TYPES = ("ivf", "ivfpq", "sq8", "hnsw_sq8")
+
+# 压缩索引默认取 k 的多少倍候选做全精度重排
+DEFAULT_RESCORE = {"ivfpq": 4, "sq8": 4, "hnsw_sq8": 4, "binary": 10}
+
+# FAISS 集合的默认配置，可以在创建集合或迁移时按集合覆盖
+DEFAULT_FAISS_OPTIONS = {
+    "index_type": settings.get("vector_store.faiss_index_type"),  # 见 INDEX_TYPES
+    "nlist": None,          # IVF 聚类中心数，默认按向量数自动选择
+    "nprobe": 16,           # IVF 查询时探查的聚类数
+    "pq_m": None,           # PQ 子向量数，默认自动选择能整除维度的值
+    "pq_bits": 8,           # 每个子向量的编码位数
+    "hnsw_m": 32,           # HNSW 每个节点的邻居数
+    "ef_construction": 200,
+    "ef_search": 64,
+    "train_size": 10000,    # IVF、SQ 需要先训练，向量数达到该值前使用精确的 Flat 索引
+    "rescore": None,        # 重排候选数为 k 的多少倍，None 按索引类型取 DEFAULT_RESCORE，0 关闭
+    "compact_ratio": 0.3,   # 已删除向量占比超过该值时自动压缩
+    "mmap": True,           # 以内存映射方式打开索引文件
+}
+
+# 内存中的索引每新增这么多向量就写回磁盘一次
+FLUSH_EVERY = settings.get("vector_store.faiss_flush_every")
+
+# 带过滤条件的查询中，匹配片段数不超过该值时直接对这些片段做精确检索
+EXACT_FILTER_LIMIT = 50000
+
+
+def _import_faiss():
+    try:
+        import faiss
+    except ImportError as e:
+        raise ImportError("使用 FAISS 后端需要安装 faiss-cpu：pip install faiss-cpu") from e
+    return faiss
+
+
+def _lock_file(fd):
+    """对文件加排他锁，其他进程持有时阻塞等待"""
+    os.lseek(fd, 0, os.SEEK_SET)
+    if os.name == "nt":
+        import msvcrt
+        while True:
+            # LK_LOCK 重试约 10 秒后抛出异常，继续等待
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+    import fcntl
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+
+def _unlock_file(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    if os.name == "nt":
+        import msvcrt
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def faiss_directory(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """返回 FAISS 集合的数据目录"""
+    return os.path.join(persist_directory, FAISS_DIRNAME, collection_name)
+
+
+def _collection_names(client):
+    # chromadb 0.6 返回名称列表，其他版本返回集合对象
+    return [getattr(c, "name", c) for c in client.list_collections()]
+
+
+def _chroma_names(persist_directory):
+    """目录中 Chroma 集合的名称；目录中没有 Chroma 数据时不导入 chromadb"""
+    if not os.path.exists(os.path.join(persist_directory, CHROMA_FILENAME)):
+        return []
+    from tools.registry import get_client
+    return _collection_names(get_client(persist_directory))
+
+
+def resolve_backend(collection_name, persist_directory=settings.PERSIST_DIRECTORY):
+    """
+    返回集合使用的后端名称
+    """
+    if os.path.exists(os.path.join(faiss_directory(collection_name, persist_directory), CONFIG_FILENAME)):
+        return "faiss"
+    if DEFAULT_BACKEND == "faiss":
+        # 默认后端改为 faiss 之前已经存在的 Chroma 集合继续使用 Chroma
+        if collection_name in _chroma_names(persist_directory):
+            return "chroma"
+    return DEFAULT_BACKEND
+
+
+def open_store(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY, backend=None, **options):
+    """
+    打开集合对应的向量存储；一般通过 tools.registry.get_store 获取共享实例
+    """
+    backend = backend or resolve_backend(collection_name, persist_directory)
+    if backend == "chroma":
+        return ChromaStore(collection_name, persist_directory)
+    if backend == "faiss":
+        return FaissStore(collection_name, persist_directory, **options)
+    raise ValueError(f"Unsupported vector backend: {backend}")
+
+
+def create_store(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY, backend=None, **options):
+    """
+    以指定的后端和配置创建集合，并返回注册表中的共享实例
+    """
+    from tools.registry import get_store, invalidate
+
+    backend = backend or DEFAULT_BACKEND
+    if backend == "faiss":
+        store = FaissStore(collection_name, persist_directory, **options)
+        # 显式创建的集合立即写入配置，此后即使还没有向量也按 FAISS 集合打开
+        store._save_config()
+        store.close()
+    else:
+        ChromaStore(collection_name, persist_directory)
+    invalidate(persist_directory, collection_name)
+    return get_store(collection_name, persist_directory)
+
+
+def list_collections(persist_directory=settings.PERSIST_DIRECTORY):
+    """返回目录下所有后端中的集合名称"""
+    names = set(_chroma_names(persist_directory))
+    root = os.path.join(persist_directory, FAISS_DIRNAME)
+    if os.path.isdir(root):
+        names.update(
+            name for name in os.listdir(root)
+            if os.path.exists(os.path.join(root, name, CONFIG_FILENAME))
+        )
+    return sorted(names)
+
+
+def _matches(metadata, where):
+    return all(metadata.get(key) == value for key, value in where.items())
+
+
+def _check_where(where):
+    for key, value in (where or {}).items():
+        if key.startswith("$") or isinstance(value, dict):
+            raise ValueError(f"Unsupported filter for FAISS backend: {key}")
+
+
+class VectorStore(ABC):
+    """
+    向量存储接口
+
+    所有后端都使用 L2 距离，search 返回的距离越小越相似
+    """
+
+    backend = None
+
+    def __init__(self, collection_name, persist_directory):
+        self.collection_name = collection_name
+        self.persist_directory = persist_directory
+
+    @abstractmethod
+    def add(self, ids, embeddings, documents, metadatas):
+        """写入片段，已存在的ID会被覆盖"""
+
+    @abstractmethod
+    def delete(self, ids):
+        """删除指定ID的片段"""
+
+    @abstractmethod
+    def get_ids(self, where=None):
+        """返回满足元数据条件的片段ID列表"""
+
+    @abstractmethod
+    def count(self):
+        """返回片段数量"""
+
+    @abstractmethod
+    def source_files(self):
+        """返回集合中所有片段的源文件名集合"""
+
+    @abstractmethod
+    def search(self, embedding, k=3, where=None):
+        """
+        按向量检索
+
+        Returns:
+            list: [(Document, 距离), ...]，按距离从小到大排列
+        """
+
+    def search_batch(self, embeddings, ks, wheres=None):
+        """
+        批量按向量检索，每个查询可以有自己的 k 和过滤条件
+
+        Returns:
+            list: 与 embeddings 顺序一致的 [(Document, 距离), ...] 列表
+        """
+        wheres = wheres or [None] * len(ks)
+        return [self.search(embedding, k, where) for embedding, k, where in zip(embeddings, ks, wheres)]
+
+    @abstractmethod
+    def iter_batches(self, batch_size=1000, include_embeddings=True):
+        """
+        分批遍历全部片段，每批是包含 ids、embeddings、documents、metadatas 的字典
+        """
+
+    @abstractmethod
+    def clear(self):
+        """删除全部片段，保留集合及其配置"""
+
+    def flush(self):
+        """把内存中的修改写回磁盘"""
+
+    def close(self):
+        """释放资源"""
+        self.flush()
+
+    def stats(self):
+        return {"backend": self.backend, "count": self.count()}
+
+    def add_documents(self, ids, docs, embeddings=None):
+        """计算文档片段的向量后写入"""
+        if embeddings is None:
+            from tools.registry import get_embeddings
+            embeddings = get_embeddings()
+        texts = [doc.page_content for doc in docs]
+        self.add(ids, embeddings.embed_documents(texts), texts, [doc.metadata for doc in docs])
+
+    def similarity_search(self, query_text, k=3, filter=None, embeddings=None):
+        """计算查询向量后检索，返回文档片段列表"""
+        if embeddings is None:
+            from tools.registry import get_embeddings
+            embeddings = get_embeddings()
+        with tracing.span("query.embed", items=1):
+            embedding = embeddings.embed_query(query_text)
+        with tracing.span("store.search", backend=self.backend, k=k) as s:
+            docs = [doc for doc, _ in self.search(embedding, k, filter)]
+            s.set(items=len(docs))
+        return docs
+
+    def similarity_search_batch(self, query_texts, ks, filters=None, embeddings=None):
+        """一次计算全部查询向量后批量检索，返回与 query_texts 顺序一致的文档片段列表"""
+        if embeddings is None:
+            from tools.registry import get_embeddings
+            embeddings = get_embeddings()
+        with tracing.span("query.embed", items=len(query_texts)):
+            embed_queries = getattr(embeddings, "embed_queries", None) or embeddings.embed_documents
+            vectors = embed_queries(list(query_texts))
+        with tracing.span("store.search", backend=self.backend, queries=len(query_texts)) as s:
+            results = [[doc for doc, _ in hits] for hits in self.search_batch(vectors, ks, filters)]
+            s.set(items=sum(len(docs) for docs in results))
+        return results
+
+
+def _chroma_where(where):
+    if not where:
+        return None
+    if len(where) == 1:
+        return dict(where)
+    # Chroma 的多个条件需要显式地用 $and 组合
+    return {"$and": [{key: value} for key, value in where.items()]}
+
+
+class ChromaStore(VectorStore):
+    """Chroma 后端，直接使用 chromadb 集合并写入预先计算好的向量"""
+
+    backend = "chroma"
+
+    def __init__(self, collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY):
+        from tools.registry import get_client
+
+        super().__init__(collection_name, persist_directory)
+        self._client = get_client(persist_directory)
+        self._collection = self._open()
+        get_max_batch_size = getattr(self._client, "get_max_batch_size", None)
+        self._max_batch_size = get_max_batch_size() if get_max_batch_size else 5000
+
+    def _open(self):
+        # 向量由调用方计算，不使用 chromadb 自带的嵌入函数
+        return self._client.get_or_create_collection(name=self.collection_name, embedding_function=None)
+
+    def add(self, ids, embeddings, documents, metadatas):
+        if hasattr(embeddings, "tolist"):
+            embeddings = embeddings.tolist()
+        for start in range(0, len(ids), self._max_batch_size):
+            end = start + self._max_batch_size
+            self._collection.upsert(
+                ids=list(ids[start:end]),
+                embeddings=list(embeddings[start:end]),
+                documents=list(documents[start:end]),
+                metadatas=list(metadatas[start:end]),
+            )
+
+    def delete(self, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), self._max_batch_size):
+            self._collection.delete(ids=ids[start:start + self._max_batch_size])
+
+    def get_ids(self, where=None):
+        return self._collection.get(where=_chroma_where(where), include=[])["ids"]
+
+    def count(self):
+        return self._collection.count()
+
+    def source_files(self):
+        sources = set()
+        for batch in self.iter_batches(include_embeddings=False):
+            sources.update(m.get("source_file") for m in batch["metadatas"] if m and m.get("source_file"))
+        return sources
+
+    def search(self, embedding, k=3, where=None):
+        if hasattr(embedding, "tolist"):
+            embedding = embedding.tolist()
+        result = self._collection.query(
+            query_embeddings=[embedding],
+            n_results=k,
+            where=_chroma_where(where),
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            (Document(page_content=document or "", metadata=metadata or {}, id=chunk_id), distance)
+            for chunk_id, document, metadata, distance in zip(
+                result["ids"][0], result["documents"][0], result["metadatas"][0], result["distances"][0]
+            )
+        ]
+
+    def search_batch(self, embeddings, ks, wheres=None):
+        # Chroma 一次查询只接受一个过滤条件，按过滤条件分组，每组一次查询
+        wheres = wheres or [None] * len(ks)
+        groups = {}
+        for i, where in enumerate(wheres):
+            groups.setdefault(json.dumps(where, sort_keys=True), []).append(i)
+        results = [None] * len(ks)
+        for members in groups.values():
+            query_embeddings = [
+                embeddings[i].tolist() if hasattr(embeddings[i], "tolist") else embeddings[i] for i in members
+            ]
+            result = self._collection.query(
+                query_embeddings=query_embeddings,
+                n_results=max(ks[i] for i in members),
+                where=_chroma_where(wheres[members[0]]),
+                include=["documents", "metadatas", "distances"],
+            )
+            for j, i in enumerate(members):
+                results[i] = [
+                    (Document(page_content=document or "", metadata=metadata or {}, id=chunk_id), distance)
+                    for chunk_id, document, metadata, distance in zip(
+                        result["ids"][j], result["documents"][j], result["metadatas"][j], result["distances"][j]
+                    )
+                ][:ks[i]]
+        return results
+
+    def iter_batches(self, batch_size=1000, include_embeddings=True):
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        offset = 0
+        while True:
+            batch = self._collection.get(include=include, limit=batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+            yield {
+                "ids": batch["ids"],
+                "embeddings": batch.get("embeddings") if include_embeddings else None,
+                "documents": [d or "" for d in batch["documents"]],
+                "metadatas": [m or {} for m in batch["metadatas"]],
+            }
+            offset += len(batch["ids"])
+
+    def clear(self):
+        try:
+            self._client.delete_collection(name=self.collection_name)
+        except Exception as e:
+            print(f"集合 '{self.collection_name}' 不存在或删除失败: {e}")
+        self._collection = self._open()
+
+    def drop(self):
+        """删除 Chroma 中的整个集合（迁移到其他后端后使用）"""
+        self._client.delete_collection(name=self.collection_name)
+
+
+# 尚未写回磁盘的 FAISS 集合，进程退出时统一保存
+_open_faiss_stores = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for store in list(_open_faiss_stores):
+        try:
+            store.flush()
+        except Exception as e:
+            print(f"保存 FAISS 索引时出错: {e}")
+
+
+class FaissStore(VectorStore):
+    """
+    FAISS 后端
+
+    - vectors.f32：按行追加写入的原始向量，行号即 FAISS 中的ID
+    - meta.sqlite3：行号到片段ID、内容和元数据的映射；删除片段时只删除这里的记录，
+      索引中残留的向量在查询时被过滤，累积到一定比例后通过 compact() 重建
+    - index.faiss：ANN 索引，定期写回磁盘；重新打开时补上最后一次保存之后写入的向量
+    - write.lock：写入（add / delete / flush / compact / clear）期间持有的跨进程文件锁；
+      每次追加或重新编号行号时更新 meta 中的 generation，其他进程发现变化后丢弃内存中的索引并重新加载
+    """
+
+    backend = "faiss"
+
+    def __init__(self, collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY, **options):
+        super().__init__(collection_name, persist_directory)
+        self.directory = faiss_directory(collection_name, persist_directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self._config_path = os.path.join(self.directory, CONFIG_FILENAME)
+        self._index_path = os.path.join(self.directory, INDEX_FILENAME)
+        self._vectors_path = os.path.join(self.directory, VECTORS_FILENAME)
+
+        config = dict(DEFAULT_FAISS_OPTIONS, dim=None)
+        saved = None
+        if os.path.exists(self._config_path):
+            with open(self._config_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            config.update(saved)
+        config.update({key: value for key, value in options.items() if value is not None})
+        if config["index_type"] not in INDEX_TYPES:
+            raise ValueError(f"Unsupported FAISS index type: {config['index_type']}")
+        self.config = config
+        # 配置文件决定集合使用 FAISS 后端，只打开集合时不写入；新集合在第一次写入向量时保存
+        if saved is not None and config != {**DEFAULT_FAISS_OPTIONS, "dim": None, **saved}:
+            self._save_config()
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(self.directory, SIDECAR_FILENAME), check_same_thread=False, timeout=30)
+        self._db.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "CREATE TABLE IF NOT EXISTS items ("
+            "row INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, source_file TEXT, "
+            "document TEXT NOT NULL, metadata TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_items_source ON items(source_file);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+        )
+        self._index = None
+        self._index_kind = None
+        self._mmapped = False
+        self._unsaved = 0
+        self._dirty = False
+        self._matrix = None
+        self._lock_fd = os.open(os.path.join(self.directory, WRITE_LOCK_FILENAME), os.O_RDWR | os.O_CREAT)
+        self._write_depth = 0
+        self._generation = None
+        with self._writing():
+            self._finish_compaction()
+        _open_faiss_stores.add(self)
+
+    # ---- 内部工具 ----
+
+    @contextmanager
+    def _writing(self):
+        """持有线程锁和跨进程的写锁；可以嵌套（例如 add 中触发 flush、flush 中触发 compact）"""
+        with self._lock:
+            if self._write_depth == 0:
+                _lock_file(self._lock_fd)
+                try:
+                    self._sync()
+                except BaseException:
+                    _unlock_file(self._lock_fd)
+                    raise
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    _unlock_file(self._lock_fd)
+
+    def _sync(self):
+        """其他进程追加或重新编号过行号时，丢弃内存中的索引，下次使用时从磁盘重新加载"""
+        generation = self._get_meta("generation")
+        if generation == self._generation:
+            return
+        self._generation = generation
+        self._index = None
+        self._index_kind = None
+        self._matrix = None
+        self._mmapped = False
+        self._unsaved = 0
+        self._dirty = False
+        if self.config["dim"] is None and os.path.exists(self._config_path):
+            with open(self._config_path, encoding="utf-8") as f:
+                self.config["dim"] = json.load(f).get("dim")
+
+    def _bump_generation(self):
+        """在调用方的事务中记录行号发生了变化"""
+        self._generation = uuid.uuid4().hex
+        self._set_meta("generation", self._generation)
+
+    def _finish_compaction(self):
+        """
+        处理上次中断的压缩：行号已重新编号（meta 中有 compacting 标记）时用临时文件完成替换，
+        否则原来的 vectors.f32 和行号仍然一致，丢弃临时文件即可
+        """
+        tmp_path = self._vectors_path + ".tmp"
+        if self._get_meta("compacting") is None:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        print(f"正在完成 FAISS 集合 '{self.collection_name}' 上次中断的压缩...")
+        if os.path.exists(self._index_path):
+            os.remove(self._index_path)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, self._vectors_path)
+        with self._db:
+            self._db.execute("DELETE FROM meta WHERE key = 'compacting'")
+            self._bump_generation()
+
+    def _save_config(self):
+        tmp_path = self._config_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.config, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._config_path)
+
+    def _get_meta(self, key, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value)),
+        )
+
+    def _row_count(self):
+        """vectors.f32 中的行数（包括已删除的行）"""
+        dim = self.config["dim"]
+        if not dim or not os.path.exists(self._vectors_path):
+            return 0
+        return os.path.getsize(self._vectors_path) // (dim * 4)
+
+    def _vectors(self, rows):
+        """以内存映射方式读取指定行的原始向量"""
+        import numpy as np
+
+        total = self._row_count()
+        if self._matrix is None or self._matrix.shape[0] != total:
+            self._matrix = None
+            if total == 0:
+                return np.empty((0, self.config["dim"] or 0), dtype="float32")
+            self._matrix = np.memmap(self._vectors_path, dtype="float32", mode="r", shape=(total, self.config["dim"]))
+        return np.ascontiguousarray(self._matrix[rows])
+
+    def _new_index(self, kind, train_vectors=None):
+        faiss = _import_faiss()
+        config = self.config
+        dim = config["dim"]
+        if kind == "flat":
+            return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        if kind == "hnsw":
+            base = faiss.IndexHNSWFlat(dim, config["hnsw_m"])
+            base.hnsw.efConstruction = config["ef_construction"]
+            return faiss.IndexIDMap2(base)
+        if kind == "binary":
+            # 每一维取符号位，1024 维向量压缩为 128 字节，按汉明距离检索
+            if dim % 8:
+                raise ValueError(f"Binary index requires a dimension divisible by 8, got {dim}")
+            return faiss.IndexBinaryIDMap2(faiss.IndexBinaryFlat(dim))
+        if kind in ("sq8", "hnsw_sq8"):
+            # 每一维量化为 int8，内存占用是 float32 的四分之一
+            if kind == "sq8":
+                base = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+            else:
+                base = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, config["hnsw_m"])
+                base.hnsw.efConstruction = config["ef_construction"]
+            print(f"正在训练 {kind} 索引（{len(train_vectors)} 个向量）...")
+            base.train(train_vectors)
+            return faiss.IndexIDMap2(base)
+
+        nlist = config["nlist"] or int(min(65536, max(16, 4 * math.sqrt(len(train_vectors)))))
+        quantizer = faiss.IndexFlatL2(dim)
+        if kind == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            pq_m = config["pq_m"] or max(m for m in range(1, max(1, dim // 16) + 1) if dim % m == 0)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, config["pq_bits"])
+        print(f"正在训练 {kind} 索引（{len(train_vectors)} 个向量，{nlist} 个聚类）...")
+        index.train(train_vectors)
+        return index
+
+    def _apply_search_params(self):
+        faiss = _import_faiss()
+        if self._index_kind in ("ivf", "ivfpq"):
+            faiss.extract_index_ivf(self._index).nprobe = self.config["nprobe"]
+        elif self._index_kind in ("hnsw", "hnsw_sq8"):
+            faiss.downcast_index(self._index.index).hnsw.efSearch = self.config["ef_search"]
+
+    def _encode(self, vectors):
+        """把 float32 向量转换为当前索引接受的输入"""
+        import numpy as np
+
+        if self._index_kind == "binary":
+            return np.packbits(vectors > 0, axis=1)
+        return vectors
+
+    def _rescore_factor(self):
+        rescore = self.config["rescore"]
+        if rescore is None:
+            rescore = DEFAULT_RESCORE.get(self._index_kind, 0)
+        return rescore
+
+    def _read_index(self, flags=0):
+        faiss = _import_faiss()
+        if self._index_kind == "binary":
+            return faiss.read_index_binary(self._index_path, flags)
+        return faiss.read_index(self._index_path, flags)
+
+    def _load_index(self):
+        """加载索引，并补上最后一次保存之后写入的向量"""
+        if self._index is not None:
+            return
+        faiss = _import_faiss()
+        indexed_rows = int(self._get_meta("indexed_rows", 0))
+        if os.path.exists(self._index_path):
+            self._index_kind = self._get_meta("index_kind", self.config["index_type"])
+            self._index = None
+            if self.config["mmap"]:
+                try:
+                    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+                    self._index = self._read_index(flags)
+                    self._mmapped = True
+                except Exception:
+                    self._index = None
+            if self._index is None:
+                self._index = self._read_index()
+                self._mmapped = False
+            self._apply_search_params()
+        else:
+            indexed_rows = 0
+
+        pending = [row for (row,) in self._db.execute(
+            "SELECT row FROM items WHERE row >= ? ORDER BY row", (indexed_rows,)
+        )]
+        if pending:
+            self._index_add(pending)
+
+    def _ensure_writable(self):
+        """内存映射的索引是只读的，写入前改为完整读入内存"""
+        if self._index is None:
+            kind = "flat" if self.config["index_type"] in TRAINED_INDEX_TYPES else self.config["index_type"]
+            self._index = self._new_index(kind)
+            self._index_kind = kind
+            self._apply_search_params()
+        elif self._mmapped:
+            self._index = self._read_index()
+            self._mmapped = False
+            self._apply_search_params()
+
+    def _index_add(self, rows, vectors=None):
+        import numpy as np
+
+        self._ensure_writable()
+        if vectors is None:
+            vectors = self._vectors(rows)
+        self._index.add_with_ids(self._encode(vectors), np.asarray(rows, dtype="int64"))
+        self._unsaved += len(rows)
+        self._dirty = True
+
+    def _rebuild(self, kind):
+        """用全部有效向量重新构建索引"""
+        import numpy as np
+
+        rows = [row for (row,) in self._db.execute("SELECT row FROM items ORDER BY row")]
+        train_vectors = None
+        if kind in TRAINED_INDEX_TYPES:
+            sample = rows
+            if len(rows) > 200000:
+                sample = sorted(np.random.default_rng(0).choice(rows, 200000, replace=False).tolist())
+            train_vectors = self._vectors(sample)
+        index = self._new_index(kind, train_vectors)
+        self._index = index
+        self._index_kind = kind
+        for start in range(0, len(rows), 100000):
+            chunk = rows[start:start + 100000]
+            index.add_with_ids(self._encode(self._vectors(chunk)), np.asarray(chunk, dtype="int64"))
+        self._mmapped = False
+        self._apply_search_params()
+        self._dirty = True
+
+    def _save_index(self):
+        faiss = _import_faiss()
+        tmp_path = self._index_path + ".tmp"
+        if self._index_kind == "binary":
+            faiss.write_index_binary(self._index, tmp_path)
+        else:
+            faiss.write_index(self._index, tmp_path)
+        os.replace(tmp_path, self._index_path)
+        with self._db:
+            self._set_meta("indexed_rows", self._row_count())
+            self._set_meta("index_kind", self._index_kind)
+        self._unsaved = 0
+        self._dirty = False
+
+    def _where_rows(self, where, column="row"):
+        """按行号顺序返回满足过滤条件的行的 column 列（默认行号）"""
+        where = dict(where)
+        source_file = where.pop("source_file", None)
+        if source_file is not None:
+            cursor = self._db.execute(
+                f"SELECT {column}, metadata FROM items WHERE source_file = ? ORDER BY row", (source_file,)
+            )
+        else:
+            cursor = self._db.execute(f"SELECT {column}, metadata FROM items ORDER BY row")
+        return [value for value, metadata in cursor if not where or _matches(json.loads(metadata), where)]
+
+    # ---- 接口实现 ----
+
+    def add(self, ids, embeddings, documents, metadatas):
+        import numpy as np
+
+        if not len(ids):
+            return
+        vectors = np.ascontiguousarray(np.asarray(embeddings, dtype="float32"))
+        with self._writing():
+            if self.config["dim"] is None:
+                self.config["dim"] = int(vectors.shape[1])
+                self._save_config()
+            elif vectors.shape[1] != self.config["dim"]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match collection dimension {self.config['dim']}")
+            self._load_index()
+
+            # 同一批中重复的ID以最后一次为准
+            latest = {chunk_id: i for i, chunk_id in enumerate(ids)}
+            positions = sorted(latest.values())
+            vectors = vectors[positions]
+            start = self._row_count()
+            rows = list(range(start, start + len(positions)))
+
+            # 先追加原始向量，再提交元数据；中途中断只会留下没有元数据的无效行
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with self._db:
+                self._db.executemany("DELETE FROM items WHERE chunk_id = ?", [(ids[i],) for i in positions])
+                self._db.executemany(
+                    "INSERT INTO items (row, chunk_id, source_file, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (row, ids[i], (metadatas[i] or {}).get("source_file"), documents[i],
+                         json.dumps(metadatas[i] or {}, ensure_ascii=False))
+                        for row, i in zip(rows, positions)
+                    ],
+                )
+                self._bump_generation()
+            self._index_add(rows, vectors)
+            if self._unsaved >= FLUSH_EVERY:
+                self.flush()
+
+    def delete(self, ids):
+        ids = list(ids)
+        with self._writing():
+            with self._db:
+                self._db.executemany("DELETE FROM items WHERE chunk_id = ?", [(i,) for i in ids])
+            # 索引中的向量保留到下次压缩，查询时按元数据过滤
+            self._dirty = True
+
+    def get_ids(self, where=None):
+        with self._lock:
+            if not where:
+                return [chunk_id for (chunk_id,) in self._db.execute("SELECT chunk_id FROM items ORDER BY row")]
+            _check_where(where)
+            # 直接取出片段ID，不再用 row IN (...) 二次查询（匹配行数可能超过 SQLite 的参数个数上限）
+            return self._where_rows(where, column="chunk_id")
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def source_files(self):
+        with self._lock:
+            return {
+                source for (source,) in self._db.execute("SELECT DISTINCT source_file FROM items")
+                if source
+            }
+
+    def _fetch_rows(self, rows):
+        if not rows:
+            return {}
+        by_row = {}
+        for start in range(0, len(rows), 500):
+            chunk = rows[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row, chunk_id, document, metadata in self._db.execute(
+                f"SELECT row, chunk_id, document, metadata FROM items WHERE row IN ({placeholders})", chunk
+            ):
+                by_row[row] = (chunk_id, document, json.loads(metadata))
+        return by_row
+
+    def search(self, embedding, k=3, where=None):
+        import numpy as np
+
+        _check_where(where)
+        query = np.asarray(embedding, dtype="float32").reshape(1, -1)
+        with self._lock:
+            self._sync()
+            if self.config["dim"] is None:
+                return []
+            self._load_index()
+            if where:
+                candidates = self._where_rows(where)
+                if len(candidates) <= EXACT_FILTER_LIMIT:
+                    # 过滤后的候选不多，直接对这些向量做精确检索
+                    if not candidates:
+                        return []
+                    distances = ((self._vectors(candidates) - query) ** 2).sum(axis=1)
+                    order = np.argsort(distances)[:k]
+                    hits = [(candidates[i], float(distances[i])) for i in order]
+                    return self._to_documents(hits)
+
+            live = self.count()
+            if live == 0 or self._index is None or self._index.ntotal == 0:
+                return []
+            total = self._index.ntotal
+            # 压缩索引多取 rescore 倍候选，再用全精度向量重新计算距离
+            rescore = self._rescore_factor()
+            want = k * rescore if rescore else k
+            # 索引中可能残留已删除的向量，按有效比例多取一些候选
+            fetch = min(total, max(want, math.ceil(want * total / live)) + k)
+            encoded = self._encode(query)
+            while True:
+                distances, labels = self._index.search(encoded, fetch)
+                # 索引保存中断后重新打开时，同一行可能被补入两次
+                hits, seen = [], set()
+                for row, distance in zip(labels[0].tolist(), distances[0].tolist()):
+                    if row >= 0 and row not in seen:
+                        seen.add(row)
+                        hits.append((row, distance))
+                by_row = self._fetch_rows([row for row, _ in hits])
+                hits = [
+                    (row, d) for row, d in hits
+                    if row in by_row and (not where or _matches(by_row[row][2], where))
+                ]
+                if len(hits) >= want or fetch >= total:
+                    break
+                fetch = min(total, fetch * 4)
+
+            hits = hits[:want]
+            if rescore and hits:
+                rows = [row for row, _ in hits]
+                exact = ((self._vectors(rows) - query) ** 2).sum(axis=1).tolist()
+                hits = sorted(zip(rows, exact), key=lambda hit: hit[1])
+            return self._to_documents(hits[:k], by_row)
+
+    def search_batch(self, embeddings, ks, wheres=None):
+        """
+        没有过滤条件的查询合并成一次索引检索；带过滤条件或候选不足的查询逐个检索
+        """
+        import numpy as np
+
+        wheres = wheres or [None] * len(ks)
+        results = [None] * len(ks)
+        batch = [i for i, where in enumerate(wheres) if not where]
+        with self._lock:
+            self._sync()
+            ready = self.config["dim"] is not None
+            if ready and batch:
+                self._load_index()
+                live = self.count()
+                ready = live > 0 and self._index is not None and self._index.ntotal > 0
+            if ready and batch:
+                total = self._index.ntotal
+                rescore = self._rescore_factor()
+                wants = [ks[i] * rescore if rescore else ks[i] for i in batch]
+                # 与 search() 相同：按有效比例多取候选，所有查询共用最大的候选数
+                fetch = min(total, max(max(wants), math.ceil(max(wants) * total / live)) + max(ks[i] for i in batch))
+                queries = np.asarray([embeddings[i] for i in batch], dtype="float32").reshape(len(batch), -1)
+                distances, labels = self._index.search(self._encode(queries), fetch)
+                by_row = self._fetch_rows(sorted({row for row in labels.ravel().tolist() if row >= 0}))
+                for j, i in enumerate(batch):
+                    hits, seen = [], set()
+                    for row, distance in zip(labels[j].tolist(), distances[j].tolist()):
+                        if row >= 0 and row not in seen and row in by_row:
+                            seen.add(row)
+                            hits.append((row, distance))
+                    if len(hits) < wants[j] and fetch < total:
+                        # 残留的已删除向量太多，交给 search() 扩大候选数重试
+                        continue
+                    hits = hits[:wants[j]]
+                    if rescore and hits:
+                        rows = [row for row, _ in hits]
+                        exact = ((self._vectors(rows) - queries[j]) ** 2).sum(axis=1).tolist()
+                        hits = sorted(zip(rows, exact), key=lambda hit: hit[1])
+                    results[i] = self._to_documents(hits[:ks[i]], by_row)
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = self.search(embeddings[i], ks[i], wheres[i])
+        return results
+
+    def _to_documents(self, hits, by_row=None):
+        if by_row is None:
+            by_row = self._fetch_rows([row for row, _ in hits])
+        results = []
+        for row, distance in hits:
+            chunk_id, document, metadata = by_row[row]
+            results.append((Document(page_content=document, metadata=metadata, id=chunk_id), distance))
+        return results
+
+    def iter_batches(self, batch_size=1000, include_embeddings=True):
+        last_row = -1
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT row, chunk_id, document, metadata FROM items WHERE row > ? ORDER BY row LIMIT ?",
+                    (last_row, batch_size),
+                ).fetchall()
+                if not rows:
+                    break
+                embeddings = self._vectors([row for row, _, _, _ in rows]) if include_embeddings else None
+            last_row = rows[-1][0]
+            yield {
+                "ids": [chunk_id for _, chunk_id, _, _ in rows],
+                "embeddings": embeddings,
+                "documents": [document for _, _, document, _ in rows],
+                "metadatas": [json.loads(metadata) for _, _, _, metadata in rows],
+            }
+
+    def clear(self):
+        with self._writing():
+            self._index = None
+            self._index_kind = None
+            self._matrix = None
+            self._mmapped = False
+            with self._db:
+                self._db.execute("DELETE FROM items")
+                self._db.execute("DELETE FROM meta")
+                self._bump_generation()
+            for path in (self._index_path, self._vectors_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._unsaved = 0
+            self._dirty = False
+
+    def flush(self):
+        with self._writing():
+            if not self._dirty or self._index is None:
+                return
+            live = self.count()
+            total = self._row_count()
+            target = self.config["index_type"]
+            if total and live and (total - live) / total > self.config["compact_ratio"] and total > 1000:
+                self.compact()
+                return
+            if target in TRAINED_INDEX_TYPES and self._index_kind != target and live >= self.config["train_size"]:
+                # 向量数达到训练规模后由 Flat 切换到需要训练的索引
+                self._rebuild(target)
+            self._save_index()
+
+    def compact(self):
+        """
+        去掉已删除的向量：重写 vectors.f32 并重建索引
+        """
+        with self._writing():
+            rows = [row for (row,) in self._db.execute("SELECT row FROM items ORDER BY row")]
+            print(f"正在压缩 FAISS 集合 '{self.collection_name}'（保留 {len(rows)} / {self._row_count()} 个向量）...")
+            tmp_path = self._vectors_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(rows), 100000):
+                    f.write(self._vectors(rows[start:start + 100000]).tobytes())
+            self._matrix = None
+            self._index = None
+            # 行号按升序重新编号为 0..n-1，新行号不会与尚未更新的行冲突；
+            # 与 compacting 标记在同一事务中提交，替换文件前中断时由 _finish_compaction 在打开时完成替换
+            with self._db:
+                self._db.executemany("UPDATE items SET row = ? WHERE row = ?", list(enumerate(rows)))
+                self._set_meta("indexed_rows", 0)
+                self._set_meta("compacting", 1)
+            if os.path.exists(self._index_path):
+                os.remove(self._index_path)
+            os.replace(tmp_path, self._vectors_path)
+            with self._db:
+                self._db.execute("DELETE FROM meta WHERE key = 'compacting'")
+                self._bump_generation()
+            kind = self.config["index_type"]
+            if kind in TRAINED_INDEX_TYPES and len(rows) < self.config["train_size"]:
+                kind = "flat"
+            if rows:
+                self._rebuild(kind)
+                self._save_index()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._index = None
+            self._matrix = None
+            self._db.close()
+            os.close(self._lock_fd)
+            _open_faiss_stores.discard(self)
+
+    def stats(self):
+        with self._lock:
+            self._sync()
+            self._load_index()
+            return {
+                "backend": self.backend,
+                "count": self.count(),
+                "rows": self._row_count(),
+                "index_type": self.config["index_type"],
+                "index_kind": self._index_kind,
+                "indexed": self._index.ntotal if self._index is not None else 0,
+                "dim": self.config["dim"],
+                "mmapped": self._mmapped,
+                "rescore": self._rescore_factor(),
+                # 索引文件的大小即查询时需要驻留内存的数据量，float32 原始向量只在重排时按需读取
+                "index_bytes": os.path.getsize(self._index_path) if os.path.exists(self._index_path) else 0,
+                "vector_bytes": os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0,
+            }
+
+
+def migrate(collection_name="knowledge_base", persist_directory=settings.PERSIST_DIRECTORY, to="faiss",
+            batch_size=1000, drop_source=False, **options):
+    """
+    把集合的全部片段（连同已计算的向量）复制到另一个后端，不需要重新计算嵌入
+
+    Args:
+        to (str): 目标后端，"faiss" 或 "chroma"
+        drop_source (bool): 迁移成功后删除源后端中的数据
+        options: FAISS 配置，如 index_type="hnsw"、nlist=4096、pq_m=64、index_type="sq8"、rescore=4
+    """
+    from tools.registry import invalidate
+    from tools import manifest
+
+    source_backend = resolve_backend(collection_name, persist_directory)
+    if source_backend == to:
+        raise ValueError(f"集合 '{collection_name}' 已经使用 {to} 后端")
+    invalidate(persist_directory, collection_name)
+    source = open_store(collection_name, persist_directory, backend=source_backend)
+    if to == "faiss":
+        target = FaissStore(collection_name, persist_directory, **options)
+    else:
+        target = ChromaStore(collection_name, persist_directory)
+    if target.count():
+        raise ValueError(f"目标后端中的集合 '{collection_name}' 不为空")
+
+    total = source.count()
+    print(f"正在把集合 '{collection_name}' 的 {total} 个片段从 {source_backend} 迁移到 {to}...")
+    copied = 0
+    try:
+        for batch in source.iter_batches(batch_size):
+            target.add(batch["ids"], batch["embeddings"], batch["documents"], batch["metadatas"])
+            copied += len(batch["ids"])
+            print(f"已迁移 {copied}/{total} 个片段")
+        target.flush()
+        if target.count() != total:
+            raise RuntimeError(f"迁移后片段数不一致：源 {total}，目标 {target.count()}")
+    except Exception:
+        # 迁移失败时删除目标数据，集合继续使用源后端
+        if to == "faiss":
+            target.close()
+            shutil.rmtree(target.directory, ignore_errors=True)
+        raise
+    if to == "faiss":
+        # 源集合为空时没有写入过向量，配置文件需要在这里写入
+        target._save_config()
+        target.close()
+
+    if to == "chroma":
+        # 删除 FAISS 目录后集合即解析为 Chroma 后端
+        source.close()
+        shutil.rmtree(source.directory, ignore_errors=True)
+    elif drop_source:
+        source.drop()
+    manifest.bump_version(collection_name, persist_directory)
+    invalidate(persist_directory, collection_name)
+    print(f"迁移完成，集合 '{collection_name}' 现在使用 {to} 后端")
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="向量存储维护工具")
+    parser.add_argument("command", choices=["migrate", "compact", "stats"],
+                        help="migrate: 迁移到其他后端；compact: 压缩 FAISS 集合；stats: 查看存储信息")
+    parser.add_argument("--collection", default="knowledge_base", help="集合名称")
+    parser.add_argument("--persist-directory", default=settings.PERSIST_DIRECTORY, help="数据库持久化目录")
+    parser.add_argument("--to", default="faiss", choices=["faiss", "chroma"], help="迁移的目标后端")
+    parser.add_argument("--index-type", default=None, choices=INDEX_TYPES, help="FAISS 索引类型")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF 聚类中心数")
+    parser.add_argument("--pq-m", type=int, default=None, help="PQ 子向量数")
+    parser.add_argument("--hnsw-m", type=int, default=None, help="HNSW 邻居数")
+    parser.add_argument("--rescore", type=int, default=None, help="压缩索引重排的候选倍数，0 关闭重排")
+    parser.add_argument("--drop-source", action="store_true", help="迁移成功后删除 Chroma 中的源集合")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        migrate(
+            args.collection, args.persist_directory, to=args.to, drop_source=args.drop_source,
+            index_type=args.index_type, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m,
+            rescore=args.rescore,
+        )
+        return 0
+
+    from tools.registry import get_store
+    store = get_store(args.collection, args.persist_directory)
+    if args.command == "compact":
+        if not isinstance(store, FaissStore):
+            print(f"集合 '{args.collection}' 使用 {store.backend} 后端，无需压缩")
+            return 1
+        store.compact()
+    else:
+        print(json.dumps(store.stats(), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())